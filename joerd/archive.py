@@ -0,0 +1,25 @@
+# Paths to members of archives through GDAL's virtual file systems, so that
+# rasters can be read straight out of a downloaded archive without first
+# extracting them to disk.
+#
+# GDAL finds the end of the archive's name in the path by its extension, so
+# the archive must be named with the usual extension (e.g: `.zip`, `.tar.gz`)
+# for these to work.
+
+
+def zip_member(archive_name, member_name):
+    """
+    Returns a path GDAL can open to read `member_name` from the Zip file
+    called `archive_name`.
+    """
+
+    return '/vsizip/%s/%s' % (archive_name, member_name)
+
+
+def tar_member(archive_name, member_name):
+    """
+    Returns a path GDAL can open to read `member_name` from the TAR file
+    (which can be GZip-encoded) called `archive_name`.
+    """
+
+    return '/vsitar/%s/%s' % (archive_name, member_name)
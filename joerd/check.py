@@ -1,7 +1,5 @@
+from joerd.archive import tar_member
 import zipfile
-import tarfile
-import shutil
-import tempfile
 from osgeo import gdal
 
 
@@ -30,15 +28,10 @@ def tar_gz_has_gdal(member_name):
     """
 
     def func(tmp):
-        try:
-            tar = tarfile.open(tmp.name, mode='r:gz', errorlevel=2)
-            with tempfile.NamedTemporaryFile() as tmp_member:
-                shutil.copyfileobj(tar.extractfile(member_name), tmp_member)
-                tmp_member.seek(0)
-                return is_gdal(tmp_member)
-
-        except (tarfile.TarError, IOError, OSError) as e:
-            return False
+        # read the member straight out of the archive, rather than copying
+        # it to another file first. this fails if the archive is truncated
+        # or corrupt anywhere up to the end of the member.
+        return is_gdal_file(tar_member(tmp.name, member_name))
 
     return func
 
@@ -49,8 +42,17 @@ def is_gdal(tmp):
     a well-formed GDAL raster file.
     """
 
+    return is_gdal_file(tmp.name)
+
+
+def is_gdal_file(filename):
+    """
+    Returns true if `filename`, which can be a path in one of GDAL's virtual
+    file systems, appears to be a well-formed GDAL raster file.
+    """
+
     try:
-        ds = gdal.Open(tmp.name)
+        ds = gdal.Open(filename)
         band = ds.GetRasterBand(1)
         band.ComputeBandStats()
         return True
@@ -3,6 +3,9 @@ from osgeo import gdal
 from joerd.server import Server
 from joerd.plugin import plugin
 from joerd.dispatcher import Dispatcher, GroupingDispatcher
+from joerd.pool import WorkerPool, run_jobs
+import joerd.manifest as manifest
+import joerd.pyramid as pyramid
 import sys
 import argparse
 import os
@@ -13,6 +16,7 @@ import time
 import traceback
 import json
 import math
+import itertools
 
 
 def _make_queue(j, config):
@@ -25,6 +29,48 @@ def _make_queue(j, config):
     return create_fn(j, config)
 
 
+def _batches(iterable, size):
+    """
+    Yields lists of up to `size` consecutive items from `iterable`.
+    """
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            break
+        yield batch
+
+
+def _render_jobs(sources, tiles):
+    """
+    Returns a list of render jobs, one for each of `tiles`, each listing the
+    source files needed for it. Each source resolves the whole list of tiles
+    at once.
+    """
+
+    tile_sources = [[] for t in tiles]
+    for name, s in sources:
+        for i, v in enumerate(s.vrts_for_many(tiles)):
+            if v:
+                vrts = []
+                for rasters in v:
+                    files = [r.output_file() for r in rasters]
+                    if files:
+                        vrts.append(files)
+                if vrts:
+                    tile_sources[i].append(dict(source=name, vrts=vrts))
+
+    jobs = []
+    for tile, srcs in zip(tiles, tile_sources):
+        assert srcs, "Was expecting at least one source for tile %r, " \
+            "but it has none." % tile.tile_name()
+
+        jobs.append(dict(job='render', data=tile.freeze_dry(),
+                         sources=srcs))
+
+    return jobs
+
+
 def create_command_parser(fn):
     def create_parser_fn(parser):
         parser.add_argument('--config', required=True,
@@ -37,6 +83,19 @@ def create_command_parser(fn):
     return create_parser_fn
 
 
+def create_server_parser(fn):
+    create_fn = create_command_parser(fn)
+
+    def create_parser_fn(parser):
+        parser = create_fn(parser)
+        parser.add_argument('--workers', required=False, type=int,
+                            help='The number of worker processes to run. '
+                            'Overrides the cluster workers setting in the '
+                            'config file.')
+        return parser
+    return create_parser_fn
+
+
 class JoerdArgumentParser(argparse.ArgumentParser):
     def error(self, message):
         sys.stderr.write('error: %s\n' % message)
@@ -50,30 +109,31 @@ def joerd_server(cfg):
 
     This grabs jobs from the queue and processes them. Jobs which cannot be
     processed due to an error are ignored and the next job is processed.
+
+    If more than one worker is configured, then the jobs are run by a pool of
+    worker processes instead.
     """
     logger = logging.getLogger('process')
 
     j = Server(cfg)
     queue = _make_queue(j, cfg.queue_config)
 
+    if cfg.workers > 1:
+        logger.info("Starting pool of %d workers." % cfg.workers)
+        pool = WorkerPool(j, queue, cfg.workers)
+        pool.run()
+        return
+
     while True:
         for message in queue.receive_messages():
-            jobs = message.body
-
-            try:
-                for job in jobs:
-                    j.dispatch_job(job)
-
-            except StandardError as e:
-                logger.warning("During processing of job %r, caught "
-                               "exception. This job failed, continuing "
-                               "to the next. Exception details: %s" %
-                               (job, "".join(traceback.format_exception(
-                                   *sys.exc_info()))))
-            else:
+            if run_jobs(j, message.body, logger):
                 # remove the message from the queue - this indicates that
                 # it has completed successfully and it won't be retried.
                 message.delete()
+            else:
+                # stop extending the message's visibility timeout, so that
+                # it becomes visible again and is retried.
+                message.release()
 
 
 def joerd_enqueue_renders(cfg):
@@ -96,38 +156,53 @@ def joerd_enqueue_renders(cfg):
     # size limit is 256KB for SQS, but we'll leave a little bit of space
     # just in case there's some small overhead for encoding it as an array.
     size_limit = 256 * 1024 - 100
-    dispatcher = GroupingDispatcher(queue, max_batch_len, logger, size_limit)
+    dispatcher = GroupingDispatcher(queue, max_batch_len, logger, size_limit,
+                                    job_encoding=cfg.job_encoding)
+
+    # if manifests of rendered tiles are being kept, then only enqueue the
+    # tiles which haven't been rendered from the same inputs before.
+    rendered = None
+    if cfg.manifest_prefix:
+        logger.info("Loading manifests of rendered tiles")
+        rendered = manifest.load(j.store, cfg.manifest_prefix,
+                                 cfg.render_version)
 
     idx = 0
     next_idx = 0
+    skipped = 0
 
     logger.info("Starting loop")
     for output in j.outputs.itervalues():
         logger.info("Starting output %r" % output.__class__.__name__)
-        for tile in output.generate_tiles():
+
+        # tiles built from the pyramid need the heights from the zoom above,
+        # so send them last and bottom-up.
+        pyramid_max_zoom = cfg.pyramid.get('max_zoom')
+        if pyramid_max_zoom is not None:
+            generated = pyramid.bottom_up(output.generate_tiles,
+                                          pyramid_max_zoom)
+        else:
+            generated = output.generate_tiles()
+
+        # resolve the sources for a batch of tiles at a time, which is much
+        # faster than doing it tile by tile.
+        for tiles in _batches(generated, 1000):
             if idx >= next_idx:
                 next_idx += 10000
-                logger.info("[%d] At job %r" % (idx, tile.__class__.__name__))
-            idx += 1
-            sources = []
-            for name, s in j.sources:
-                v = s.vrts_for(tile)
-                if v:
-                    vrts = []
-                    for rasters in v:
-                        files = [r.output_file() for r in rasters]
-                        if files:
-                            vrts.append(files)
-                    if vrts:
-                        sources.append(dict(source=name, vrts=vrts))
-
-            assert sources, "Was expecting at least one source for tile %r, " \
-                "but it has none." % tile.tile_name()
-
-            job = dict(job='render', data=tile.freeze_dry(), sources=sources)
-            dispatcher.append(job)
+                logger.info("[%d] At job %r"
+                            % (idx, tiles[0].__class__.__name__))
+            idx += len(tiles)
+
+            for job in _render_jobs(j.sources, tiles):
+                if rendered is not None and rendered.is_current(job):
+                    skipped += 1
+                    continue
+                dispatcher.append(job)
 
     dispatcher.flush()
+    if rendered is not None:
+        logger.info("Skipped %d tiles which were already rendered from the "
+                    "same inputs." % skipped)
     logger.info("Done.")
 
 
@@ -151,7 +226,8 @@ def joerd_enqueue_single_renders(cfg):
     # size limit is 256KB for SQS, but we'll leave a little bit of space
     # just in case there's some small overhead for encoding it as an array.
     size_limit = 256 * 1024 - 100
-    dispatcher = GroupingDispatcher(queue, max_batch_len, logger, size_limit)
+    dispatcher = GroupingDispatcher(queue, max_batch_len, logger, size_limit,
+                                    job_encoding=cfg.job_encoding)
 
     idx = 0
     next_idx = 0
@@ -193,23 +269,8 @@ def joerd_enqueue_single_renders(cfg):
                     raise Exception, "Couldn't make a tile from line %r" \
                         % line
 
-            sources = []
-            for name, s in j.sources:
-                v = s.vrts_for(tile)
-                if v:
-                    vrts = []
-                    for rasters in v:
-                        files = [r.output_file() for r in rasters]
-                        if files:
-                            vrts.append(files)
-                    if vrts:
-                        sources.append(dict(source=name, vrts=vrts))
-
-            assert sources, "Was expecting at least one source for tile %r, " \
-                "but it has none." % tile.tile_name()
-
-            job = dict(job='render', data=tile.freeze_dry(), sources=sources)
-            dispatcher.append(job)
+            for job in _render_jobs(j.sources, [tile]):
+                dispatcher.append(job)
 
     dispatcher.flush()
     logger.info("Done.")
@@ -229,23 +290,37 @@ def joerd_enqueue_downloads(cfg):
     logger.info("Sending %d download jobs to the queue" % len(downloads))
     queue = _make_queue(j, cfg.queue_config)
 
-    # download jobs are long-running and don't benefit from any cache re-use,
-    # so don't batch them - just one job per batch.
+    # download jobs are long-running, so each message holds a single job.
+    # the job can be a batch of several downloads, which the server runs
+    # concurrently.
     max_batch_len = 1
     dispatcher = Dispatcher(queue, max_batch_len, logger)
+    download_batch_len = cfg.download['batch_len']
 
     # env var to turn on/off skipping existing files. this can be useful when
     # re-running the jobs for a particular area.
     skip_existing = os.getenv('SKIP_EXISTING', False)
 
+    # downloads from the same source are batched together, as they're likely
+    # to share a server, and so connections to it.
+    by_source = {}
     for d in downloads:
         # skip any files which already exist.
         if skip_existing and j.source_store.exists(d.output_file()):
             continue
 
         data = d.freeze_dry()
-        job = dict(job='download', data=data)
-        dispatcher.append(job)
+        by_source.setdefault(data['type'], []).append(data)
+
+    for typ in sorted(by_source.keys()):
+        data = by_source[typ]
+        for i in xrange(0, len(data), download_batch_len):
+            batch = data[i:i + download_batch_len]
+            if len(batch) == 1:
+                job = dict(job='download', data=batch[0])
+            else:
+                job = dict(job='downloadbatch', data=batch)
+            dispatcher.append(job)
 
     dispatcher.flush()
     logger.info("Done.")
@@ -259,7 +334,7 @@ def joerd_main(argv=None):
     subparsers = parser.add_subparsers()
 
     parser_config = (
-        ('server', create_command_parser(joerd_server)),
+        ('server', create_server_parser(joerd_server)),
         ('enqueue-renders', create_command_parser(joerd_enqueue_renders)),
         ('enqueue-single-renders', create_command_parser(joerd_enqueue_single_renders)),
         ('enqueue-downloads', create_command_parser(joerd_enqueue_downloads)),
@@ -274,6 +349,10 @@ def joerd_main(argv=None):
         'Config file %r does not exist.' % args.config
     cfg = make_config_from_argparse(args)
 
+    workers = getattr(args, 'workers', None)
+    if workers is not None:
+        cfg.workers = workers
+
     if cfg.logconfig is not None:
         config_dir = os.path.dirname(args.config)
         logconfig_path = os.path.join(config_dir, cfg.logconfig)
@@ -44,6 +44,22 @@ def _mk_image(src_ds, dst_ds, filter_type):
     assert res == gdal.CPLE_None
 
 
+def _mosaic(source, rasters):
+    """
+    Returns a context manager giving a VRT mosaic of the rasters. If the source
+    carries a VRT cache (see `joerd.vrt.Cache`) then that's used, so that
+    mosaics can be shared between all the tiles in a batch.
+    """
+
+    srs = source.srs().ExportToWkt()
+    vrt_cache = getattr(source, 'vrt_cache', None)
+
+    if vrt_cache is not None:
+        return vrt_cache.build(rasters, srs)
+
+    return vrt.build(rasters, srs)
+
+
 _NUMPY_TYPES = {
     gdal.GDT_Int16: numpy.int16,
     gdal.GDT_Float32: numpy.float32
@@ -57,6 +73,11 @@ _NUMPY_TYPES = {
 #
 # dst_ds will be erased to its nodata value before composition starts.
 #
+# internally, the layers are visited in the reverse order, most detailed
+# first, and each only fills in the pixels which are still nodata. this gives
+# the same result as painting them in order, but means that once the tile is
+# completely covered the remaining, less detailed, layers can be skipped.
+#
 def compose(tile, dst_ds, logger, dst_res):
     dst_band = dst_ds.GetRasterBand(1)
     dst_nodata = dst_band.GetNoDataValue()
@@ -72,56 +93,75 @@ def compose(tile, dst_ds, logger, dst_res):
     assert numpy_type is not None, "Unable to compose type %r" % \
         dst_band.GetUnitType()
 
-    # write the nodata value to blank out the source dataset
+    # the composited data is held in a single buffer, which starts off as
+    # all nodata and is written back to dst_ds at the end.
     # WATCH OUT! numpy shapes are confusingly the "wrong" way around, that
     # is they are (height, width)!
-    dst_band.WriteArray(
-        numpy.full((dst_y_size, dst_x_size), dst_nodata, numpy_type))
+    shape = (dst_y_size, dst_x_size)
+    dst_data = numpy.full(shape, dst_nodata, numpy_type)
+
+    # boolean mask of the pixels which are still nodata in dst_data, and
+    # a scratch mask of the pixels to fill from each layer.
+    missing = numpy.ones(shape, numpy.bool_)
+    fill = numpy.empty(shape, numpy.bool_)
 
     # we'll hold temporary reprojected layers in memory, so we need a
-    # memory driver to hold all of that.
+    # memory driver to hold all of that. the same buffer is re-used for each
+    # layer, as they're all the same size, type and location.
     mem_drv = gdal.GetDriverByName("MEM")
     assert mem_drv is not None
 
-    # loop over layers in order, so the first layer will be overwritten
-    # by any valid data values in later layers. so layers should be listed
-    # in order of increasing detail.
-    for source in tile.sources:
-        logger.debug("Processing layer %s VRT", type(source).__name__)
+    mem_ds = mem_drv.Create('', dst_x_size, dst_y_size, 1, dst_type)
+    assert mem_ds is not None
+    mem_ds.SetGeoTransform(dst_gt)
+    mem_ds.SetProjection(dst_srs)
+    mem_band = mem_ds.GetRasterBand(1)
+    mem_band.SetNoDataValue(dst_nodata)
+    mem_data = numpy.empty(shape, numpy_type)
+
+    # loop over layers in reverse order, so that the most detailed are
+    # visited first.
+    for source in reversed(tile.sources):
+        if not missing.any():
+            logger.debug("Tile fully covered, skipping layer %s VRT",
+                         type(source).__name__)
+            continue
 
-        mem_ds = mem_drv.Create('', dst_x_size, dst_y_size, 1, dst_type)
-        assert mem_ds is not None
-        mem_ds.SetGeoTransform(dst_gt)
-        mem_ds.SetProjection(dst_srs)
-        mem_band = mem_ds.GetRasterBand(1)
+        logger.debug("Processing layer %s VRT", type(source).__name__)
 
         def _filter_type_func(src_res):
             return source.filter_type(src_res, dst_res)
 
         vrts = source.vrts_for(tile)
-        for rasters in vrts:
+        for rasters in reversed(vrts):
             # set the memory buffer to be all nodata, which will be
             # overwritten by the call to _mk_image.
-            mem_band.SetNoDataValue(dst_nodata)
-            mem_band.WriteArray(
-                numpy.full((dst_y_size, dst_x_size), dst_nodata, numpy_type))
+            res = mem_band.Fill(dst_nodata)
+            assert res == gdal.CPLE_None
 
             # build a VRT of just the overlapping tiles, then generate
             # the output image.
-            with vrt.build(rasters, source.srs().ExportToWkt()) as src_ds:
+            with _mosaic(source, rasters) as src_ds:
                 _mk_image(src_ds, mem_ds, _filter_type_func)
 
-            # extract the output data, but only those which are not nodata,
-            # and overwrite those pixels in the dst. the pixels which are
-            # nodata in the VRT will stay nodata in the output.
-            mem_band = mem_ds.GetRasterBand(1)
-            mem_data = mem_band.ReadAsArray(0, 0, dst_x_size, dst_y_size)
-            nodata = mem_band.GetNoDataValue()
-
-            dst_data = dst_band.ReadAsArray(0, 0, dst_x_size, dst_y_size)
-            nodata_test = numpy.equal(mem_data, nodata)
-            new_data = numpy.choose(nodata_test, (mem_data, dst_data))
-            res = dst_band.WriteArray(new_data)
-            assert res == gdal.CPLE_None
+            # extract the output data, and fill in those pixels which are
+            # not nodata in the layer, but are still nodata in the dst.
+            mem_band.ReadAsArray(0, 0, dst_x_size, dst_y_size,
+                                 buf_obj=mem_data)
+            numpy.not_equal(mem_data, dst_nodata, out=fill)
+            numpy.logical_and(fill, missing, out=fill)
+            numpy.copyto(dst_data, mem_data, where=fill)
+
+            # the filled pixels are a subset of the missing ones, so this
+            # removes them from the missing set.
+            numpy.logical_xor(missing, fill, out=missing)
+
+            if not missing.any():
+                break
+
+    del mem_ds
+
+    res = dst_band.WriteArray(dst_data)
+    assert res == gdal.CPLE_None
 
     logger.debug("Done composite.")
@@ -17,6 +17,15 @@ class Configuration(object):
         self.logconfig = self._cfg('logging config')
         self.queue_config = self._cfg('cluster queue')
         self.block_size = self._cfg('cluster block_size')
+        self.metatile_size = self._cfg('cluster metatile_size')
+        self.workers = self._cfg('cluster workers')
+        self.working_set_size = self._cfg('cluster working_set_size')
+        self.upload_queue_size = self._cfg('cluster upload_queue_size')
+        self.job_encoding = self._cfg('cluster job_encoding')
+        self.manifest_prefix = self._cfg('cluster manifest_prefix')
+        self.render_version = self._cfg('cluster render_version')
+        self.pyramid = self._cfg('cluster pyramid')
+        self.download = self._cfg('cluster download')
         self.store = self._cfg('store')
         self.source_store = self._cfg('source_store')
 
@@ -63,6 +72,21 @@ def default_yml_config():
                 'type': 'fake',
             },
             'block_size': 2,
+            'metatile_size': 0,
+            'workers': 1,
+            'working_set_size': 2 * 1024 * 1024 * 1024,
+            'upload_queue_size': 0,
+            'job_encoding': 'json',
+            'manifest_prefix': None,
+            'render_version': 1,
+            'pyramid': {
+                'max_zoom': None,
+            },
+            'download': {
+                'batch_len': 4,
+                'threads': 4,
+                'host_limit': 2,
+            },
         },
         'store': {
             'type': 'file',
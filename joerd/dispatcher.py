@@ -1,3 +1,5 @@
+from collections import OrderedDict
+import joerd.job_codec as job_codec
 import traceback
 import json
 import sys
@@ -48,20 +50,53 @@ class Dispatcher(object):
         self.logger.info("Dispatcher sent %d jobs in total." % self.idx)
 
 
+# json.dumps makes a new encoder for each call when given any non-default
+# parameters, which is a significant overhead when encoding lots of small
+# objects, so keep one around.
+_JSON_ENCODER = json.JSONEncoder(separators=(',',':'))
+
+
 def _json_dumps(obj):
     """
-    Convenience method to call json.dumps with a consistent set of (compact)
+    Convenience method to encode JSON with a consistent set of (compact)
     parameters.
     """
-    return json.dumps(obj, separators=(',',':'))
+    return _JSON_ENCODER.encode(obj)
+
+
+class EncodedJob(dict):
+    """
+    A job which also carries its compact JSON encoding in `json`, so that
+    queues which send JSON don't have to serialise it again.
+    """
+
+    def __init__(self, job, encoded):
+        super(EncodedJob, self).__init__(job)
+        self.json = encoded
 
 
 class JSONSizer(object):
-    def __init__(self, sources, limit):
+    """
+    Accumulates the data for a batch of render jobs sharing the same sources,
+    and keeps track of the size of its JSON encoding as it goes.
+
+    Each datum is encoded once as it's appended, and the encoding of the
+    whole batch is made by joining those fragments together when it's
+    flushed.
+    """
+
+    def __init__(self, sources, limit, encoded_sources=None):
+        if encoded_sources is None:
+            encoded_sources = _json_dumps(sources)
+
+        self.sources = sources
         self.limit = limit
         self.data = []
-        fake_job_data = self._job_data(sources)
-        self.initial_size = len(_json_dumps(fake_job_data))
+        self.fragments = []
+        self.prefix = '{"job":"renderbatch","sources":%s,"data":[' \
+                      % encoded_sources
+        self.suffix = ']}'
+        self.initial_size = len(self.prefix) + len(self.suffix)
         self.size = self.initial_size
 
     def _job_data(self, sources):
@@ -71,7 +106,8 @@ class JSONSizer(object):
 
     def append(self, sources, data):
         flushed = None
-        data_size = len(_json_dumps(data)) + 1
+        fragment = _json_dumps(data)
+        data_size = len(fragment) + 1
 
         assert data_size < self.limit, "Job too large for limit: " \
             "%d >= %d." % (self.size + 1, self.limit)
@@ -80,17 +116,74 @@ class JSONSizer(object):
             flushed = self.flush(sources)
 
         self.data.append(data)
+        self.fragments.append(fragment)
         self.size += data_size
 
         return flushed
 
     def flush(self, sources):
-        flushed = self._job_data(sources)
+        encoded = self.prefix + ",".join(self.fragments) + self.suffix
+        flushed = EncodedJob(self._job_data(sources), encoded)
         self.data = []
+        self.fragments = []
         self.size = self.initial_size
         return flushed
 
 
+class PackedSizer(object):
+    """
+    Accumulates the data for a batch of render jobs sharing the same sources,
+    like JSONSizer, but flushes them as a packed job (see joerd.job_codec).
+
+    Packed jobs can't be sized incrementally, so up to `max_tiles` data are
+    accumulated before flushing. If the packed job turns out to be larger
+    than the limit, then only as many of the data as fit are flushed, and
+    the rest are left for the next flush.
+    """
+
+    def __init__(self, sources, limit, max_tiles=10000):
+        self.sources = sources
+        self.limit = limit
+        self.max_tiles = max_tiles
+        self.data = []
+
+    def append(self, sources, data):
+        flushed = None
+
+        if len(self.data) >= self.max_tiles:
+            flushed = self.flush(sources)
+
+        self.data.append(data)
+        return flushed
+
+    def _encode(self, sources, count):
+        job = job_codec.encode_render_batch(sources, self.data[:count])
+        return EncodedJob(job, _json_dumps(job))
+
+    def flush(self, sources):
+        count = len(self.data)
+        flushed = self._encode(sources, count)
+
+        if len(flushed.json) > self.limit:
+            # binary search for the largest number of data which fit.
+            lo, hi = 1, count - 1
+            flushed = None
+            while lo <= hi:
+                mid = (lo + hi) // 2
+                job = self._encode(sources, mid)
+                if len(job.json) <= self.limit:
+                    flushed, count = job, mid
+                    lo = mid + 1
+                else:
+                    hi = mid - 1
+
+            assert flushed is not None, "Job too large for limit, even " \
+                "with a single tile: %r" % self.data[0]
+
+        self.data = self.data[count:]
+        return flushed
+
+
 def _freeze(obj):
     if isinstance(obj, dict):
         frozen_items = [(_freeze(k), _freeze(v)) for (k, v) in obj.items()]
@@ -119,15 +212,31 @@ class GroupingDispatcher(object):
     """
     A dispatcher which groups jobs by the sources that they require. This
     should help to improve cache re-use.
+
+    If `job_encoding` is 'packed', then the batches are sent as compact packed
+    jobs rather than JSON, which can hold many more tiles per message.
+
+    At most `max_open_batches` groups are held open at once. When another is
+    needed, the least recently used group is sent, so that memory use doesn't
+    grow with the number of distinct sets of sources. Tiles are generated in
+    spatial order, so a group which hasn't been used for a while is unlikely
+    to be used again.
     """
 
-    def __init__(self, queue, max_batch_len, logger, size_limit):
+    def __init__(self, queue, max_batch_len, logger, size_limit,
+                 max_open_batches=1000, job_encoding='json'):
+        assert job_encoding in ('json', 'packed'), "Unknown job encoding " \
+            "%r, expected either 'json' or 'packed'." % job_encoding
+
         self.queue = queue
         self.max_batch_len = max_batch_len
         self.logger = logger
         self.limit = size_limit
+        self.max_open_batches = max_open_batches
+        self.job_encoding = job_encoding
 
-        self.batches = {}
+        self.batches = OrderedDict()
+        self.last_key = None
         self.dispatcher = Dispatcher(self.queue, self.max_batch_len,
                                      self.logger)
 
@@ -142,20 +251,46 @@ class GroupingDispatcher(object):
             self.dispatcher.append(job)
 
     def _append_render_batch(self, sources, data):
-        sources_key = _freeze(sources)
-        json_sizer = self.batches.get(sources_key)
+        # the encoding of the sources is used both to group the jobs and as
+        # part of the encoding of the batch. the keys aren't sorted, as that
+        # is much slower, so equal sources with keys in a different order
+        # might end up in different batches, which is harmless.
+        sources_key = _json_dumps(sources)
+
+        # consecutive jobs very often have the same sources, in which case
+        # the batch is already the most recently used.
+        if sources_key == self.last_key:
+            sizer = self.batches[sources_key]
+
+        else:
+            sizer = self.batches.pop(sources_key, None)
+
+            if sizer is None:
+                while len(self.batches) >= self.max_open_batches:
+                    self._flush_batch(self.batches.popitem(last=False)[1])
+                if self.job_encoding == 'packed':
+                    sizer = PackedSizer(sources, self.limit)
+                else:
+                    sizer = JSONSizer(sources, self.limit, sources_key)
 
-        if json_sizer is None:
-            json_sizer = JSONSizer(sources, self.limit)
-            self.batches[sources_key] = json_sizer
+            # (re-)insert at the end, to mark it as the most recently used.
+            self.batches[sources_key] = sizer
+            self.last_key = sources_key
 
-        flushed = json_sizer.append(sources, data)
+        flushed = sizer.append(sources, data)
         if flushed:
             self.dispatcher.append(flushed)
 
-    def flush(self):
-        for sources_key, json_sizer in self.batches.iteritems():
-            flushed = json_sizer.flush(_thaw(sources_key))
+    def _flush_batch(self, sizer):
+        # packed batches might not all fit in a single job.
+        while sizer.data:
+            flushed = sizer.flush(sizer.sources)
             self.dispatcher.append(flushed)
 
+    def flush(self):
+        for sizer in self.batches.itervalues():
+            self._flush_batch(sizer)
+        self.batches.clear()
+        self.last_key = None
+
         self.dispatcher.flush()
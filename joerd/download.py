@@ -1,6 +1,11 @@
 from contextlib2 import contextmanager, closing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+import requests
+import urllib
 import urllib2
+import urlparse
 import tempfile
+import threading
 import os
 import logging
 import shutil
@@ -8,6 +13,11 @@ import httplib
 import ftplib
 import socket
 from time import sleep
+from urllib3.exceptions import HTTPError as _Urllib3Error
+
+
+# size of the chunks in which segments are copied from the server to the file.
+_CHUNK_SIZE = 64 * 1024
 
 
 # Custom error wrapper for (known) exceptions thrown by the download module.
@@ -15,6 +25,442 @@ class DownloadFailedError(Exception):
     pass
 
 
+# Raised when a server which said it accepts Range requests doesn't honour
+# them, so that the download can fall back to a single stream.
+class _RangeNotSupportedError(Exception):
+    pass
+
+
+def _suffix(url):
+    """
+    Returns the extension(s) of the file name in `url`, e.g: `.tar.gz`, so
+    that the downloaded file can be given the same ones. GDAL's virtual file
+    systems need these to recognise archives.
+    """
+
+    name = os.path.basename(urlparse.urlparse(url).path)
+    idx = name.find('.')
+    return name[idx:] if idx > 0 else ''
+
+
+@contextmanager
+def _no_slot():
+    yield
+
+
+def _host_slot(url, options):
+    """
+    Returns a context manager to hold while a connection to the server for
+    `url` is in use. The 'host_slot' option can be used to limit the number
+    of connections to each server, for example to keep under a rate limit.
+    """
+
+    host_slot = options.get('host_slot')
+    if host_slot is None:
+        return _no_slot()
+    return host_slot(url)
+
+
+class _HeadRequest(urllib2.Request):
+    def get_method(self):
+        return 'HEAD'
+
+
+class _SessionResponse(object):
+    """
+    Wraps a streamed `requests` response to look like the file-like objects
+    returned by `urllib2.urlopen`.
+    """
+
+    def __init__(self, resp):
+        self.resp = resp
+
+    def read(self, n=-1):
+        try:
+            return self.resp.raw.read(n if n >= 0 else None)
+        except _Urllib3Error as e:
+            # so that callers only need to handle the same errors as urllib2.
+            raise IOError(str(e))
+
+    def info(self):
+        return self.resp.headers
+
+    def getcode(self):
+        return self.resp.status_code
+
+    def close(self):
+        # a response which has been read to its end, such as a byte range or
+        # a HEAD request, has its connection put back in the pool once the
+        # end has been seen. closing it before then would close the
+        # connection too, so that it couldn't be re-used.
+        if getattr(self.resp.raw, 'length_remaining', None) == 0:
+            try:
+                self.resp.raw.read(1)
+            except _Urllib3Error:
+                pass
+        self.resp.close()
+
+
+# errors which are raised for replies from an FTP server, after which the
+# session can carry on being used.
+_FTP_REPLY_ERRORS = (ftplib.error_reply, ftplib.error_temp, ftplib.error_perm)
+
+
+def _close_ftp(ftp, polite=True):
+    try:
+        if polite:
+            ftp.quit()
+        else:
+            ftp.close()
+    except ftplib.all_errors:
+        ftp.close()
+
+
+class FTPPool(object):
+    """
+    Keeps logged-in FTP sessions open between transfers, so that fetching
+    many files from the same server doesn't need a new connection and login
+    for each one. Up to `max_idle` sessions are kept for each server and
+    user.
+    """
+
+    def __init__(self, max_idle=8):
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.idle = {}
+
+    def _take(self, key):
+        with self.lock:
+            # sessions can't be shared with a forked process, so the child
+            # forgets about them without closing them.
+            if os.getpid() != self.pid:
+                self.pid = os.getpid()
+                self.idle = {}
+
+            sessions = self.idle.get(key)
+            return sessions.pop() if sessions else None
+
+    def _give(self, key, ftp):
+        with self.lock:
+            sessions = self.idle.setdefault(key, [])
+            if os.getpid() == self.pid and len(sessions) < self.max_idle:
+                sessions.append(ftp)
+                return
+        _close_ftp(ftp)
+
+    @contextmanager
+    def session(self, netloc, timeout=60):
+        """
+        Yields a logged-in session with the server at `netloc`, which is the
+        network location part of an FTP URL, e.g: `user:pass@host:port`.
+        The session is returned to the pool afterwards, unless an error
+        other than an error reply from the server was raised, in which case
+        it's in an unknown state and is closed.
+        """
+
+        parts = urlparse.urlparse('ftp://' + netloc)
+        key = (parts.hostname, parts.port or ftplib.FTP_PORT,
+               urllib.unquote(parts.username or ''),
+               urllib.unquote(parts.password or ''))
+
+        ftp = self._take(key)
+        while ftp is not None:
+            # the server might have closed the session while it was idle,
+            # which is cheaper to find out now than part way through a
+            # transfer.
+            try:
+                ftp.sock.settimeout(timeout)
+                ftp.voidcmd('NOOP')
+                break
+            except ftplib.all_errors:
+                _close_ftp(ftp, False)
+                ftp = self._take(key)
+
+        if ftp is None:
+            host, port, user, passwd = key
+            ftp = ftplib.FTP()
+            try:
+                ftp.connect(host, port, timeout)
+                ftp.login(user, passwd)
+                ftp.set_pasv(True)
+            except:
+                _close_ftp(ftp, False)
+                raise
+
+        try:
+            yield ftp
+        except _FTP_REPLY_ERRORS:
+            # the server replied, so the session is still in step with it.
+            self._give(key, ftp)
+            raise
+        except:
+            _close_ftp(ftp, False)
+            raise
+        self._give(key, ftp)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for sessions in idle.itervalues():
+            for ftp in sessions:
+                _close_ftp(ftp)
+
+
+# sessions used for FTP downloads and listings which aren't given a
+# `Connections` object of their own.
+_FTP_POOL = FTPPool()
+
+
+def ftp_session(server, timeout=60):
+    """
+    Returns a context manager yielding a logged-in, pooled session with the
+    FTP `server`, which is a host name with an optional port, user and
+    password, e.g: `user:pass@host:port`.
+    """
+
+    return _FTP_POOL.session(server, timeout)
+
+
+def ftp_mdtm(ftp, path):
+    """
+    Returns the modification time of `path` reported by the server of the
+    FTP session `ftp`, as a string, or None if the server won't say.
+    """
+
+    try:
+        resp = ftp.sendcmd('MDTM ' + path)
+    except ftplib.error_perm:
+        return None
+
+    code, _, mtime = resp.partition(' ')
+    return mtime.strip() if code == '213' else None
+
+
+def get_if_modified(url, validators, timeout=60):
+    """
+    Fetches the text of the page at the HTTP `url`, unless it hasn't changed
+    since it was fetched with the given `validators`, the dict returned with
+    it last time. Returns a tuple of the text, or None if it hasn't changed,
+    and the validators to use next time.
+    """
+
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+
+    r = requests.get(url, headers=headers, timeout=timeout)
+    if r.status_code == 304:
+        return None, validators
+
+    r.raise_for_status()
+    new_validators = {}
+    if r.headers.get('ETag'):
+        new_validators['etag'] = r.headers['ETag']
+    if r.headers.get('Last-Modified'):
+        new_validators['last_modified'] = r.headers['Last-Modified']
+    return r.text, new_validators
+
+
+class Connections(object):
+    """
+    Keeps connections to servers open between downloads, so that fetching
+    many files from the same server doesn't have to connect again for each
+    one. HTTP connections are kept alive by a `requests` session, and FTP
+    sessions are kept in an `FTPPool`. Both can be shared between threads.
+
+    Call `close` to close all the connections when they're no longer needed.
+    """
+
+    def __init__(self, pool_size=10):
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.session = None
+        self.ftp = FTPPool(pool_size)
+
+    def _session(self):
+        with self.lock:
+            if self.session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=self.pool_size,
+                    pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                # requests asks for gzip-encoded responses by default, but
+                # the raw response body is read as-is, so the server must
+                # send the file unencoded. that also keeps Content-Length
+                # and Range offsets in bytes of the file.
+                session.headers['Accept-Encoding'] = 'identity'
+                self.session = session
+            return self.session
+
+    def open(self, url, headers, timeout, method='GET'):
+        """
+        Opens the HTTP or HTTPS `url`, returning a file-like object for the
+        response.
+        """
+
+        resp = self._session().request(
+            method, url, headers=headers, timeout=timeout, stream=True)
+        try:
+            resp.raise_for_status()
+        except:
+            resp.close()
+            raise
+        return _SessionResponse(resp)
+
+    def close(self):
+        with self.lock:
+            if self.session is not None:
+                self.session.close()
+                self.session = None
+        self.ftp.close()
+
+
+def _open(url, headers, options, method='GET'):
+    """
+    Opens `url`, returning a file-like object for the response. The
+    connection is taken from the 'connections' option, if there is one.
+    """
+
+    timeout = options.get('timeout', 60)
+    connections = options.get('connections')
+    if connections is not None and \
+       urlparse.urlparse(url).scheme in ('http', 'https'):
+        return connections.open(url, headers, timeout, method)
+
+    request_class = _HeadRequest if method == 'HEAD' else urllib2.Request
+    return urllib2.urlopen(request_class(url, headers=headers),
+                           timeout=timeout)
+
+
+def _probe(url, options):
+    """
+    Returns the size of the file at `url` if the server reports it and says
+    that it accepts byte Range requests, or None otherwise.
+    """
+
+    logger = logging.getLogger('download')
+
+    try:
+        with _host_slot(url, options):
+            f = _open(url, {}, options, 'HEAD')
+            try:
+                info = f.info()
+                if info.get('Accept-Ranges') != 'bytes':
+                    return None
+                return int(info.get('Content-Length'))
+
+            finally:
+                f.close()
+
+    except (IOError, httplib.HTTPException, socket.timeout, TypeError,
+            ValueError) as e:
+        logger.debug("Unable to probe %r for segmented download: %s"
+                     % (url, str(e)))
+        return None
+
+
+def _get_range(url, filename, start, end, options, failed):
+    """
+    Downloads bytes `start` to `end` inclusive of the file at `url` into the
+    same position in the existing file `filename`, retrying and backing off
+    in the same way as `get` does for a whole file. Gives up early if the
+    `failed` event is set by another segment.
+    """
+
+    logger = logging.getLogger('download')
+    max_tries = options.get('tries', 1)
+    backoff = options.get('backoff')
+
+    pos = start
+    tries = 0
+    last_successful_try = 0
+
+    with open(filename, 'r+b') as fh:
+        while pos <= end:
+            if failed.is_set():
+                return
+
+            if tries >= max_tries:
+                raise DownloadFailedError("Max tries exceeded (%d) while "
+                                          "downloading bytes %d-%d of file "
+                                          "%r" % (max_tries, start, end, url))
+            else:
+                if backoff and tries > last_successful_try:
+                    backoff(tries - last_successful_try)
+                tries += 1
+
+            headers = {'Range': 'bytes=%d-%d' % (pos, end)}
+            old_pos = pos
+
+            try:
+                with _host_slot(url, options):
+                    f = _open(url, headers, options)
+                    try:
+                        if f.getcode() != 206:
+                            raise _RangeNotSupportedError()
+
+                        fh.seek(pos, os.SEEK_SET)
+                        # stop part-way through if another segment failed,
+                        # rather than fetching the rest of the range.
+                        while pos <= end and not failed.is_set():
+                            data = f.read(min(_CHUNK_SIZE, end - pos + 1))
+                            if not data:
+                                break
+                            fh.write(data)
+                            pos += len(data)
+
+                    finally:
+                        f.close()
+
+            except (IOError, httplib.HTTPException) as e:
+                logger.debug("Got HTTP error: %s" % str(e))
+
+            except socket.timeout as e:
+                logger.debug("Got socket timeout: %s" % str(e))
+
+            if pos > old_pos:
+                last_successful_try = tries
+
+
+def _get_segmented(url, tmp, filesize, num_segments, options):
+    """
+    Downloads the file at `url`, which is `filesize` bytes long, into the
+    file `tmp` as `num_segments` byte ranges fetched concurrently.
+    """
+
+    logger = logging.getLogger('download')
+    logger.info("Downloading %r in %d segments" % (url, num_segments))
+
+    # preallocate the file, so that each segment can be written in place.
+    tmp.seek(0, os.SEEK_SET)
+    tmp.truncate(filesize)
+    tmp.flush()
+
+    segment_size = -(-filesize // num_segments)
+    failed = threading.Event()
+
+    with ThreadPoolExecutor(num_segments) as executor:
+        futures = []
+        for start in xrange(0, filesize, segment_size):
+            end = min(start + segment_size, filesize) - 1
+            futures.append(executor.submit(
+                _get_range, url, tmp.name, start, end, options, failed))
+
+        # as soon as any segment fails, tell the others to give up, so that
+        # the error (or the fallback to a single stream) isn't held up until
+        # they've finished.
+        done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        for fut in futures:
+            if fut in done and fut.exception() is not None:
+                failed.set()
+                raise fut.exception()
+
+
 @contextmanager
 def get(url, options={}):
     """
@@ -29,10 +475,36 @@ def get(url, options={}):
       * 'verifier' - A function which is called with a filelike object. It
         should return True if the file is okay and appears to be fully
         downloaded.
+      * 'segments' - The maximum number of byte ranges of an HTTP file to
+        download concurrently, if the server supports Range requests.
+      * 'min_segment_size' - The minimum size in bytes of each byte range.
+        Files smaller than two segments are downloaded as a single stream.
+      * 'connections' - A `Connections` object to take connections to the
+        server from, so that they can be re-used for other downloads.
+      * 'host_slot' - A function which is called with the URL, returning a
+        context manager which is held for as long as each connection to the
+        server is in use.
     """
     logger = logging.getLogger('download')
 
-    with closing(tempfile.NamedTemporaryFile()) as tmp:
+    with closing(tempfile.NamedTemporaryFile(suffix=_suffix(url))) as tmp:
+        # large files from servers which accept Range requests are downloaded
+        # as several segments at once, and FTP files over pooled sessions.
+        # otherwise, fall back to a single urllib2 stream below.
+        if _get_in_segments(url, tmp, options) or \
+           _get_ftp(url, tmp, options):
+            # verify the file, as below.
+            verifier = options.get('verifier')
+            if verifier is not None:
+                tmp.seek(0, os.SEEK_SET)
+                if not verifier(tmp):
+                    raise DownloadFailedError("File downloaded from %r "
+                                              "failed verification" % url)
+
+            tmp.seek(0, os.SEEK_SET)
+            yield tmp
+            return
+
         # current file position = number of bytes read
         filepos = 0
 
@@ -75,7 +547,7 @@ def get(url, options={}):
                     backoff(tries - last_successful_try)
                 tries += 1
 
-            req = urllib2.Request(url)
+            headers = {}
 
             # if the server supports accept range, and we have a partial
             # download then attemp to resume it.
@@ -83,7 +555,7 @@ def get(url, options={}):
                 logger.info("Continuing (try %d/%d) at %d bytes: %r"
                             % (tries, max_tries, filepos, url))
                 assert filesize is not None
-                req.headers['Range'] = 'bytes=%s-%s' % (filepos, filesize - 1)
+                headers['Range'] = 'bytes=%s-%s' % (filepos, filesize - 1)
             else:
                 # otherwise, truncate the file in readiness to download from
                 # scratch.
@@ -94,22 +566,28 @@ def get(url, options={}):
                 tmp.truncate(0)
 
             try:
-                f = urllib2.urlopen(req, timeout=timeout)
-
-                # try to get the filesize, if the server reports it.
-                if filesize is None:
-                    content_length = f.info().get('Content-Length')
-                    if content_length is not None:
-                        try:
-                            filesize = int(content_length)
-                        except ValueError:
-                            pass
-
-                # detect whether the server accepts Range requests.
-                accept_range = f.info().get('Accept-Ranges') == 'bytes'
-
-                # copy data from the server
-                shutil.copyfileobj(f, tmp)
+                with _host_slot(url, options):
+                    f = _open(url, headers, options)
+
+                    # try to get the filesize, if the server reports it.
+                    if filesize is None:
+                        content_length = f.info().get('Content-Length')
+                        if content_length is not None:
+                            try:
+                                filesize = int(content_length)
+                            except ValueError:
+                                pass
+
+                    # detect whether the server accepts Range requests.
+                    accept_range = f.info().get('Accept-Ranges') == 'bytes'
+
+                    # copy data from the server, closing the response
+                    # afterwards so that a kept-alive connection can be used
+                    # again.
+                    try:
+                        shutil.copyfileobj(f, tmp)
+                    finally:
+                        f.close()
 
             except (IOError, httplib.HTTPException) as e:
                 logger.debug("Got HTTP error: %s" % str(e))
@@ -152,6 +630,148 @@ def get(url, options={}):
         yield tmp
 
 
+def _get_ftp(url, tmp, options):
+    """
+    Downloads the file at `url` into `tmp` over a pooled FTP session,
+    resuming from where the last try left off with a REST command if the
+    transfer is interrupted. Returns False without downloading if `url`
+    isn't an FTP URL.
+    """
+
+    parts = urlparse.urlparse(url)
+    if parts.scheme != 'ftp':
+        return False
+
+    logger = logging.getLogger('download')
+    connections = options.get('connections')
+    pool = connections.ftp if connections is not None else _FTP_POOL
+
+    # the path is used as-is, rather than changing to its directory first,
+    # so that pooled sessions don't depend on the directory they were left
+    # in.
+    path = urllib.unquote(parts.path)
+
+    max_tries = options.get('tries', 1)
+    timeout = options.get('timeout', 60)
+    verifier = options.get('verifier')
+    backoff = options.get('backoff')
+
+    filepos = 0
+    filesize = None
+    tries = 0
+    last_successful_try = 0
+
+    # whether the server accepts REST commands to resume a transfer. this is
+    # assumed until it refuses one.
+    accept_rest = True
+
+    while True:
+        if tries >= max_tries:
+            raise DownloadFailedError("Max tries exceeded (%d) while "
+                                      "downloading file %r"
+                                      % (max_tries, url))
+        else:
+            if backoff and tries > last_successful_try:
+                backoff(tries - last_successful_try)
+            tries += 1
+
+        if accept_rest and filepos > 0:
+            logger.info("Continuing (try %d/%d) at %d bytes: %r"
+                        % (tries, max_tries, filepos, url))
+        else:
+            logger.info("Downloading (try %d/%d) %r"
+                        % (tries, max_tries, url))
+            filepos = 0
+            tmp.seek(0, os.SEEK_SET)
+            tmp.truncate(0)
+
+        complete = False
+        try:
+            with _host_slot(url, options), \
+                 pool.session(parts.netloc, timeout) as ftp:
+                ftp.voidcmd('TYPE I')
+                if filesize is None:
+                    try:
+                        filesize = ftp.size(path)
+                    except ftplib.error_perm:
+                        # SIZE isn't supported everywhere.
+                        pass
+
+                try:
+                    conn = ftp.transfercmd('RETR ' + path, filepos or None)
+                except (ftplib.error_reply, ftplib.error_perm):
+                    if filepos > 0:
+                        accept_rest = False
+                    raise
+
+                try:
+                    while True:
+                        data = conn.recv(_CHUNK_SIZE)
+                        if not data:
+                            break
+                        tmp.write(data)
+                finally:
+                    conn.close()
+
+                ftp.voidresp()
+                complete = True
+
+        except ftplib.all_errors as e:
+            logger.debug("Got FTP error: %s" % str(e))
+
+        old_filepos = filepos
+        filepos = tmp.tell()
+        if filepos > old_filepos:
+            last_successful_try = tries
+
+        if complete and (filesize is None or filepos >= filesize):
+            break
+
+        # if we don't know how large the file is supposed to be, then a
+        # partial file can't be resumed, but it might be complete anyway.
+        if filesize is None:
+            accept_rest = False
+            if verifier is not None:
+                tmp.seek(0, os.SEEK_SET)
+                if verifier(tmp):
+                    break
+
+    return True
+
+
+def _get_in_segments(url, tmp, options):
+    """
+    Tries to download the file at `url` into `tmp` as concurrent segments,
+    returning False without downloading if that isn't possible.
+    """
+
+    segments = options.get('segments', 1)
+    min_segment_size = options.get('min_segment_size', 16 * 1024 * 1024)
+
+    if segments < 2 or \
+       urlparse.urlparse(url).scheme not in ('http', 'https'):
+        return False
+
+    filesize = _probe(url, options)
+    if filesize is None:
+        return False
+
+    num_segments = min(segments, filesize // max(1, min_segment_size))
+    if num_segments < 2:
+        return False
+
+    try:
+        _get_segmented(url, tmp, filesize, num_segments, options)
+
+    except _RangeNotSupportedError:
+        logger = logging.getLogger('download')
+        logger.info("Server for %r doesn't honour Range requests, falling "
+                    "back to a single stream." % url)
+        return False
+
+    return True
+
+
 def _exponential_backoff(try_num):
     """
     Backoff exponentially, with each request backing off 2x from the previous
@@ -183,4 +803,10 @@ def options(in_opts={}):
     tries = in_opts.get('tries', 10)
     out_opts['tries'] = int(tries)
 
+    segments = in_opts.get('segments', 4)
+    out_opts['segments'] = int(segments)
+
+    min_segment_size = in_opts.get('min_segment_size', 16 * 1024 * 1024)
+    out_opts['min_segment_size'] = int(min_segment_size)
+
     return out_opts
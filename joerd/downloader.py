@@ -0,0 +1,138 @@
+from contextlib2 import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+import joerd.download as download
+import threading
+import urlparse
+import logging
+import traceback
+import sys
+import os
+
+
+class Downloader(object):
+    """
+    Downloads source files and puts them in a store, running up to
+    `num_threads` downloads at once.
+
+    Servers such as the USGS FTP and NOAA HTTP servers throttle clients which
+    make too many connections at once, so no more than `host_limit`
+    connections are made to each server at the same time, counting each
+    segment of a segmented download. A source can set its own limit with
+    the `num_download_threads` option. Connections are kept open
+    between files, so that downloads from the same server can re-use them.
+    """
+
+    def __init__(self, num_threads, host_limit):
+        self.num_threads = num_threads
+        self.host_limit = host_limit
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # open connections can't be shared with a forked process, so each
+        # process starts afresh.
+        self.pid = os.getpid()
+        self.connections = download.Connections()
+        self.semaphores = {}
+
+    def close(self):
+        """
+        Closes any connections kept open for later downloads.
+        """
+
+        self.connections.close()
+
+    def _semaphore(self, url, limit):
+        # sources with different limits for the same host each get their
+        # own semaphore, so that one source's limit doesn't cap the others.
+        key = (urlparse.urlparse(url).netloc, limit)
+        with self.lock:
+            sem = self.semaphores.get(key)
+            if sem is None:
+                sem = threading.BoundedSemaphore(limit)
+                self.semaphores[key] = sem
+            return sem
+
+    def download(self, d, store):
+        """
+        Download a source file from the internet and store it in the given
+        store.
+        """
+
+        logger = logging.getLogger('download')
+
+        in_opts = d.options()
+        options = download.options(in_opts).copy()
+        options['verifier'] = d.verifier()
+        options['connections'] = self.connections
+        limit = in_opts.get('num_download_threads') or self.host_limit
+
+        # each connection to the server holds one of its slots while it is in
+        # use, and there's no point splitting a file into more segments than
+        # could be fetched at once.
+        options['host_slot'] = lambda u: self._semaphore(u, limit)
+        options['segments'] = min(options['segments'], limit)
+
+        with ExitStack() as stack:
+            tmps = [stack.enter_context(download.get(url, options))
+                    for url in d.urls()]
+
+            try:
+                d.unpack(store, *tmps)
+
+            except Exception as e:
+                logger.error(repr(e))
+                raise RuntimeError("Failed to download %r: %s" %
+                                   (d.output_file(),
+                                    "".join(traceback.format_exception(
+                                        *sys.exc_info()))))
+
+        assert store.exists(d.output_file())
+
+    def run(self, downloads, store, skip_existing=False):
+        """
+        Runs all of `downloads`, raising an error if any of them failed. A
+        failure doesn't stop the other downloads, which are all run to
+        completion first.
+
+        If `skip_existing` is set, then downloads whose output is already in
+        `store` aren't run again, e.g: when retrying a batch which partly
+        failed before.
+        """
+
+        if os.getpid() != self.pid:
+            self._reset()
+
+        logger = logging.getLogger('download')
+
+        if skip_existing:
+            missing = [d for d in downloads
+                       if not store.exists(d.output_file())]
+            if len(missing) < len(downloads):
+                logger.info("Skipping %d of %d downloads which are already "
+                            "in the store." % (len(downloads) - len(missing),
+                                               len(downloads)))
+            downloads = missing
+
+        if len(downloads) <= 1 or self.num_threads < 2:
+            for d in downloads:
+                self.download(d, store)
+            return
+
+        num_threads = min(self.num_threads, len(downloads))
+
+        with ThreadPoolExecutor(num_threads) as executor:
+            futures = [(d, executor.submit(self.download, d, store))
+                       for d in downloads]
+
+            failed = []
+            for d, fut in futures:
+                e = fut.exception()
+                if e is not None:
+                    logger.warning("Download of %r failed: %s"
+                                   % (d.output_file(), str(e)))
+                    failed.append(d.output_file())
+
+        if failed:
+            raise RuntimeError("Failed to download %d of %d files: %r"
+                               % (len(failed), len(downloads), failed))
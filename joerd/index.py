@@ -1,27 +1,388 @@
-import pyqtree
+import joerd.mercator as mercator
+from collections import OrderedDict
+import numpy
 import yaml
 import logging
-import thread
+import tempfile
+import time
+import os
+import os.path
+
+
+# Suffixes of the compiled versions of a YAML index file. The compiled index
+# is a pair of numpy arrays; the bounding boxes of each object as an (N, 4)
+# array of float64 and the names of each object as an array of fixed-length
+# strings. Both can be memory-mapped, so loading them needs no YAML parsing
+# and very little I/O.
+_BBOX_SUFFIX = '.bbox.npy'
+_NAMES_SUFFIX = '.names.npy'
+# suffix of the compiled version of a plain list of names, with no bounding
+# boxes.
+_LIST_SUFFIX = '.list.npy'
+# maximum number of elements in the (tiles x objects) mask built when
+# intersecting many bounding boxes at once.
+_MAX_MASK_SIZE = 1 << 22
+# suffix of the file recording when an index was last checked against the
+# upstream listing it was made from, and the validators (e.g: ETag) needed
+# to check it again cheaply.
+_VALIDATORS_SUFFIX = '.validators.yaml'
+
+
+def _is_fresh(compiled_file, index_file):
+    """
+    Returns True if the compiled file exists and is at least as new as the
+    index file it was made from.
+    """
+
+    if not os.path.isfile(compiled_file):
+        return False
+
+    if not os.path.isfile(index_file):
+        return True
+
+    return os.path.getmtime(compiled_file) >= os.path.getmtime(index_file)
+
+
+def _save(filename, arr):
+    # write to a temporary file and rename it into place, so that other
+    # processes reading the index never see a partially-written file.
+    d = os.path.dirname(os.path.abspath(filename))
+    with tempfile.NamedTemporaryFile(dir=d, delete=False) as tmp:
+        numpy.save(tmp, arr)
+    os.rename(tmp.name, filename)
+
+
+def _write_yaml(filename, obj):
+    # as for _save, the file is renamed into place.
+    d = os.path.dirname(os.path.abspath(filename))
+    with tempfile.NamedTemporaryFile(dir=d, delete=False) as tmp:
+        tmp.write(yaml.dump(obj))
+    os.rename(tmp.name, filename)
+
+
+def _names_array(names):
+    if not names:
+        return numpy.zeros(0, dtype='S1')
+    return numpy.array(names, dtype='S%d' % max(len(n) for n in names))
+
+
+def names(index_file):
+    """
+    Returns the list of strings in the YAML file `index_file`, from its
+    compiled version if that's up to date.
+    """
+
+    names_file = index_file + _LIST_SUFFIX
+
+    if _is_fresh(names_file, index_file):
+        return [str(n) for n in numpy.load(names_file, mmap_mode='r')]
+
+    with open(index_file, 'r') as f:
+        result = yaml.load(f) or []
+
+    _save(names_file, _names_array(result))
+    return result
+
+
+def compile_index(index_file, parse_fn, *parse_args):
+    """
+    Compiles the YAML file `index_file`, consisting of a list of strings, into
+    the binary index format, using `parse_fn` to find the bounding box of each
+    string. Strings for which `parse_fn` returns None are left out.
+    """
+
+    with open(index_file, 'r') as f:
+        files = yaml.load(f) or []
+
+    bboxes = []
+    valid = []
+    for f in files:
+        t = parse_fn(f, *parse_args)
+        if t:
+            bboxes.append(t.bbox.bounds)
+            valid.append(f)
+
+    bbox_arr = numpy.array(bboxes, dtype=numpy.float64).reshape((-1, 4))
+    _save(index_file + _BBOX_SUFFIX, bbox_arr)
+    _save(index_file + _NAMES_SUFFIX, _names_array(valid))
+
+
+def validators(index_file):
+    """
+    Returns the dict of validators saved for `index_file`, or an empty dict
+    if there aren't any.
+    """
+
+    validators_file = index_file + _VALIDATORS_SUFFIX
+    if not os.path.isfile(validators_file):
+        return {}
+
+    with open(validators_file, 'r') as f:
+        return yaml.load(f) or {}
+
+
+def save_validators(index_file, validators):
+    """
+    Saves the `validators` for `index_file`, recording that it has just been
+    checked against its upstream listing.
+    """
+
+    validators = dict(validators, checked=time.time())
+    _write_yaml(index_file + _VALIDATORS_SUFFIX, validators)
+
+
+def is_stale(index_file, max_age):
+    """
+    Returns True if `index_file` doesn't exist, or hasn't been checked
+    against its upstream listing in the last `max_age` seconds.
+    """
+
+    if not os.path.isfile(index_file):
+        return True
+
+    checked = validators(index_file).get('checked')
+    if checked is None:
+        checked = os.path.getmtime(index_file)
+    return time.time() > checked + max_age
+
+
+def update(index_file, new_names, parse_fn=None, *parse_args):
+    """
+    Replaces the list of strings in the YAML file `index_file` with
+    `new_names`, returning the number of strings added and removed.
+
+    A compiled spatial index which is up to date is updated in place rather
+    than being left to be re-compiled from scratch: only the added strings
+    are parsed, with `parse_fn`, and the removed ones are dropped. Nothing is
+    written if the list hasn't changed.
+    """
+
+    bbox_file = index_file + _BBOX_SUFFIX
+    names_file = index_file + _NAMES_SUFFIX
+    list_file = index_file + _LIST_SUFFIX
+
+    compiled = parse_fn is not None and \
+        _is_fresh(bbox_file, index_file) and \
+        _is_fresh(names_file, index_file)
+    listed = _is_fresh(list_file, index_file)
+
+    if listed:
+        old_names = [str(n) for n in numpy.load(list_file, mmap_mode='r')]
+    elif os.path.isfile(index_file):
+        with open(index_file, 'r') as f:
+            old_names = yaml.load(f) or []
+    else:
+        old_names = []
+        compiled = False
+
+    old_set = set(old_names)
+    new_set = set(new_names)
+    added = [n for n in new_names if n not in old_set]
+    removed = old_set - new_set
+    if not added and not removed and os.path.isfile(index_file):
+        return 0, 0
+
+    # the compiled files must be written after the YAML, so that they're at
+    # least as new as it.
+    _write_yaml(index_file, list(new_names))
+
+    if compiled:
+        bboxes = numpy.load(bbox_file)
+        valid = [str(n) for n in numpy.load(names_file)]
+        keep = [i for i, n in enumerate(valid) if n not in removed]
+
+        added_bboxes = []
+        added_valid = []
+        for n in added:
+            t = parse_fn(n, *parse_args)
+            if t:
+                added_bboxes.append(t.bbox.bounds)
+                added_valid.append(n)
+
+        added_arr = numpy.array(added_bboxes, dtype=numpy.float64)
+        bbox_arr = numpy.concatenate(
+            (bboxes[keep].reshape((-1, 4)), added_arr.reshape((-1, 4))))
+        _save(bbox_file, bbox_arr)
+        _save(names_file,
+              _names_array([valid[i] for i in keep] + added_valid))
+
+    # the plain list is always kept, as it's the quickest way to find the
+    # differences next time.
+    _save(list_file, _names_array(list(new_names)))
+
+    return len(added), len(removed)
+
+
+class Index(object):
+    """
+    A spatial index over the compiled arrays of bounding boxes and names. It
+    is queried with a vectorised bounding box test over all the objects,
+    which is fast enough for the tens of thousands of objects in a source
+    index, and needs no tree to be built at load time.
+
+    Objects are made from the names by calling `parse_fn` when they're first
+    returned from a query, and kept for subsequent queries. Subsets of the
+    index share the same objects.
+    """
+
+    def __init__(self, bboxes, names, parse_fn, parse_args, objects=None):
+        self.bboxes = bboxes
+        self.names = names
+        self.parse_fn = parse_fn
+        self.parse_args = parse_args
+        self.objects = objects if objects is not None else {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def _object(self, i):
+        name = str(self.names[i])
+        obj = self.objects.get(name)
+        if obj is None:
+            obj = self.parse_fn(name, *self.parse_args)
+            self.objects[name] = obj
+        return obj
+
+    def _mask(self, bbox):
+        # same (inclusive) test as BoundingBox.intersects.
+        b = self.bboxes
+        return (b[:, 0] <= bbox[2]) & (b[:, 1] <= bbox[3]) & \
+               (b[:, 2] >= bbox[0]) & (b[:, 3] >= bbox[1])
+
+    def intersect(self, bbox):
+        return [self._object(i) for i in numpy.flatnonzero(self._mask(bbox))]
+
+    def intersect_many(self, bboxes):
+        """
+        Returns a list of the objects intersecting each row of `bboxes`, an
+        (M, 4) array of bounding boxes.
+        """
+
+        if len(self) == 0:
+            return [[] for bbox in bboxes]
+
+        result = []
+        # test a chunk of bounding boxes against all the objects at once,
+        # keeping the size of the mask bounded.
+        b = self.bboxes
+        chunk = max(1, _MAX_MASK_SIZE // len(self))
+        for start in xrange(0, len(bboxes), chunk):
+            q = bboxes[start:start+chunk, numpy.newaxis, :]
+            mask = (b[:, 0] <= q[:, :, 2]) & (b[:, 1] <= q[:, :, 3]) & \
+                   (b[:, 2] >= q[:, :, 0]) & (b[:, 3] >= q[:, :, 1])
+            objs = [[] for row in mask]
+            for row, i in zip(*numpy.nonzero(mask)):
+                objs[row].append(self._object(i))
+            result.extend(objs)
+
+        return result
+
+    def subset(self, bbox):
+        """
+        Returns a smaller index containing only the objects which intersect
+        `bbox`.
+        """
+
+        sel = numpy.flatnonzero(self._mask(bbox))
+        return Index(self.bboxes[sel], self.names[sel], self.parse_fn,
+                     self.parse_args, self.objects)
+
+
+class TileIntersector(object):
+    """
+    Finds the objects in an index which intersect each of a list of tiles,
+    buffered by `buffer` degrees.
+
+    Neighbouring tiles very often intersect the same few objects, so the
+    subset of the index covering each tile's ancestor at `parent_zoom` is
+    memoised, and the tile is only tested against that. Up to `max_parents`
+    subsets are kept, least recently used first out. Tiles which aren't
+    Mercator tiles, or are at or above `parent_zoom`, are tested against the
+    whole index.
+    """
+
+    def __init__(self, idx, buffer, parent_zoom=12, max_parents=4096):
+        self.idx = idx
+        self.buffer = buffer
+        self.parent_zoom = parent_zoom
+        self.max_parents = max_parents
+        self.parents = OrderedDict()
+        self.mercator = mercator.Mercator()
+
+    def _parent(self, tile):
+        if not isinstance(tile, mercator.MercatorTile) or \
+           tile.z <= self.parent_zoom:
+            return None
+
+        shift = tile.z - self.parent_zoom
+        return (self.parent_zoom, tile.x >> shift, tile.y >> shift)
+
+    def _subset(self, parent):
+        sub = self.parents.pop(parent, None)
+
+        if sub is None:
+            # every child of the parent is inside the parent's bounding box,
+            # so buffering it by the same amount gives a superset of the
+            # objects which intersect any of them.
+            bbox = self.mercator.latlon_bbox(*parent).buffer(self.buffer)
+            sub = self.idx.subset(bbox.bounds)
+
+            while len(self.parents) >= self.max_parents:
+                self.parents.popitem(last=False)
+
+        self.parents[parent] = sub
+        return sub
+
+    def intersections(self, tiles):
+        """
+        Returns a list of the objects intersecting each of `tiles`.
+        """
+
+        bboxes = numpy.array([t.latlon_bbox().bounds for t in tiles],
+                             dtype=numpy.float64).reshape((-1, 4))
+        bboxes[:, 0:2] -= self.buffer
+        bboxes[:, 2:4] += self.buffer
+
+        groups = OrderedDict()
+        for i, t in enumerate(tiles):
+            groups.setdefault(self._parent(t), []).append(i)
+
+        result = [None] * len(tiles)
+        for parent, idxs in groups.iteritems():
+            sub = self.idx if parent is None else self._subset(parent)
+            for i, objs in zip(idxs, sub.intersect_many(bboxes[idxs])):
+                result[i] = objs
+
+        return result
 
 
 # Create an index given a YAML file consisting of a list of strings and a
 # function to parse it. Extra, fixed arguments for the function can be also
 # be given. Each object returned from the `parse_fn` should have a member
 # called `bbox` which is a `joerd.util.BoundingBox` instance.
+#
+# The YAML is compiled into a binary index alongside it the first time it is
+# used, and the compiled version is used from then on until the YAML file
+# changes. The `bbox` of the whole index is not needed, and is kept only for
+# compatibility.
 def create(index_file, bbox, parse_fn, *parse_args):
     logger = logging.getLogger("index")
-    idx = pyqtree.Index(bbox=bbox)
-    n = 0
 
-    with open(index_file, 'r') as f:
-        files = yaml.load(f)
-        for f in files:
-            t = parse_fn(f, *parse_args)
-            if t:
-                idx.insert(bbox=t.bbox.bounds, item=t)
-                n += 1
+    bbox_file = index_file + _BBOX_SUFFIX
+    names_file = index_file + _NAMES_SUFFIX
+    if not _is_fresh(bbox_file, index_file) or \
+       not _is_fresh(names_file, index_file):
+        logger.info("Compiling index %r." % index_file)
+        compile_index(index_file, parse_fn, *parse_args)
+
+    bboxes = numpy.load(bbox_file, mmap_mode='r')
+    names = numpy.load(names_file, mmap_mode='r')
+    assert len(bboxes) == len(names), "Compiled index %r is corrupt: %d " \
+        "bounding boxes, but %d names." % (index_file, len(bboxes),
+                                           len(names))
 
-    logger.info("Created index with %d objects." % n)
+    idx = Index(bboxes, names, parse_fn, parse_args)
+    logger.info("Created index with %d objects." % len(idx))
     return idx
 
 
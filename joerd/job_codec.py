@@ -0,0 +1,151 @@
+import base64
+import json
+import zlib
+
+
+# Compact encoding for render batches, which can hold many more tiles in a
+# single message than the plain JSON encoding.
+#
+# Batches are generated from contiguous regions, so the tiles in a batch
+# usually cover a few rectangles. The tiles are grouped by all their fields
+# other than x and y (e.g: output type and zoom), and the x, y coordinates
+# of each group are stored as a list of rectangles, delta-encoded against
+# the previous rectangle. The VRT paths of the sources are stored once each
+# in a table, and referred to by index. The whole thing is JSON encoded,
+# compressed and base64 encoded so that it can be sent as text.
+
+PACKED_JOB_TYPE = 'packedrenderbatch'
+_VERSION = 1
+
+
+def _rectangles(coords):
+    """
+    Returns a list of (x, y, w, h) rectangles exactly covering the set of
+    (x, y) coordinates in `coords`.
+    """
+
+    columns = {}
+    for x, y in coords:
+        columns.setdefault(x, []).append(y)
+
+    # find the runs of consecutive y in each column, and merge runs which
+    # are the same in consecutive columns into rectangles.
+    rects = []
+    open_rects = {}
+    for x in sorted(columns):
+        ys = sorted(columns[x])
+        runs = []
+        start = prev = ys[0]
+        for y in ys[1:]:
+            if y != prev + 1:
+                runs.append((start, prev - start + 1))
+                start = y
+            prev = y
+        runs.append((start, prev - start + 1))
+
+        still_open = {}
+        for run in runs:
+            rect = open_rects.get(run)
+            if rect is not None and rect[0] + rect[2] == x:
+                rect[2] += 1
+            else:
+                rect = [x, run[0], 1, run[1]]
+                rects.append(rect)
+            still_open[run] = rect
+        open_rects = still_open
+
+    rects.sort()
+    return rects
+
+
+def _pack_rectangles(rects):
+    packed = []
+    px = py = 0
+    for x, y, w, h in rects:
+        packed.extend((x - px, y - py, w, h))
+        px, py = x, y
+    return packed
+
+
+def _unpack_rectangles(packed):
+    px = py = 0
+    for i in xrange(0, len(packed), 4):
+        dx, dy, w, h = packed[i:i+4]
+        px += dx
+        py += dy
+        for x in xrange(px, px + w):
+            for y in xrange(py, py + h):
+                yield x, y
+
+
+def encode_render_batch(sources, data):
+    """
+    Encodes a render batch of the tiles described by the list `data`, all
+    of which use `sources`, as a packed job. Each datum must have `x` and `y`
+    members. Duplicate tiles are only encoded once, and the order of the
+    tiles is not kept.
+    """
+
+    paths = []
+    path_index = {}
+    packed_sources = []
+    for s in sources:
+        vrts = []
+        for vrt in s['vrts']:
+            idxs = []
+            for path in vrt:
+                idx = path_index.get(path)
+                if idx is None:
+                    idx = len(paths)
+                    paths.append(path)
+                    path_index[path] = idx
+                idxs.append(idx)
+            vrts.append(idxs)
+        packed_sources.append([s['source'], vrts])
+
+    groups = {}
+    for datum in data:
+        key = tuple(sorted((k, v) for k, v in datum.iteritems()
+                           if k not in ('x', 'y')))
+        groups.setdefault(key, set()).add((datum['x'], datum['y']))
+
+    tiles = []
+    for key in sorted(groups):
+        rects = _rectangles(groups[key])
+        tiles.append([dict(key), _pack_rectangles(rects)])
+
+    body = dict(v=_VERSION, paths=paths, sources=packed_sources, tiles=tiles)
+    payload = base64.b64encode(zlib.compress(
+        json.dumps(body, separators=(',', ':')), 9))
+
+    return dict(job=PACKED_JOB_TYPE, payload=payload)
+
+
+def decode_render_batch(job):
+    """
+    Decodes a packed job made by `encode_render_batch` back into a plain
+    render batch job.
+    """
+
+    assert job.get('job') == PACKED_JOB_TYPE, "Unable to decode job of " \
+        "type %r as a packed render batch." % job.get('job')
+
+    body = json.loads(zlib.decompress(base64.b64decode(job['payload'])))
+    assert body.get('v') == _VERSION, "Unknown packed render batch version " \
+        "%r." % body.get('v')
+
+    paths = body['paths']
+    sources = []
+    for name, vrts in body['sources']:
+        sources.append(dict(source=name,
+                            vrts=[[paths[i] for i in vrt] for vrt in vrts]))
+
+    data = []
+    for fields, packed in body['tiles']:
+        for x, y in _unpack_rectangles(packed):
+            datum = dict(fields)
+            datum['x'] = x
+            datum['y'] = y
+            data.append(datum)
+
+    return dict(job='renderbatch', sources=sources, data=data)
@@ -0,0 +1,124 @@
+from joerd.tmpdir import tmpdir
+from joerd.mkdir_p import mkdir_p
+import hashlib
+import logging
+import json
+import time
+import os.path
+
+
+# Manifests of rendered tiles, which allow re-runs to render only the tiles
+# whose inputs have changed.
+#
+# When a render batch has finished and all its tiles have been uploaded, the
+# server puts a manifest for it in the output store, under the manifest
+# prefix. The manifest lists the tiles in the batch and a hash of the batch's
+# inputs: the source files it was rendered from, and the configured render
+# version, and the time it was written. The hash is also part of the
+# manifest's name.
+#
+# Before enqueueing renders, the enqueuer lists and loads all the manifests,
+# keeping only the newest inputs hash for each tile, as that is the one which
+# the stored tile was rendered from. It then leaves out any tile whose newest
+# hash is the same as the tile would have now. Bumping the render version
+# makes every tile's hash change, and so re-renders everything.
+
+
+def inputs_hash(sources, version):
+    """
+    Returns a hash of the source files in `sources`, the list of sources of a
+    render job, and the render `version`.
+    """
+
+    # the hash must be the same in the enqueuer and the server, which sees the
+    # sources after they've been through the queue, so only the source names
+    # and paths are used, in a form with no dicts to be re-ordered.
+    canonical = [[s['source'], s['vrts']] for s in sources]
+    h = hashlib.sha1()
+    h.update(json.dumps([version, canonical], separators=(',', ':')))
+    return h.hexdigest()
+
+
+def tile_key(datum):
+    """
+    Returns a string uniquely identifying the tile described by `datum`, the
+    frozen version of a tile from a render job.
+    """
+
+    return json.dumps(datum, sort_keys=True, separators=(',', ':'))
+
+
+def write(store, prefix, sources, data, version):
+    """
+    Puts a manifest in `store` recording that the tiles described by `data`
+    have been rendered from `sources`.
+    """
+
+    h = inputs_hash(sources, version)
+    keys = sorted(tile_key(datum) for datum in data)
+    body = json.dumps(dict(inputs=h, tiles=keys, written=time.time()),
+                      separators=(',', ':'))
+    name = "%s/%s/%s.json" % (prefix, h, hashlib.sha1(body).hexdigest())
+
+    with tmpdir() as d:
+        path = os.path.join(d, name)
+        mkdir_p(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            fh.write(body)
+        store.upload_all(d)
+
+
+class Manifest(object):
+    """
+    The tiles which have been rendered, each with the hash of the inputs of
+    its most recent render and the time that was written.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.tiles = {}
+
+    def add(self, h, keys, written):
+        for key in keys:
+            old = self.tiles.get(key)
+            if old is None or old[0] <= written:
+                self.tiles[key] = (written, h)
+
+    def is_current(self, job):
+        """
+        Returns True if the tile in the render job `job` was last rendered
+        from the same inputs as it would be now.
+        """
+
+        latest = self.tiles.get(tile_key(job['data']))
+        return latest is not None and \
+            latest[1] == inputs_hash(job['sources'], self.version)
+
+
+def load(store, prefix, version):
+    """
+    Loads all the manifests under `prefix` in `store`.
+    """
+
+    logger = logging.getLogger('manifest')
+    manifest = Manifest(version)
+    count = 0
+
+    with tmpdir() as d:
+        tmp = os.path.join(d, 'manifest.json')
+        for name in store.list_files(prefix + '/'):
+            if not name.endswith('.json'):
+                continue
+
+            store.get(name, tmp)
+            with open(tmp, 'r') as fh:
+                body = json.load(fh)
+            # manifests from before the time was recorded are older than
+            # any which have it.
+            manifest.add(body['inputs'], body['tiles'],
+                         body.get('written', 0))
+            count += 1
+
+    logger.info("Loaded %d manifests for %d distinct tiles."
+                % (count, len(manifest.tiles)))
+    return manifest
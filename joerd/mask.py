@@ -1,6 +1,160 @@
 from osgeo import gdal
+from joerd.tmpdir import tmpdir
 import numpy
 import numpy.ma
+import os.path
+
+
+# The functions in this module process rasters a window at a time, rather
+# than copying the whole raster into memory, as some sources are large
+# enough (e.g: 14400x9600 pixels for a GMTED tile) that several copies of
+# them would use a lot of memory. Each window is a whole number of the
+# source's natural blocks, so that reading it doesn't decode any block more
+# than once, and is no more than _WINDOW_PIXELS pixels, unless a single
+# block is larger than that.
+_WINDOW_PIXELS = 1 << 22
+
+# drivers which can only CreateCopy another dataset (e.g: SRTMHGT) need the
+# whole processed raster to copy from. rasters up to this many pixels, which
+# includes a 3601x3601 SRTM tile, are staged in memory, and larger ones in a
+# temporary file on disk.
+_MEM_STAGE_PIXELS = 1 << 24
+
+
+def _windows(band, max_pixels=None):
+    """
+    Yields (x, y, width, height) windows covering all of `band`, aligned to
+    its natural block size.
+    """
+
+    if max_pixels is None:
+        max_pixels = _WINDOW_PIXELS
+
+    x_size = band.XSize
+    y_size = band.YSize
+    block_x, block_y = band.GetBlockSize()
+    block_x = min(max(1, block_x), x_size)
+    block_y = min(max(1, block_y), y_size)
+
+    win_x = min(x_size, max(block_x,
+                            (max_pixels // block_y) // block_x * block_x))
+    win_y = min(y_size, max(block_y,
+                            (max_pixels // win_x) // block_y * block_y))
+
+    for y in xrange(0, y_size, win_y):
+        for x in xrange(0, x_size, win_x):
+            yield (x, y, min(win_x, x_size - x), min(win_y, y_size - y))
+
+
+def _create_like(drv, filename, src_ds):
+    """
+    Creates an empty dataset with `drv` which has the same size, bands,
+    georeferencing and metadata as `src_ds`. For each band, this includes
+    its metadata, nodata value, scale, offset and unit type, as
+    `CreateCopy` would copy them.
+    """
+
+    src_band = src_ds.GetRasterBand(1)
+    dst_ds = drv.Create(filename, src_ds.RasterXSize, src_ds.RasterYSize,
+                        src_ds.RasterCount, src_band.DataType)
+    assert dst_ds is not None, "Unable to create %r" % filename
+
+    dst_ds.SetGeoTransform(src_ds.GetGeoTransform())
+    dst_ds.SetProjection(src_ds.GetProjection())
+    dst_ds.SetMetadata(src_ds.GetMetadata())
+
+    for i in xrange(1, src_ds.RasterCount + 1):
+        src_band = src_ds.GetRasterBand(i)
+        dst_band = dst_ds.GetRasterBand(i)
+
+        dst_band.SetMetadata(src_band.GetMetadata())
+        dst_band.SetUnitType(src_band.GetUnitType())
+
+        nodata = src_band.GetNoDataValue()
+        if nodata is not None:
+            dst_band.SetNoDataValue(nodata)
+        scale = src_band.GetScale()
+        if scale is not None:
+            dst_band.SetScale(scale)
+        offset = src_band.GetOffset()
+        if offset is not None:
+            dst_band.SetOffset(offset)
+
+    return dst_ds
+
+
+def _copy_windows(src_ds, dst_ds, fn):
+    """
+    Copies the data in `src_ds` to `dst_ds` a window at a time, passing each
+    window of the first band through `fn(data, window)`. Other bands are
+    copied as-is.
+    """
+
+    for i in xrange(1, src_ds.RasterCount + 1):
+        src_band = src_ds.GetRasterBand(i)
+        dst_band = dst_ds.GetRasterBand(i)
+
+        for window in _windows(src_band):
+            x, y, w, h = window
+            data = src_band.ReadAsArray(x, y, w, h)
+            if i == 1:
+                data = fn(data, window)
+            res = dst_band.WriteArray(data, x, y)
+            assert res == gdal.CPLE_None
+
+
+def _process(src_ds, dst_driver, dst_filename, fn):
+    """
+    Writes a copy of `src_ds` to `dst_filename` using `dst_driver`, with the
+    first band processed a window at a time by `fn`.
+    """
+
+    drv = gdal.GetDriverByName(dst_driver)
+
+    if drv.GetMetadataItem(gdal.DCAP_CREATE) == 'YES':
+        dst_ds = _create_like(drv, dst_filename, src_ds)
+        _copy_windows(src_ds, dst_ds, fn)
+        del dst_ds
+
+    elif src_ds.RasterXSize * src_ds.RasterYSize <= _MEM_STAGE_PIXELS:
+        # some drivers (e.g: SRTMHGT) can only write copies of another
+        # dataset, so small rasters are staged in memory.
+        mem_drv = gdal.GetDriverByName("MEM")
+        mem_ds = _create_like(mem_drv, '', src_ds)
+        _copy_windows(src_ds, mem_ds, fn)
+
+        dst_ds = drv.CreateCopy(dst_filename, mem_ds)
+        del dst_ds
+        del mem_ds
+
+    else:
+        # otherwise, the windows are written to a temporary file on disk,
+        # which is then copied.
+        with tmpdir() as d:
+            tmp_drv = gdal.GetDriverByName("GTiff")
+            tmp_ds = _create_like(tmp_drv, os.path.join(d, 'tmp.tif'),
+                                  src_ds)
+            _copy_windows(src_ds, tmp_ds, fn)
+
+            dst_ds = drv.CreateCopy(dst_filename, tmp_ds)
+            del dst_ds
+            del tmp_ds
+
+
+def _mask_with(msk_data_fn, mask_value, nodata):
+    """
+    Returns a function for `_process` which masks each window to `nodata`
+    wherever the mask data for the window, from `msk_data_fn(window)`, is
+    `mask_value`.
+    """
+
+    def _fn(data, window):
+        mask = (msk_data_fn(window) == mask_value)
+        mx = numpy.ma.masked_array(data, mask=mask)
+        return numpy.ma.filled(mx, nodata)
+
+    return _fn
+
 
 def negative(src_filename, dst_driver, dst_filename):
     """
@@ -10,25 +164,15 @@ def negative(src_filename, dst_driver, dst_filename):
     """
 
     src_ds = gdal.Open(src_filename)
-    mem_drv = gdal.GetDriverByName("MEM")
-    ds = mem_drv.CreateCopy('', src_ds)
-    x_size = ds.RasterXSize
-    y_size = ds.RasterYSize
-
-    band = ds.GetRasterBand(1)
-    nodata = band.GetNoDataValue()
+    nodata = src_ds.GetRasterBand(1).GetNoDataValue()
 
-    data = band.ReadAsArray(0, 0, x_size, y_size)
-    mask = (data <= 0) | (data == nodata)
-    mx = numpy.ma.masked_array(data, mask=mask)
-    res = band.WriteArray(numpy.ma.filled(mx, nodata))
-    assert res == gdal.CPLE_None
+    def _fn(data, window):
+        mask = (data <= 0) | (data == nodata)
+        mx = numpy.ma.masked_array(data, mask=mask)
+        return numpy.ma.filled(mx, nodata)
 
-    drv = gdal.GetDriverByName(dst_driver)
-    dst_ds = drv.CreateCopy(dst_filename, ds)
+    _process(src_ds, dst_driver, dst_filename, _fn)
 
-    del dst_ds
-    del ds
     del src_ds
 
 
@@ -39,35 +183,25 @@ def raster(src_filename, msk_filename, mask_value, dst_driver, dst_filename):
     requires both to be the same size, location and in the same projection.
     """
 
-    orig_ds = gdal.Open(src_filename)
-    mem_drv = gdal.GetDriverByName("MEM")
-    src_ds = mem_drv.CreateCopy('', orig_ds)
+    src_ds = gdal.Open(src_filename)
     msk_ds = gdal.Open(msk_filename)
 
-    x_size = src_ds.RasterXSize
-    y_size = src_ds.RasterYSize
-    assert x_size == msk_ds.RasterXSize
-    assert y_size == msk_ds.RasterYSize
+    assert src_ds.RasterXSize == msk_ds.RasterXSize
+    assert src_ds.RasterYSize == msk_ds.RasterYSize
     assert src_ds.GetProjection() == msk_ds.GetProjection()
     assert src_ds.GetGeoTransform() == msk_ds.GetGeoTransform()
 
-    src_band = src_ds.GetRasterBand(1)
-    src_nodata = src_band.GetNoDataValue()
+    src_nodata = src_ds.GetRasterBand(1).GetNoDataValue()
+    msk_band = msk_ds.GetRasterBand(1)
 
-    src_data = src_band.ReadAsArray(0, 0, x_size, y_size)
-    msk_data = msk_ds.GetRasterBand(1).ReadAsArray(0, 0, x_size, y_size)
-    mask = (msk_data == mask_value)
-    mx = numpy.ma.masked_array(src_data, mask=mask)
-    res = src_band.WriteArray(numpy.ma.filled(mx, src_nodata))
-    assert res == gdal.CPLE_None
+    def _msk_data(window):
+        return msk_band.ReadAsArray(*window)
 
-    drv = gdal.GetDriverByName(dst_driver)
-    dst_ds = drv.CreateCopy(dst_filename, src_ds)
+    _process(src_ds, dst_driver, dst_filename,
+             _mask_with(_msk_data, mask_value, src_nodata))
 
-    del dst_ds
     del msk_ds
     del src_ds
-    del orig_ds
 
 
 def raw(src_filename, raw_filename, raw_value, dst_driver, dst_filename):
@@ -77,33 +211,43 @@ def raw(src_filename, raw_filename, raw_value, dst_driver, dst_filename):
     requires both to be the same size, location and in the same projection.
     """
 
-    orig_ds = gdal.Open(src_filename)
-    mem_drv = gdal.GetDriverByName("MEM")
-    src_ds = mem_drv.CreateCopy('', orig_ds)
+    # the raw file is memory-mapped, so only the parts of it covering each
+    # window are read.
+    data = numpy.memmap(raw_filename, dtype=numpy.uint8, mode='r')
+    _raw_array(src_filename, data, raw_value, dst_driver, dst_filename)
+    del data
+
+
+def raw_data(src_filename, data, raw_value, dst_driver, dst_filename):
+    """
+    As `raw`, but with the contents of the raw file given as the string
+    `data`, e.g: when it has been read straight out of an archive.
+    """
+
+    _raw_array(src_filename, numpy.frombuffer(data, dtype=numpy.uint8),
+               raw_value, dst_driver, dst_filename)
+
+
+def _raw_array(src_filename, data, raw_value, dst_driver, dst_filename):
+    src_ds = gdal.Open(src_filename)
 
     x_size = src_ds.RasterXSize
     y_size = src_ds.RasterYSize
 
-    raw_data = numpy.reshape(numpy.fromfile(raw_filename, dtype=numpy.uint8),
-                             (y_size, x_size), order='C')
-    assert x_size == raw_data.shape[1]
-    assert y_size == raw_data.shape[0]
+    msk_data = numpy.reshape(data, (y_size, x_size), order='C')
+    assert x_size == msk_data.shape[1]
+    assert y_size == msk_data.shape[0]
 
-    src_band = src_ds.GetRasterBand(1)
-    src_nodata = src_band.GetNoDataValue()
+    src_nodata = src_ds.GetRasterBand(1).GetNoDataValue()
 
-    src_data = src_band.ReadAsArray(0, 0, x_size, y_size)
-    mask = (raw_data == raw_value)
-    mx = numpy.ma.masked_array(src_data, mask=mask)
-    res = src_band.WriteArray(numpy.ma.filled(mx, src_nodata))
-    assert res == gdal.CPLE_None
+    def _msk_data(window):
+        x, y, w, h = window
+        return msk_data[y:y+h, x:x+w]
 
-    drv = gdal.GetDriverByName(dst_driver)
-    dst_ds = drv.CreateCopy(dst_filename, src_ds)
+    _process(src_ds, dst_driver, dst_filename,
+             _mask_with(_msk_data, raw_value, src_nodata))
 
-    del dst_ds
     del src_ds
-    del orig_ds
 
 
 def datum_shift(src_filename, dst_driver, dst_filename, shift):
@@ -113,22 +257,12 @@ def datum_shift(src_filename, dst_driver, dst_filename, shift):
     """
 
     src_ds = gdal.Open(src_filename)
-    mem_drv = gdal.GetDriverByName("MEM")
-    ds = mem_drv.CreateCopy('', src_ds)
-    x_size = ds.RasterXSize
-    y_size = ds.RasterYSize
+    nodata = src_ds.GetRasterBand(1).GetNoDataValue()
 
-    band = ds.GetRasterBand(1)
-    nodata = band.GetNoDataValue()
+    def _fn(data, window):
+        data[data != nodata] += shift
+        return data
 
-    data = band.ReadAsArray(0, 0, x_size, y_size)
-    data[data != nodata] += shift
-    res = band.WriteArray(data)
-    assert res == gdal.CPLE_None
-
-    drv = gdal.GetDriverByName(dst_driver)
-    dst_ds = drv.CreateCopy(dst_filename, ds)
+    _process(src_ds, dst_driver, dst_filename, _fn)
 
-    del dst_ds
-    del ds
     del src_ds
@@ -2,6 +2,7 @@ from joerd.util import BoundingBox
 import joerd.composite as composite
 from contextlib2 import contextmanager
 from osgeo import osr, gdal
+import numpy
 import math
 
 
@@ -15,29 +16,16 @@ FLT_NODATA = -3.0e38
 
 MERCATOR_WORLD_SIZE = 40075016.68
 
+# radius of the sphere used by spherical mercator (EPSG:3857), and the
+# largest latitude that it can represent.
+EARTH_RADIUS = 6378137.0
+MAX_LATITUDE = 85.051129
+
 
 def _tile_name(z, x, y):
     return '%d/%d/%d' % (z, x, y)
 
 
-def _tx_bbox(tx, bbox, expand=0.0):
-    xs = []
-    ys = []
-    for i in range(0,4):
-        ix = float(bbox[i & 2])
-        iy = float(bbox[(i & 1) * 2 + 1])
-        x, y, z = tx.TransformPoint(ix, iy)
-        xs.append(x)
-        ys.append(y)
-    bbox = (min(xs), min(ys), max(xs), max(ys))
-    xspan = bbox[2] - bbox[0]
-    yspan = bbox[3] - bbox[1]
-    return (bbox[0] - 0.5 * expand * xspan,
-            bbox[1] - 0.5 * expand * yspan,
-            bbox[2] + 0.5 * expand * xspan,
-            bbox[3] + 0.5 * expand * yspan)
-
-
 def _merc_bbox(z, x, y):
     extent = float(1 << z)
     return BoundingBox(
@@ -47,7 +35,110 @@ def _merc_bbox(z, x, y):
         MERCATOR_WORLD_SIZE * (0.5 - y / extent))
 
 
+def mercator_bboxes(z, x, y):
+    """
+    Returns an (N, 4) array of the Mercator bounding boxes (left, bottom,
+    right, top) of the tiles at `z`, `x`, `y`, which can be scalars or arrays
+    and are broadcast against each other.
+    """
+
+    z, x, y = numpy.broadcast_arrays(numpy.atleast_1d(z), x, y)
+    extent = numpy.left_shift(1, z.astype(numpy.int64)).astype(numpy.float64)
+    return numpy.column_stack((
+        MERCATOR_WORLD_SIZE * (x / extent - 0.5),
+        MERCATOR_WORLD_SIZE * (0.5 - (y + 1) / extent),
+        MERCATOR_WORLD_SIZE * ((x + 1) / extent - 0.5),
+        MERCATOR_WORLD_SIZE * (0.5 - y / extent)))
+
+
+def mercator_to_lonlat(mx, my):
+    """
+    Converts arrays of Mercator coordinates to arrays of longitude and
+    latitude in degrees.
+    """
+
+    lon = numpy.degrees(numpy.asarray(mx, dtype=numpy.float64) / EARTH_RADIUS)
+    lat = numpy.degrees(numpy.arctan(numpy.sinh(
+        numpy.asarray(my, dtype=numpy.float64) / EARTH_RADIUS)))
+    return lon, lat
+
+
+def lonlat_to_mercator(lon, lat):
+    """
+    Converts arrays of longitude and latitude in degrees to arrays of
+    Mercator coordinates. Latitudes are clipped to the range which Mercator
+    can represent.
+    """
+
+    lat = numpy.clip(lat, -MAX_LATITUDE, MAX_LATITUDE)
+    mx = EARTH_RADIUS * numpy.radians(lon)
+    my = EARTH_RADIUS * numpy.log(numpy.tan(0.25 * math.pi +
+                                            0.5 * numpy.radians(lat)))
+    return mx, my
+
+
+def latlon_bboxes(z, x, y):
+    """
+    Returns an (N, 4) array of the lat/lon bounding boxes (left, bottom,
+    right, top) of the tiles at `z`, `x`, `y`, which can be scalars or arrays
+    and are broadcast against each other.
+    """
+
+    merc = mercator_bboxes(z, x, y)
+    lon, lat = mercator_to_lonlat(merc[:, 0::2], merc[:, 1::2])
+    return numpy.column_stack((lon[:, 0], lat[:, 0], lon[:, 1], lat[:, 1]))
+
+
+def lonlat_to_tiles(zoom, lon, lat):
+    """
+    Returns arrays of the x and y coordinates of the tiles at `zoom`
+    containing each of the points given by arrays of `lon` and `lat`. The
+    results are clipped to the tiles which exist at that zoom.
+    """
+
+    mx, my = lonlat_to_mercator(lon, lat)
+
+    extent = 1 << zoom
+    tx = numpy.floor(extent * ((mx / MERCATOR_WORLD_SIZE) + 0.5))
+    ty = numpy.floor(extent * (0.5 - (my / MERCATOR_WORLD_SIZE)))
+
+    # and clip the result to lie in the allowable domain 0 <= coord < extent
+    tx = numpy.clip(tx, 0, extent - 1).astype(numpy.int64)
+    ty = numpy.clip(ty, 0, extent - 1).astype(numpy.int64)
+
+    return tx, ty
+
+
+def tile_range(zoom, lx, ly, ux, uy):
+    """
+    Yields (x, y, latlon_bbox, mercator_bbox) for each tile at `zoom` with
+    lx <= x <= ux and ly <= y <= uy, in column order.
+
+    The bounding boxes are calculated for all the columns and rows at once,
+    as longitude only depends on x and latitude only on y.
+    """
+
+    xs = numpy.arange(lx, ux + 1)
+    ys = numpy.arange(ly, uy + 1)
+    col_merc = mercator_bboxes(zoom, xs, 0).tolist()
+    row_merc = mercator_bboxes(zoom, 0, ys).tolist()
+    col_ll = latlon_bboxes(zoom, xs, 0).tolist()
+    row_ll = latlon_bboxes(zoom, 0, ys).tolist()
+
+    for x, cm, cl in zip(xs.tolist(), col_merc, col_ll):
+        for y, rm, rl in zip(ys.tolist(), row_merc, row_ll):
+            yield (x, y, BoundingBox(cl[0], rl[1], cl[2], rl[3]),
+                   BoundingBox(cm[0], rm[1], cm[2], rm[3]))
+
+
 class MercatorTile(object):
+    # number of extra pixels around the edge of the tile which are needed to
+    # render it, e.g: for image filters.
+    margin = 0
+    # the pyramid of heights (see joerd.pyramid) to build this tile from and
+    # save its heights into, if any.
+    pyramid = None
+
     def __init__(self, z, x, y, size, ll_bbox, merc_bbox):
         self.z = z
         self.x = x
@@ -55,6 +146,7 @@ class MercatorTile(object):
         self.size = size
         self._latlon_bbox = ll_bbox
         self._mercator_bbox = merc_bbox
+        self.metatile = None
 
     def set_sources(self, sources):
         self.sources = sources
@@ -70,6 +162,19 @@ class MercatorTile(object):
     def tile_name(self):
         return _tile_name(self.z, self.x, self.y)
 
+    def _compose(self, dst_ds, logger, dst_res):
+        # if this tile is part of a metatile which has already been rendered,
+        # then just cut the data out of that. otherwise build it from the
+        # level above in the pyramid, or composite it from the sources.
+        if self.metatile is not None and self.metatile.extract(dst_ds):
+            pass
+        elif self.pyramid is None or \
+             not self.pyramid.downsample(dst_ds, logger):
+            composite.compose(self, dst_ds, logger, dst_res)
+
+        if self.pyramid is not None:
+            self.pyramid.save(dst_ds, logger)
+
     @contextmanager
     def get_datasource(self, logger):
         bbox = self._mercator_bbox
@@ -98,7 +203,7 @@ class MercatorTile(object):
         ll_x_res = float(ll_bbox.bounds[2] - ll_bbox.bounds[0]) / dst_x_size
         ll_y_res = float(ll_bbox.bounds[3] - ll_bbox.bounds[1]) / dst_y_size
 
-        composite.compose(self, dst_ds, logger, min(ll_x_res, ll_y_res))
+        self._compose(dst_ds, logger, min(ll_x_res, ll_y_res))
 
         try:
             yield dst_ds
@@ -107,45 +212,178 @@ class MercatorTile(object):
             del dst_ds
 
 
+class Metatile(object):
+    """
+    An area covering several Mercator tiles at the same resolution, which is
+    composited from the sources once and then cut up into the individual
+    tiles. This saves a reprojection, VRT and nodata fill per tile, which is
+    most of the cost of rendering a high zoom tile.
+
+    The area is given as a bounding box in "world pixel" coordinates, where
+    the world is `world_px` pixels wide and high and (0, 0) is the top left.
+    """
+
+    def __init__(self, world_px, px_bbox, tiles):
+        self.world_px = world_px
+        self.px_bbox = px_bbox
+        self.tiles = tiles
+        self.sources = tiles[0].sources
+        self.res = MERCATOR_WORLD_SIZE / world_px
+        self.gt = (self.res * px_bbox[0] - 0.5 * MERCATOR_WORLD_SIZE, self.res,
+                   0, 0.5 * MERCATOR_WORLD_SIZE - self.res * px_bbox[1], 0,
+                   -self.res)
+        self.ds = None
+
+    def latlon_bbox(self):
+        bboxes = [t.latlon_bbox().bounds for t in self.tiles]
+        return BoundingBox(min(b[0] for b in bboxes),
+                           min(b[1] for b in bboxes),
+                           max(b[2] for b in bboxes),
+                           max(b[3] for b in bboxes))
+
+    def max_resolution(self):
+        return max(t.max_resolution() for t in self.tiles)
+
+    @contextmanager
+    def render(self, logger):
+        x_size = self.px_bbox[2] - self.px_bbox[0]
+        y_size = self.px_bbox[3] - self.px_bbox[1]
+
+        dst_srs = osr.SpatialReference()
+        dst_srs.ImportFromEPSG(3857)
+
+        dst_drv = gdal.GetDriverByName("MEM")
+        dst_ds = dst_drv.Create('', x_size, y_size, 1, gdal.GDT_Float32)
+        dst_ds.SetGeoTransform(self.gt)
+        dst_ds.SetProjection(dst_srs.ExportToWkt())
+        dst_ds.GetRasterBand(1).SetNoDataValue(FLT_NODATA)
+
+        ll_bbox = self.latlon_bbox()
+        ll_x_res = float(ll_bbox.bounds[2] - ll_bbox.bounds[0]) / x_size
+        ll_y_res = float(ll_bbox.bounds[3] - ll_bbox.bounds[1]) / y_size
+
+        logger.debug("Rendering %dx%d metatile for %d tiles."
+                     % (x_size, y_size, len(self.tiles)))
+        composite.compose(self, dst_ds, logger, min(ll_x_res, ll_y_res))
+
+        self.ds = dst_ds
+        for t in self.tiles:
+            t.metatile = self
+
+        try:
+            yield self
+
+        finally:
+            for t in self.tiles:
+                t.metatile = None
+            self.ds = None
+            del dst_ds
+
+    def extract(self, dst_ds):
+        """
+        Copies the area of the metatile covered by dst_ds into it. Returns
+        False, and leaves dst_ds alone, if the metatile doesn't completely
+        cover dst_ds at the same resolution.
+        """
+
+        if self.ds is None:
+            return False
+
+        dst_gt = dst_ds.GetGeoTransform()
+        if abs(dst_gt[1] - self.res) > 1.0e-6 * self.res or \
+           abs(-dst_gt[5] - self.res) > 1.0e-6 * self.res:
+            return False
+
+        x_off = int(round((dst_gt[0] - self.gt[0]) / self.res))
+        y_off = int(round((self.gt[3] - dst_gt[3]) / self.res))
+        x_size = dst_ds.RasterXSize
+        y_size = dst_ds.RasterYSize
+
+        if x_off < 0 or y_off < 0 or \
+           x_off + x_size > self.ds.RasterXSize or \
+           y_off + y_size > self.ds.RasterYSize:
+            return False
+
+        data = self.ds.GetRasterBand(1).ReadAsArray(
+            x_off, y_off, x_size, y_size)
+        res = dst_ds.GetRasterBand(1).WriteArray(data)
+        assert res == gdal.CPLE_None
+
+        return True
+
+
+def metatiles(tiles, metatile_size):
+    """
+    Groups the Mercator tiles in `tiles` into metatiles. Tiles at the same
+    resolution (e.g: a 512px tile at zoom z and a 256px tile at z+1) are
+    grouped into blocks of `metatile_size` 256px tiles on a side, and each
+    metatile covers the tiles in its block, plus any margin they need.
+
+    Returns a tuple of the list of metatiles, and a list of all the tiles
+    which weren't grouped into a metatile. If `metatile_size` is less than 1,
+    then no tiles are grouped.
+    """
+
+    if metatile_size < 1:
+        return [], list(tiles)
+
+    block_px = 256 * metatile_size
+    groups = {}
+    others = []
+
+    for t in tiles:
+        if not isinstance(t, MercatorTile):
+            others.append(t)
+            continue
+
+        world_px = t.size << t.z
+        px = t.x * t.size
+        py = t.y * t.size
+        key = (world_px, px // block_px, py // block_px)
+        groups.setdefault(key, []).append(t)
+
+    result = []
+    for (world_px, bx, by), group in groups.iteritems():
+        bbox = [world_px, world_px, 0, 0]
+        for t in group:
+            bbox[0] = min(bbox[0], t.x * t.size - t.margin)
+            bbox[1] = min(bbox[1], t.y * t.size - t.margin)
+            bbox[2] = max(bbox[2], (t.x + 1) * t.size + t.margin)
+            bbox[3] = max(bbox[3], (t.y + 1) * t.size + t.margin)
+
+        # clip to the edges of the world, as the tiles do when rendering.
+        bbox = (max(0, bbox[0]), max(0, bbox[1]),
+                min(world_px, bbox[2]), min(world_px, bbox[3]))
+
+        result.append(Metatile(world_px, bbox, group))
+
+    return result, others
+
+
 class Mercator(object):
-    def __init__(self):
-        self._setup_transforms()
-
-    def _setup_transforms(self):
-        # cache these transforms, as they are mildly expensive to create and
-        # are used a lot when intersecting mercator tiles against latlon
-        # sources.
-        self.merc_srs = osr.SpatialReference()
-        self.merc_srs.ImportFromEPSG(3857)
-        self.latlon_srs = osr.SpatialReference()
-        self.latlon_srs.ImportFromEPSG(4326)
-
-        self.tx = osr.CoordinateTransformation(self.merc_srs, self.latlon_srs)
-        self.tx_inv = osr.CoordinateTransformation(self.latlon_srs,
-                                                   self.merc_srs)
-
-    # The spatial reference and transform objects are handles to C objects
-    # and can't be serialized. However, this object is stateless, and an
-    # identical copy can be recreated from scratch without parameters. So
-    # that's what happens in __setstate__.
-    def __getstate__(self):
-        return {}
-
-    def __setstate__(self, d):
-        self.__dict__.update(d)
-        self._setup_transforms()
+    """
+    Conversions between tile coordinates, lat/lon and Mercator for single
+    tiles, using the closed-form spherical Mercator formulas. These are the
+    same as the module-level functions which work on arrays of tiles, but
+    without the overhead of numpy for a single value.
+    """
 
     def latlon_bbox(self, z, x, y):
-        merc = _merc_bbox(z, x, y)
-
-        return BoundingBox(*_tx_bbox(self.tx, merc.bounds))
+        merc = _merc_bbox(z, x, y).bounds
+        return BoundingBox(
+            math.degrees(merc[0] / EARTH_RADIUS),
+            math.degrees(math.atan(math.sinh(merc[1] / EARTH_RADIUS))),
+            math.degrees(merc[2] / EARTH_RADIUS),
+            math.degrees(math.atan(math.sinh(merc[3] / EARTH_RADIUS))))
 
     def lonlat_to_xy(self, zoom, lon, lat):
         # clip lat to +/- 85.051129 because that's all that spherical mercator
-        # can support. otherwise we get "tolerance condition error".
-        lat = min(max(lat, -85.051129), 85.051129)
+        # can support.
+        lat = min(max(float(lat), -MAX_LATITUDE), MAX_LATITUDE)
 
-        x, y, z = self.tx_inv.TransformPoint(float(lon), float(lat))
+        x = EARTH_RADIUS * math.radians(float(lon))
+        y = EARTH_RADIUS * math.log(math.tan(0.25 * math.pi +
+                                             0.5 * math.radians(lat)))
 
         extent = 1 << zoom
         tx = int(math.floor(extent * ((x / MERCATOR_WORLD_SIZE) + 0.5)))
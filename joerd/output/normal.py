@@ -54,12 +54,39 @@ def _height_mapping_func(h):
     return 255 - bisect.bisect_left(HEIGHT_TABLE, h)
 
 
+# Precomputed lookup table of `_height_mapping_func` for every integer height
+# covered by the table, so that the mapping can be done for a whole image at
+# once. Because the entries of HEIGHT_TABLE are all integers, the number of
+# entries less than `h` is the same as the number less than `ceil(h)`, so the
+# lookup is exact for non-integer heights too.
+HEIGHT_LUT_MIN = HEIGHT_TABLE[0]
+HEIGHT_LUT_MAX = HEIGHT_TABLE[-1] + 1
+HEIGHT_LUT = (255 - numpy.searchsorted(
+    numpy.array(HEIGHT_TABLE),
+    numpy.arange(HEIGHT_LUT_MIN, HEIGHT_LUT_MAX + 1),
+    side='left')).astype(numpy.uint8)
+
+
+# Vectorised version of `_height_mapping_func`, which returns a uint8 array of
+# the same shape as `pixels` containing the flipped table indices.
+def _height_mapping(pixels):
+    h = numpy.ceil(pixels)
+    numpy.clip(h, HEIGHT_LUT_MIN, HEIGHT_LUT_MAX, out=h)
+    return HEIGHT_LUT.take(h.astype(numpy.intp) - HEIGHT_LUT_MIN, mode='clip')
+
+
 class NormalTile(mercator.MercatorTile):
-    def __init__(self, parent, z, x, y):
-        super(NormalTile, self).__init__(
-            z, x, y, 256,
-            parent.mercator.latlon_bbox(z, x, y),
-            parent.mercator.mercator_bbox(z, x, y))
+    # extra "bleed" around the tile for the gradient filter.
+    margin = 10
+
+    def __init__(self, parent, z, x, y, ll_bbox=None, merc_bbox=None):
+        # the bounding boxes can be passed in if they've already been
+        # calculated, e.g: when generating many tiles at once.
+        if ll_bbox is None:
+            ll_bbox = parent.mercator.latlon_bbox(z, x, y)
+        if merc_bbox is None:
+            merc_bbox = parent.mercator.mercator_bbox(z, x, y)
+        super(NormalTile, self).__init__(z, x, y, 256, ll_bbox, merc_bbox)
         self.output_dir = parent.output_dir
 
     def freeze_dry(self):
@@ -79,7 +106,7 @@ class NormalTile(mercator.MercatorTile):
                                  tile + ".png")
         logger.debug("Generating tile %r..." % tile)
 
-        filter_size = 10
+        filter_size = self.margin
 
         outfile = tile_file
         dst_bbox = bbox.bounds
@@ -156,7 +183,7 @@ class NormalTile(mercator.MercatorTile):
                          geod.Inverse(ll_mid_y - ll_spc_y, ll_mid_x,
                                       ll_mid_y + ll_spc_y, ll_mid_x)['s12']
 
-        composite.compose(self, mid_ds, logger, min(ll_x_res, ll_y_res))
+        self._compose(mid_ds, logger, min(ll_x_res, ll_y_res))
 
         pixels = mid_ds.GetRasterBand(1).ReadAsArray(0, 0, mid_x_size, mid_y_size)
         ygrad, xgrad = numpy.gradient(pixels, 2)
@@ -193,8 +220,7 @@ class NormalTile(mercator.MercatorTile):
         dst_ds.SetProjection(dst_srs.ExportToWkt())
 
         # apply the height mapping function to get the table index.
-        func = numpy.vectorize(_height_mapping_func)
-        hyps = func(pixels).astype(numpy.uint8)
+        hyps = _height_mapping(pixels)
 
         # extract the area without the "bleed" margin.
         ext = img[filter_top_margin:(filter_top_margin+dst_y_size), \
@@ -248,20 +274,27 @@ class Normal:
 
         return tiles
 
-    def generate_tiles(self):
+    def generate_tiles(self, zooms=None):
+        """
+        Yields the tiles in all the regions, or only those at `zooms` if it
+        is given.
+        """
+
         logger = logging.getLogger('normal')
 
         for r in self.regions:
             rbox = r.bbox.bounds
             for zoom in range(*r.zoom_range):
+                if zooms is not None and zoom not in zooms:
+                    continue
+
                 lx, ly = self.mercator.lonlat_to_xy(zoom, rbox[0], rbox[3])
                 ux, uy = self.mercator.lonlat_to_xy(zoom, rbox[2], rbox[1])
 
                 logger.info("Generating %d tiles for region." % ((ux - lx + 1) * (uy - ly + 1),))
-                for x in range(lx, ux + 1):
-                    for y in range(ly, uy + 1):
-                        bbox = self.latlon_bbox(zoom, x, y)
-                        yield NormalTile(self, zoom, x, y)
+                for x, y, ll_bbox, merc_bbox in mercator.tile_range(
+                        zoom, lx, ly, ux, uy):
+                    yield NormalTile(self, zoom, x, y, ll_bbox, merc_bbox)
 
     def latlon_bbox(self, z, x, y):
         return self.mercator.latlon_bbox(z, x, y)
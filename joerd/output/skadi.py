@@ -140,12 +140,6 @@ class Skadi:
         self.sources = sources
         self.output_dir = options.get('output_dir', 'tiles')
 
-    def _intersects(self, bbox):
-        for r in self.regions:
-            if r.intersects(bbox, SKADI_NOMINAL_ZOOM):
-                return True
-        return False
-
     def expand_tile(self, bbox, zoom_range):
         tiles = []
 
@@ -167,16 +161,33 @@ class Skadi:
 
     def generate_tiles(self):
         logger = logging.getLogger('skadi')
-        tiles = []
+        # tiles already generated for an earlier, overlapping, region. there
+        # are only 360x180 Skadi tiles, so this is bounded.
+        seen = set()
 
-        for x in range(0, 360):
-            for y in range(0, 180):
-                bbox = _bbox(x, y)
-                if self._intersects(bbox):
-                    tiles.append(SkadiTile(self.output_dir, x, y))
-
-        logger.info("Generated %d tile jobs." % len(tiles))
-        return tiles
+        for r in self.regions:
+            if not r.intersects(r.bbox, SKADI_NOMINAL_ZOOM):
+                continue
+
+            # only the tiles near the region's bbox need to be checked, with
+            # a margin of one tile to be sure of getting all the tiles which
+            # touch it.
+            rbox = r.bbox.bounds
+            xmin = max(0, int(math.floor(rbox[0])) + 179)
+            xmax = min(359, int(math.ceil(rbox[2])) + 180)
+            ymin = max(0, int(math.floor(rbox[1])) + 89)
+            ymax = min(179, int(math.ceil(rbox[3])) + 90)
+
+            for x in range(xmin, xmax + 1):
+                for y in range(ymin, ymax + 1):
+                    if (x, y) in seen or not r.intersects(_bbox(x, y),
+                                                          SKADI_NOMINAL_ZOOM):
+                        continue
+
+                    seen.add((x, y))
+                    yield SkadiTile(self.output_dir, x, y)
+
+        logger.info("Generated %d tile jobs." % len(seen))
 
     def rehydrate(self, data):
         typ = data.get('type')
@@ -18,11 +18,14 @@ import numpy
 
 
 class TerrariumTile(mercator.MercatorTile):
-    def __init__(self, parent, z, x, y):
-        super(TerrariumTile, self).__init__(
-            z, x, y, 256,
-            parent.mercator.latlon_bbox(z, x, y),
-            parent.mercator.mercator_bbox(z, x, y))
+    def __init__(self, parent, z, x, y, ll_bbox=None, merc_bbox=None):
+        # the bounding boxes can be passed in if they've already been
+        # calculated, e.g: when generating many tiles at once.
+        if ll_bbox is None:
+            ll_bbox = parent.mercator.latlon_bbox(z, x, y)
+        if merc_bbox is None:
+            merc_bbox = parent.mercator.mercator_bbox(z, x, y)
+        super(TerrariumTile, self).__init__(z, x, y, 256, ll_bbox, merc_bbox)
         self.output_dir = parent.output_dir
 
     def freeze_dry(self):
@@ -117,19 +120,27 @@ class Terrarium:
 
         return tiles
 
-    def generate_tiles(self):
+    def generate_tiles(self, zooms=None):
+        """
+        Yields the tiles in all the regions, or only those at `zooms` if it
+        is given.
+        """
+
         logger = logging.getLogger('terrarium')
 
         for r in self.regions:
             rbox = r.bbox.bounds
             for zoom in range(*r.zoom_range):
+                if zooms is not None and zoom not in zooms:
+                    continue
+
                 lx, ly = self.mercator.lonlat_to_xy(zoom, rbox[0], rbox[3])
                 ux, uy = self.mercator.lonlat_to_xy(zoom, rbox[2], rbox[1])
 
                 logger.info("Generating %d tiles for region." % ((ux - lx + 1) * (uy - ly + 1),))
-                for x in range(lx, ux + 1):
-                    for y in range(ly, uy + 1):
-                        yield TerrariumTile(self, zoom, x, y)
+                for x, y, ll_bbox, merc_bbox in mercator.tile_range(
+                        zoom, lx, ly, ux, uy):
+                    yield TerrariumTile(self, zoom, x, y, ll_bbox, merc_bbox)
 
     def rehydrate(self, data):
         typ = data.get('type')
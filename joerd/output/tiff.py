@@ -18,11 +18,14 @@ import numpy
 
 
 class TiffTile(mercator.MercatorTile):
-    def __init__(self, parent, z, x, y):
-        super(TiffTile, self).__init__(
-            z, x, y, 512,
-            parent.mercator.latlon_bbox(z, x, y),
-            parent.mercator.mercator_bbox(z, x, y))
+    def __init__(self, parent, z, x, y, ll_bbox=None, merc_bbox=None):
+        # the bounding boxes can be passed in if they've already been
+        # calculated, e.g: when generating many tiles at once.
+        if ll_bbox is None:
+            ll_bbox = parent.mercator.latlon_bbox(z, x, y)
+        if merc_bbox is None:
+            merc_bbox = parent.mercator.mercator_bbox(z, x, y)
+        super(TiffTile, self).__init__(z, x, y, 512, ll_bbox, merc_bbox)
         self.output_dir = parent.output_dir
 
     def freeze_dry(self):
@@ -105,7 +108,12 @@ class Tiff:
 
         return tiles
 
-    def generate_tiles(self):
+    def generate_tiles(self, zooms=None):
+        """
+        Yields the tiles in all the regions, or only those at `zooms` if it
+        is given.
+        """
+
         logger = logging.getLogger('tiff')
 
         # so here's where this whole thing with zooms breaks down: the tiles
@@ -118,13 +126,16 @@ class Tiff:
             rbox = r.bbox.bounds
             for zoom in range(max(0, r.zoom_range[0] - 1),
                               max(0, r.zoom_range[1] - 1)):
+                if zooms is not None and zoom not in zooms:
+                    continue
+
                 lx, ly = self.mercator.lonlat_to_xy(zoom, rbox[0], rbox[3])
                 ux, uy = self.mercator.lonlat_to_xy(zoom, rbox[2], rbox[1])
 
                 logger.info("Generating %d tiles for region." % ((ux - lx + 1) * (uy - ly + 1),))
-                for x in range(lx, ux + 1):
-                    for y in range(ly, uy + 1):
-                        yield TiffTile(self, zoom, x, y)
+                for x, y, ll_bbox, merc_bbox in mercator.tile_range(
+                        zoom, lx, ly, ux, uy):
+                    yield TiffTile(self, zoom, x, y, ll_bbox, merc_bbox)
 
     def rehydrate(self, data):
         typ = data.get('type')
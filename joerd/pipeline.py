@@ -0,0 +1,127 @@
+from contextlib2 import contextmanager
+import joerd.tmpdir as tmpdir
+import threading
+import tempfile
+import shutil
+import logging
+import Queue
+import sys
+
+
+class SyncRenderer(object):
+    """
+    Renders each tile into a temporary directory and uploads it to the store
+    before returning.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def render(self, t):
+        with tmpdir.tmpdir() as d:
+            t.render(d)
+            self.store.upload_all(d)
+
+    def close(self):
+        pass
+
+
+class UploadPipeline(object):
+    """
+    Renders tiles on the calling thread and uploads them to the store on a
+    background thread, so that the next tile can be rendering while the last
+    one is uploading.
+
+    Rendered tiles wait in a queue of at most `queue_size` directories for
+    upload. If uploading falls behind, then `render` blocks until there is
+    space in the queue. If an upload fails, then the error is raised from the
+    next call to `render` or from `close`.
+    """
+
+    def __init__(self, store, queue_size):
+        self.store = store
+        self.queue = Queue.Queue(queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._upload_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _upload_loop(self):
+        logger = logging.getLogger('process')
+
+        while True:
+            d = self.queue.get()
+            if d is None:
+                break
+
+            try:
+                if self.error is None:
+                    self.store.upload_all(d)
+
+            except Exception:
+                logger.warning("Upload of %r failed." % d)
+                self.error = sys.exc_info()
+
+            finally:
+                shutil.rmtree(d, ignore_errors=True)
+
+    def _raise_error(self):
+        if self.error is not None:
+            exc_type, exc_value, exc_tb = self.error
+            raise exc_type, exc_value, exc_tb
+
+    def render(self, t):
+        self._raise_error()
+
+        d = tempfile.mkdtemp()
+        try:
+            t.render(d)
+
+        except:
+            shutil.rmtree(d, ignore_errors=True)
+            raise
+
+        # this blocks if the queue is full, which stops rendering from
+        # getting too far ahead of uploading.
+        self.queue.put(d)
+
+    def close(self):
+        """
+        Waits for all the queued uploads to finish, raising an error if any of
+        them failed.
+        """
+
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+
+
+@contextmanager
+def renderer(store, queue_size):
+    """
+    Returns an object with a `render(tile)` method which renders the tile and
+    uploads the output to the store. If `queue_size` is greater than zero,
+    then uploads are done in the background. In either case, all uploads have
+    finished when the context exits.
+    """
+
+    if queue_size > 0:
+        r = UploadPipeline(store, queue_size)
+    else:
+        r = SyncRenderer(store)
+
+    try:
+        yield r
+
+    except:
+        # make sure the upload thread is stopped, but don't let any upload
+        # error hide the original exception.
+        exc_info = sys.exc_info()
+        try:
+            r.close()
+        except Exception:
+            pass
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    else:
+        r.close()
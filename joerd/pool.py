@@ -0,0 +1,190 @@
+import multiprocessing
+import logging
+import traceback
+import sys
+
+
+def run_jobs(server, jobs, logger):
+    """
+    Runs all the jobs from a single message on the server, returning True if
+    they all completed successfully.
+
+    Jobs which cannot be processed due to an error are logged, and the rest of
+    the message is abandoned.
+    """
+
+    for job in jobs:
+        try:
+            server.dispatch_job(job)
+
+        except StandardError as e:
+            logger.warning("During processing of job %r, caught "
+                           "exception. This job failed, continuing "
+                           "to the next. Exception details: %s" %
+                           (job, "".join(traceback.format_exception(
+                               *sys.exc_info()))))
+            return False
+
+    return True
+
+
+def _worker_main(server, jobs, results, results_lock):
+    """
+    Main loop of a worker process. Takes (message id, jobs) pairs from its
+    own `jobs` queue, runs them and reports whether they succeeded on the
+    `results` pipe. The pipe is written synchronously, unlike a
+    multiprocessing queue, so the result isn't lost if the worker crashes
+    straight afterwards.
+    """
+
+    logger = logging.getLogger('process')
+
+    try:
+        while True:
+            item = jobs.get()
+            if item is None:
+                break
+
+            msg_id, body = item
+            ok = run_jobs(server, body, logger)
+            with results_lock:
+                results.send((msg_id, ok))
+
+    finally:
+        # forked processes don't run atexit handlers, so anything the
+        # server holds on disk must be cleaned up here.
+        server.close()
+
+
+class WorkerPool(object):
+    """
+    A supervised pool of worker processes sharing a single Server.
+
+    The server is created once in the parent and inherited by each forked
+    worker, so the configuration and any indexes already loaded don't have to
+    be rebuilt in every process. The parent process receives messages from
+    the queue, keeping up to `prefetch` of them in flight so that workers
+    don't wait on the queue, and deletes each one once a worker has
+    successfully run it.
+
+    Each message is handed to a particular worker, on its own jobs queue, so
+    the parent always knows which messages a worker holds. If a worker dies,
+    it is restarted with a new jobs queue and all the messages handed to it
+    which haven't completed, including any it hadn't started, are released
+    so that the queue will make them visible again to be retried.
+    """
+
+    def __init__(self, server, queue, num_workers, prefetch=None):
+        self.server = server
+        self.queue = queue
+        self.num_workers = num_workers
+        self.prefetch = prefetch or 2 * num_workers
+
+        # the number of messages handed out is limited by checking the size
+        # of in_flight, so the jobs queues don't need their own limit.
+        self.jobs = [None] * num_workers
+        self.results, self.results_writer = multiprocessing.Pipe(False)
+        self.results_lock = multiprocessing.Lock()
+        self.workers = [None] * num_workers
+
+        # messages which have been handed to the workers, by id, as
+        # (message, worker index) pairs.
+        self.in_flight = {}
+        self.next_msg_id = 0
+
+    def _start_worker(self, idx):
+        # a restarted worker gets a fresh queue, as anything left on the old
+        # one has already been released.
+        old_jobs = self.jobs[idx]
+        if old_jobs is not None:
+            old_jobs.cancel_join_thread()
+            old_jobs.close()
+
+        self.jobs[idx] = multiprocessing.Queue()
+        p = multiprocessing.Process(
+            target=_worker_main,
+            args=(self.server, self.jobs[idx], self.results_writer,
+                  self.results_lock))
+        p.daemon = True
+        p.start()
+        self.workers[idx] = p
+
+    def _check_workers(self, logger):
+        for idx, p in enumerate(self.workers):
+            if p is not None and p.is_alive():
+                continue
+
+            if p is not None:
+                logger.warning("Worker %d (pid %r) exited with code %r, "
+                               "restarting." % (idx, p.pid, p.exitcode))
+                self.server.cleanup_worker(p.pid)
+                # abandon the messages the worker was processing or had yet
+                # to start. they will become visible on the queue again
+                # after their visibility timeout.
+                for msg_id, (message, worker) in self.in_flight.items():
+                    if worker == idx:
+                        del self.in_flight[msg_id]
+                        message.release()
+
+            self._start_worker(idx)
+
+    def _handle_results(self, logger, timeout):
+        # only wait for the first result, then drain anything else which is
+        # ready.
+        while self.results.poll(timeout):
+            timeout = 0
+            msg_id, ok = self.results.recv()
+
+            item = self.in_flight.pop(msg_id, None)
+
+            if item is None:
+                continue
+
+            message = item[0]
+
+            # remove the message from the queue - this indicates that it has
+            # completed successfully and it won't be retried. otherwise, let
+            # it become visible again so that it's retried.
+            if ok:
+                message.delete()
+            else:
+                message.release()
+
+    def _least_loaded(self):
+        counts = [0] * self.num_workers
+        for message, idx in self.in_flight.itervalues():
+            counts[idx] += 1
+        return counts.index(min(counts))
+
+    def _fill(self):
+        received = 0
+
+        for message in self.queue.receive_messages():
+            msg_id = self.next_msg_id
+            self.next_msg_id += 1
+            idx = self._least_loaded()
+            self.in_flight[msg_id] = (message, idx)
+            self.jobs[idx].put((msg_id, message.body))
+            received += 1
+
+        return received
+
+    def run(self):
+        """
+        Runs the pool in an infinite loop.
+        """
+
+        logger = logging.getLogger('process')
+
+        while True:
+            self._check_workers(logger)
+            self._handle_results(logger, 0)
+
+            received = 0
+            if len(self.in_flight) < self.prefetch:
+                received = self._fill()
+
+            # if there's nothing new to hand out, then wait a little while
+            # for the workers to make progress.
+            if received == 0:
+                self._handle_results(logger, 1)
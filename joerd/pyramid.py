@@ -0,0 +1,222 @@
+from joerd.tmpdir import tmpdir
+from joerd.mkdir_p import mkdir_p
+import joerd.mercator as mercator
+from osgeo import gdal
+import logging
+import numpy
+import math
+import os.path
+
+
+# A pyramid of rendered heights, used to build low zoom tiles by downsampling
+# the zoom above instead of reprojecting large areas of the sources.
+#
+# Heights are kept in a store as 256px square float32 cells, on the same grid
+# as 256px Mercator tiles, so that the cell at "level" L, x, y covers the same
+# area as the 256px tile at zoom L, x, y. Tiles of other sizes are on the
+# level with the same resolution, e.g: a 512px tile at zoom z covers 4 cells
+# at level z+1.
+#
+# Whenever a tile at level max_zoom+1 or below is rendered, the heights it
+# covers are saved. A tile at level max_zoom or below is then built from the
+# 2x2 average of the cells at the level above it, if they have all been
+# saved. Otherwise, it is rendered from the sources as normal.
+#
+# The cells are kept under the render version, so that changing it, e.g: to
+# re-render after a change to the rendering, doesn't build tiles from the
+# heights rendered before. Changed source files don't need this, as the tiles
+# which cover them are re-rendered highest zoom first, and so save over the
+# cells they cover before the level below needs them.
+
+CELL_SIZE = 256
+
+
+def tile_level(tile):
+    """
+    Returns the pyramid level of `tile`, or None if it isn't a Mercator tile.
+    """
+
+    if not isinstance(tile, mercator.MercatorTile):
+        return None
+
+    return tile.z + int(round(math.log(tile.size / float(CELL_SIZE), 2)))
+
+
+def bottom_up(generate, max_zoom):
+    """
+    Yields the tiles from `generate()`, in order, except that those at levels
+    which can be built from the pyramid are left until the end, and then
+    yielded in order of decreasing level, so that each level's heights have
+    had a chance to be rendered before the level below needs them.
+
+    Rather than holding those tiles back, each level is generated again
+    afterwards by calling `generate(zooms)`, which should yield only the
+    tiles at the given zooms. There are few tiles at these levels, so this
+    costs much less than the first pass.
+    """
+
+    # the zooms of the tiles at each pyramid level, as tiles of different
+    # sizes at the same zoom are on different levels.
+    levels = {}
+    for t in generate():
+        level = tile_level(t)
+        if level is not None and level <= max_zoom:
+            levels.setdefault(level, set()).add(t.z)
+        else:
+            yield t
+
+    for level in sorted(levels.keys(), reverse=True):
+        for t in generate(levels[level]):
+            if tile_level(t) == level:
+                yield t
+
+
+def _downsample(data):
+    """
+    Returns the 2x2 average of `data`, ignoring nodata pixels. An output pixel
+    is nodata only if all four of its input pixels are.
+    """
+
+    h, w = data.shape
+    blocks = data.reshape((h // 2, 2, w // 2, 2))
+    valid = blocks != mercator.FLT_NODATA
+
+    count = valid.sum(axis=(1, 3))
+    total = numpy.where(valid, blocks, 0).sum(axis=(1, 3), dtype=numpy.float64)
+
+    result = numpy.full(count.shape, mercator.FLT_NODATA, numpy.float32)
+    has_data = count > 0
+    result[has_data] = total[has_data] / count[has_data]
+    return result
+
+
+class Pyramid(object):
+
+    def __init__(self, store, max_zoom, prefix='heights', version=1):
+        self.store = store
+        self.max_zoom = max_zoom
+        self.prefix = prefix
+        self.version = version
+
+    def covers(self, tile):
+        """
+        Returns True if `tile` can be built from the pyramid.
+        """
+
+        level = tile_level(tile)
+        return level is not None and level <= self.max_zoom
+
+    def _cell_name(self, level, x, y):
+        return "%s/v%s/%d/%d/%d.npy" % (self.prefix, self.version, level, x, y)
+
+    def _grid(self, dst_ds):
+        """
+        Returns the pyramid level of `dst_ds`, and its pixel bounding box at
+        that level, or None if it isn't aligned to a level.
+        """
+
+        gt = dst_ds.GetGeoTransform()
+        res = gt[1]
+        if abs(-gt[5] - res) > 1.0e-6 * res:
+            return None
+
+        level_f = math.log(mercator.MERCATOR_WORLD_SIZE /
+                           (CELL_SIZE * res), 2)
+        level = int(round(level_f))
+        if abs(level_f - level) > 1.0e-6:
+            return None
+
+        # the resolution is an exact fraction of the world size, so
+        # re-calculate it to keep rounding errors in the pixel offsets down.
+        res = mercator.MERCATOR_WORLD_SIZE / (CELL_SIZE << level)
+        x0 = int(round((gt[0] + 0.5 * mercator.MERCATOR_WORLD_SIZE) / res))
+        y0 = int(round((0.5 * mercator.MERCATOR_WORLD_SIZE - gt[3]) / res))
+        return level, (x0, y0, x0 + dst_ds.RasterXSize,
+                       y0 + dst_ds.RasterYSize)
+
+    def _load_cell(self, d, level, x, y):
+        name = self._cell_name(level, x, y)
+        local = os.path.join(d, name)
+        mkdir_p(os.path.dirname(local))
+        try:
+            self.store.get(name, local)
+        except Exception:
+            return None
+        return numpy.load(local)
+
+    def downsample(self, dst_ds, logger):
+        """
+        Fills `dst_ds` from the heights at the level above it, returning True
+        if it could, or False if `dst_ds` isn't on a pyramid level or not all
+        the heights it needs have been saved yet.
+        """
+
+        grid = self._grid(dst_ds)
+        if grid is None or grid[0] > self.max_zoom:
+            return False
+
+        level, (x0, y0, x1, y1) = grid
+        child = level + 1
+
+        # the pixel bounding box at the child level, and the cells which
+        # cover it.
+        cx0, cy0, cx1, cy1 = 2 * x0, 2 * y0, 2 * x1, 2 * y1
+        data = numpy.empty((cy1 - cy0, cx1 - cx0), numpy.float32)
+
+        with tmpdir() as d:
+            for cy in xrange(cy0 // CELL_SIZE, (cy1 - 1) // CELL_SIZE + 1):
+                for cx in xrange(cx0 // CELL_SIZE, (cx1 - 1) // CELL_SIZE + 1):
+                    cell = self._load_cell(d, child, cx, cy)
+                    if cell is None:
+                        logger.debug("Heights for %d/%d/%d not available, "
+                                     "rendering from sources."
+                                     % (child, cx, cy))
+                        return False
+
+                    # copy the part of the cell which overlaps the data.
+                    px, py = cx * CELL_SIZE, cy * CELL_SIZE
+                    ix0, iy0 = max(px, cx0), max(py, cy0)
+                    ix1 = min(px + CELL_SIZE, cx1)
+                    iy1 = min(py + CELL_SIZE, cy1)
+                    data[iy0 - cy0:iy1 - cy0, ix0 - cx0:ix1 - cx0] = \
+                        cell[iy0 - py:iy1 - py, ix0 - px:ix1 - px]
+
+        res = dst_ds.GetRasterBand(1).WriteArray(_downsample(data))
+        assert res == gdal.CPLE_None
+
+        logger.debug("Built %dx%d heights at level %d from level %d."
+                     % (x1 - x0, y1 - y0, level, child))
+        return True
+
+    def save(self, dst_ds, logger):
+        """
+        Saves the heights of all the cells completely covered by `dst_ds`, if
+        they'll be needed to build the level below.
+        """
+
+        grid = self._grid(dst_ds)
+        if grid is None or grid[0] > self.max_zoom + 1:
+            return
+
+        level, (x0, y0, x1, y1) = grid
+        data = None
+
+        with tmpdir() as d:
+            count = 0
+            for cy in xrange(-(-y0 // CELL_SIZE), y1 // CELL_SIZE):
+                for cx in xrange(-(-x0 // CELL_SIZE), x1 // CELL_SIZE):
+                    if data is None:
+                        data = dst_ds.GetRasterBand(1).ReadAsArray()
+
+                    px, py = cx * CELL_SIZE - x0, cy * CELL_SIZE - y0
+                    cell = data[py:py + CELL_SIZE, px:px + CELL_SIZE]
+
+                    name = os.path.join(d, self._cell_name(level, cx, cy))
+                    mkdir_p(os.path.dirname(name))
+                    numpy.save(name, cell.astype(numpy.float32))
+                    count += 1
+
+            if count > 0:
+                self.store.upload_all(d)
+                logger.debug("Saved heights for %d cells at level %d."
+                             % (count, level))
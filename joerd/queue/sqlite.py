@@ -0,0 +1,317 @@
+from joerd.dispatcher import EncodedJob
+import threading
+import logging
+import sqlite3
+import time
+import json
+import uuid
+
+
+# A queue stored in a local SQLite database, for running large jobs on a
+# single machine without any external services. Any number of processes can
+# send to and receive from the same database file.
+#
+# Received messages are hidden from other receivers for a visibility timeout,
+# in the same way as SQS, and are extended by a heartbeat while they're being
+# processed. If the process crashes, then the messages it held become
+# visible again when their timeouts run out, and are retried. Messages which
+# have been received `max_receives` times without being deleted are moved to
+# the `dead_letters` table rather than being retried forever.
+
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS messages (
+         id INTEGER PRIMARY KEY AUTOINCREMENT,
+         body TEXT NOT NULL,
+         visible_at REAL NOT NULL,
+         receive_count INTEGER NOT NULL DEFAULT 0,
+         receipt TEXT)""",
+    """CREATE INDEX IF NOT EXISTS messages_visible_at
+         ON messages (visible_at)""",
+    """CREATE TABLE IF NOT EXISTS dead_letters (
+         id INTEGER PRIMARY KEY,
+         body TEXT NOT NULL,
+         receive_count INTEGER NOT NULL,
+         died_at REAL NOT NULL)""",
+]
+
+# how often to look for new messages while waiting for some to arrive.
+_POLL_INTERVAL = 0.5
+
+
+def _connect(path, timeout):
+    # isolation_level=None turns off the sqlite3 module's implicit
+    # transactions, so that they can be started explicitly with BEGIN
+    # IMMEDIATE, which takes the write lock up front.
+    conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+    # WAL lets readers carry on while another process is writing.
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+class Message(object):
+    """
+    A message received from the queue. Call `delete` when it has been
+    processed successfully, or `release` to have it retried.
+    """
+
+    def __init__(self, queue, msg_id, receipt, body):
+        self.queue = queue
+        self.msg_id = msg_id
+        self.receipt = receipt
+        self.body = json.loads(body)
+
+    def delete(self):
+        self.queue.heartbeat.remove(self.msg_id)
+        self.queue.conn.execute(
+            "DELETE FROM messages WHERE id = ? AND receipt = ?",
+            (self.msg_id, self.receipt))
+
+    def release(self):
+        self.queue.heartbeat.remove(self.msg_id)
+        self.queue.conn.execute(
+            "UPDATE messages SET visible_at = ? WHERE id = ? AND receipt = ?",
+            (time.time() + self.queue.retry_delay, self.msg_id,
+             self.receipt))
+
+
+class Heartbeat(object):
+    """
+    Extends the visibility timeout of each of the messages it holds every
+    `interval` seconds, on a background thread, for as long as they're held.
+    """
+
+    def __init__(self, path, timeout, visibility_timeout, interval):
+        self.path = path
+        self.timeout = timeout
+        self.visibility_timeout = visibility_timeout
+        self.interval = interval
+        self.messages = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def add(self, msg_id, receipt):
+        with self.lock:
+            self.messages[msg_id] = receipt
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def remove(self, msg_id):
+        with self.lock:
+            self.messages.pop(msg_id, None)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.beat()
+
+    def beat(self):
+        """
+        Extends the visibility timeout of all the held messages.
+        """
+
+        with self.lock:
+            held = self.messages.items()
+
+        if not held:
+            return
+
+        # sqlite connections can't be shared between threads, so this uses
+        # its own.
+        conn = _connect(self.path, self.timeout)
+        try:
+            visible_at = time.time() + self.visibility_timeout
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "UPDATE messages SET visible_at = ? "
+                "WHERE id = ? AND receipt = ?",
+                [(visible_at, msg_id, receipt) for msg_id, receipt in held])
+            conn.execute("COMMIT")
+
+        except Exception as e:
+            logger = logging.getLogger('sqlite')
+            logger.warning("Failed to extend message visibility: %s"
+                           % str(e))
+
+        finally:
+            conn.close()
+
+
+class Batch(object):
+    """
+    Merges jobs into JSON arrays of up to `max_batch_len` jobs, and sends
+    each array as a single message.
+    """
+
+    def __init__(self, queue, max_batch_len):
+        self.queue = queue
+        self.max_batch_len = max_batch_len
+        self.batch = []
+
+    def append(self, job):
+        if isinstance(job, EncodedJob):
+            job_json = job.json
+        else:
+            job_json = json.dumps(job, separators=(',',':'))
+
+        if len(self.batch) >= self.max_batch_len:
+            self.flush()
+
+        self.batch.append(job_json)
+
+    def flush(self):
+        if self.batch:
+            self.queue.send_message("[" + (",".join(self.batch)) + "]")
+            self.batch = []
+
+
+class Queue(object):
+    """
+    A queue which keeps its messages in a local SQLite database file.
+    """
+
+    def __init__(self, config):
+        self.path = config.get('path')
+        assert self.path is not None, \
+            "Could not find the database path in config, but this must be " \
+            "configured when using SQLite queues."
+
+        self.timeout = config.get('lock_timeout', 60)
+        self.max_batch_len = config.get('max_batch_len', 10)
+        self.receive_batch_size = config.get('receive_batch_size', 10)
+        self.wait_time = config.get('wait_time', 20)
+        self.max_receives = config.get('max_receives', 5)
+        self.retry_delay = config.get('retry_delay', 0)
+        self.entries = []
+
+        self.visibility_timeout = config.get('visibility_timeout', 600)
+        heartbeat_interval = config.get('heartbeat_interval',
+                                        self.visibility_timeout / 3.0)
+        self.heartbeat = Heartbeat(self.path, self.timeout,
+                                   self.visibility_timeout,
+                                   heartbeat_interval)
+
+        self.conn = _connect(self.path, self.timeout)
+        for stmt in _SCHEMA:
+            self.conn.execute(stmt)
+
+    def start_batch(self, max_batch_len):
+        return Batch(self, min(max_batch_len, self.max_batch_len))
+
+    def send_message(self, job_json):
+        # messages are written in transactions of many messages at once, as
+        # each transaction costs a sync to disk.
+        self.entries.append(job_json)
+        if len(self.entries) >= 1000:
+            self.flush()
+
+    def flush(self):
+        if not self.entries:
+            return
+
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.executemany(
+                "INSERT INTO messages (body, visible_at) VALUES (?, ?)",
+                [(body, now) for body in self.entries])
+            self.conn.execute("COMMIT")
+
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+
+        self.entries = []
+
+    def _receive(self):
+        logger = logging.getLogger('sqlite')
+        now = time.time()
+        received = []
+
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.conn.execute(
+                "SELECT id, body, receive_count FROM messages "
+                "WHERE visible_at <= ? ORDER BY visible_at, id LIMIT ?",
+                (now, self.receive_batch_size)).fetchall()
+
+            for msg_id, body, receive_count in rows:
+                if receive_count >= self.max_receives:
+                    logger.warning("Message %d has been received %d times "
+                                   "without completing, moving it to the "
+                                   "dead letter table." %
+                                   (msg_id, receive_count))
+                    self.conn.execute(
+                        "INSERT INTO dead_letters "
+                        "(id, body, receive_count, died_at) "
+                        "VALUES (?, ?, ?, ?)",
+                        (msg_id, body, receive_count, now))
+                    self.conn.execute(
+                        "DELETE FROM messages WHERE id = ?", (msg_id,))
+                    continue
+
+                receipt = uuid.uuid4().hex
+                self.conn.execute(
+                    "UPDATE messages SET visible_at = ?, receipt = ?, "
+                    "receive_count = receive_count + 1 WHERE id = ?",
+                    (now + self.visibility_timeout, receipt, msg_id))
+                received.append((msg_id, receipt, body))
+
+            self.conn.execute("COMMIT")
+
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+
+        return received
+
+    def receive_messages(self):
+        """
+        Yields up to `receive_batch_size` messages, waiting up to `wait_time`
+        seconds for some to become visible. This can return without yielding
+        any messages if none become visible within the wait time.
+        """
+
+        deadline = time.time() + self.wait_time
+        received = self._receive()
+        while not received and time.time() < deadline:
+            time.sleep(min(_POLL_INTERVAL, max(0, deadline - time.time())))
+            received = self._receive()
+
+        for msg_id, receipt, body in received:
+            self.heartbeat.add(msg_id, receipt)
+
+        for msg_id, receipt, body in received:
+            yield Message(self, msg_id, receipt, body)
+
+    def requeue_dead_letters(self):
+        """
+        Moves all the messages in the dead letter table back onto the queue,
+        returning the number of messages moved.
+        """
+
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            count = self.conn.execute(
+                "INSERT INTO messages (id, body, visible_at) "
+                "SELECT id, body, ? FROM dead_letters", (now,)).rowcount
+            self.conn.execute("DELETE FROM dead_letters")
+            self.conn.execute("COMMIT")
+
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+
+        return count
+
+
+def create(j, cfg):
+    return Queue(cfg)
@@ -1,3 +1,7 @@
+from joerd.dispatcher import EncodedJob
+from collections import deque
+import threading
+import logging
 import boto3
 import json
 
@@ -6,15 +10,99 @@ class Message(object):
     """
     A wrapper around the SQS message, basically to unpack the JSON body and
     hold a message handle so that delete can be called on success.
+
+    While the message is held, its visibility timeout is extended by the
+    queue's heartbeat, so that it isn't given to another worker. Calling
+    `delete` or `release` stops this; after `release` the message becomes
+    visible again when its current visibility timeout runs out.
     """
 
-    def __init__(self, msg):
+    def __init__(self, msg, heartbeat):
         self.msg = msg
+        self.heartbeat = heartbeat
         self.body = json.loads(self.msg.body)
 
     def delete(self):
+        self.heartbeat.remove(self.msg)
         self.msg.delete()
 
+    def release(self):
+        self.heartbeat.remove(self.msg)
+
+
+class Heartbeat(object):
+    """
+    Extends the visibility timeout of each of the messages it holds every
+    `interval` seconds, on a background thread, for as long as they're held.
+    This stops messages which take longer than the visibility timeout to
+    process from being given to another worker and processed twice.
+    """
+
+    def __init__(self, queue, visibility_timeout, interval):
+        self.queue = queue
+        self.visibility_timeout = visibility_timeout
+        self.interval = interval
+        self.messages = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def add(self, msg):
+        with self.lock:
+            self.messages[msg.receipt_handle] = msg
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def remove(self, msg):
+        with self.lock:
+            self.messages.pop(msg.receipt_handle, None)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.beat()
+
+    def beat(self):
+        """
+        Extends the visibility timeout of all the held messages.
+        """
+
+        logger = logging.getLogger('sqs')
+
+        with self.lock:
+            handles = self.messages.keys()
+
+        # SQS allows up to 10 entries per batch request.
+        for i in range(0, len(handles), 10):
+            entries = [dict(Id=str(n), ReceiptHandle=h,
+                            VisibilityTimeout=self.visibility_timeout)
+                       for n, h in enumerate(handles[i:i+10])]
+            try:
+                result = self.queue.change_message_visibility_batch(
+                    Entries=entries)
+
+            except Exception as e:
+                logger.warning("Failed to extend message visibility: %s"
+                               % str(e))
+                continue
+
+            # the message might have been deleted since we took the list of
+            # handles, or taken too long and been received by someone else,
+            # so stop trying to extend those which failed.
+            for failed in result.get('Failed', []):
+                h = entries[int(failed['Id'])]['ReceiptHandle']
+                logger.warning("Failed to extend visibility of message: %r"
+                               % failed)
+                with self.lock:
+                    self.messages.pop(h, None)
+
 
 class Batch(object):
     """
@@ -31,9 +119,14 @@ class Batch(object):
         self.batch = []
 
     def append(self, job):
-        # NOTE: using the most compact encoding, as SQS has a size limit on
-        # the payload.
-        job_json = json.dumps(job, separators=(',',':'))
+        # jobs from the grouping dispatcher have already been encoded, and
+        # don't need to be serialised again.
+        if isinstance(job, EncodedJob):
+            job_json = job.json
+        else:
+            # NOTE: using the most compact encoding, as SQS has a size limit
+            # on the payload.
+            job_json = json.dumps(job, separators=(',',':'))
         job_len = len(job_json) + 1
         assert job_len + 1 < self.max_bytes, "Cannot send job of size %d, " \
             "as this job alone is larger than the maximum job size." \
@@ -81,6 +174,22 @@ class Queue(object):
         self.entries = []
         self.entries_size = 0
 
+        # receive up to this many messages at once, waiting up to wait_time
+        # seconds for them to arrive (i.e: long polling).
+        self.receive_batch_size = config.get('receive_batch_size', 10)
+        self.wait_time = config.get('wait_time', 20)
+        self.buffer = deque()
+
+        visibility_timeout = config.get('visibility_timeout')
+        if visibility_timeout is None:
+            visibility_timeout = self.queue.attributes.get(
+                'VisibilityTimeout', 30)
+        visibility_timeout = int(visibility_timeout)
+        heartbeat_interval = config.get('heartbeat_interval',
+                                        visibility_timeout / 3.0)
+        self.heartbeat = Heartbeat(self.queue, visibility_timeout,
+                                   heartbeat_interval)
+
     def start_batch(self, max_batch_len):
         max_batch_len = min(max_batch_len, self.max_batch_len)
         return Batch(self, self.max_batch_bytes, max_batch_len)
@@ -103,6 +212,9 @@ class Queue(object):
         self.idx += 1
 
     def flush(self):
+        if not self.entries:
+            return
+
         result = self.queue.send_messages(Entries=self.entries)
         if 'Failed' in result and result['Failed']:
             raise RuntimeError("Failed to enqueue: %r" % result['Failed'])
@@ -110,9 +222,29 @@ class Queue(object):
         self.entries = []
         self.entries_size = 0
 
+    def _fill_buffer(self):
+        msgs = self.queue.receive_messages(
+            MaxNumberOfMessages=self.receive_batch_size,
+            WaitTimeSeconds=self.wait_time)
+
+        for msg in msgs:
+            # start extending the visibility timeout straight away, as the
+            # message might wait in the buffer for a while.
+            self.heartbeat.add(msg)
+            self.buffer.append(Message(msg, self.heartbeat))
+
     def receive_messages(self):
-        for msg in self.queue.receive_messages():
-            yield Message(msg)
+        """
+        Yields the messages which have already been received, or if there
+        are none, then waits for some to arrive. This can return without
+        yielding any messages if none arrive within the wait time.
+        """
+
+        if not self.buffer:
+            self._fill_buffer()
+
+        while self.buffer:
+            yield self.buffer.popleft()
 
 
 def create(j, cfg):
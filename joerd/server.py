@@ -1,41 +1,17 @@
 from joerd.mkdir_p import mkdir_p
 import joerd.tmpdir as tmpdir
-import joerd.download as download
+import joerd.vrt as vrt
+import joerd.pipeline as pipeline
+import joerd.mercator as mercator
+import joerd.job_codec as job_codec
+import joerd.manifest as manifest
+import joerd.pyramid as pyramid
+from joerd.working_set import WorkingSet
+from joerd.downloader import Downloader
 from joerd.plugin import plugin
-from contextlib2 import ExitStack, contextmanager
+from contextlib2 import contextmanager
 import logging
-import traceback
 import os.path
-import sys
-
-
-def _download(d, store):
-    """
-    Download a source file from the internet and store it in the given store.
-    """
-
-    logger = logging.getLogger('download')
-
-    options = download.options(d.options()).copy()
-    options['verifier'] = d.verifier()
-
-    with ExitStack() as stack:
-        def _get(u):
-            return stack.enter_context(download.get(u, options))
-
-        tmps = [_get(url) for url in d.urls()]
-
-        try:
-            d.unpack(store, *tmps)
-
-        except Exception as e:
-            logger.error(repr(e))
-            raise RuntimeError("Failed to download %r: %s" %
-                               (d.output_file(),
-                                "".join(traceback.format_exception(
-                                    *sys.exc_info()))))
-
-    assert store.exists(d.output_file())
 
 
 def _download_local_vrts(d, source_store, input_vrts):
@@ -65,34 +41,43 @@ def _download_local_vrts(d, source_store, input_vrts):
     return vrts
 
 
-def _render(t, store):
-    """
-    Renders a tile, sending output to a temporary directory and puts the
-    result(s) in the store.
-    """
-
-    with tmpdir.tmpdir() as d:
-        t.render(d)
-        store.upload_all(d)
-
-
 class MockSource(object):
     """
     Used to wrap a source and override its `vrts_for` method so that VRTs which
     have been downloaded from a source store to the local filesystem can be
     used.
+
+    The VRTs are given by calling `load_vrts`, which is only done the first
+    time they're needed, so that tiles which can be built without the
+    sources (e.g: from the pyramid) don't download them.
+
+    The optional `vrt_cache` is used by the compositing step to share VRT
+    mosaics between all the tiles rendered with this source.
     """
 
-    def __init__(self, src, vrts):
+    def __init__(self, src, load_vrts, vrt_cache=None):
         self.src = src
-        self.vrts = vrts
+        self.load_vrts = load_vrts
+        self.vrts = None
+        self.vrt_cache = vrt_cache
+
+    def _local_vrts(self):
+        if self.vrts is None:
+            self.vrts = self.load_vrts()
+        return self.vrts
 
     def __getattr__(self, method_name):
         def return_vrts(self, tile):
-            return self.vrts
+            return self._local_vrts()
+
+        def return_many_vrts(self, tiles):
+            vrts = self._local_vrts()
+            return [vrts for t in tiles]
 
         if method_name == 'vrts_for':
             return return_vrts.__get__(self)
+        elif method_name == 'vrts_for_many':
+            return return_many_vrts.__get__(self)
         else:
             return self.src.__getattribute__(method_name)
 
@@ -100,8 +85,8 @@ class MockSource(object):
 class Server:
     """
     Joerd "server" or worker class. It can list the downloads required for a
-    configured region or run a job. Jobs can be either downloads of a single
-    source file or renders of a single output tile.
+    configured region or run a job. Jobs can be downloads of one or more
+    source files, or renders of one or more output tiles.
     """
 
     def __init__(self, cfg):
@@ -110,6 +95,32 @@ class Server:
         self.outputs = self._outputs(cfg, self.sources)
         self.store = self._store(cfg.store)
         self.source_store = self._store(cfg.source_store)
+        self.metatile_size = cfg.metatile_size
+        self.working_set = WorkingSet(self.source_store,
+                                      cfg.working_set_size)
+        self.upload_queue_size = cfg.upload_queue_size
+        self.manifest_prefix = cfg.manifest_prefix
+        self.render_version = cfg.render_version
+        self.pyramid = self._pyramid(cfg.pyramid)
+        self.downloader = Downloader(cfg.download['threads'],
+                                     cfg.download['host_limit'])
+
+    def close(self):
+        """
+        Releases anything held by this process, such as local copies of
+        source files and open connections.
+        """
+
+        self.working_set.close()
+        self.downloader.close()
+
+    def cleanup_worker(self, pid):
+        """
+        Removes anything left behind by the worker process `pid`, which has
+        exited without calling `close`.
+        """
+
+        self.working_set.sweep(pid)
 
     def list_downloads(self):
         logger = logging.getLogger('process')
@@ -160,35 +171,105 @@ class Server:
         create_fn = plugin('store', store_type, 'create')
         return create_fn(store_cfg)
 
+    def _pyramid(self, pyramid_cfg):
+        max_zoom = pyramid_cfg.get('max_zoom')
+        if max_zoom is None:
+            return None
+
+        # heights are kept in the output store unless another is configured.
+        store_cfg = pyramid_cfg.get('store')
+        store = self.store if store_cfg is None else self._store(store_cfg)
+        return pyramid.Pyramid(store, max_zoom,
+                               pyramid_cfg.get('prefix', 'heights'),
+                               self.render_version)
+
     def _find_source_by_name(self, name):
         for n, source in self.sources:
             if n == name:
                 return source
         raise LookupError("Unable to find source called %r" % name)
 
-    def _download(self, rehydrated):
-        _download(rehydrated, self.source_store)
+    def _download(self, rehydrated_jobs, skip_existing=False):
+        self.downloader.run(rehydrated_jobs, self.source_store, skip_existing)
 
     def _render(self, rehydrated_jobs, sources):
-        with tmpdir.tmpdir() as d:
+        # note that the VRT cache must be cleared before the temporary
+        # directory is removed, as the cached VRTs hold the source files open.
+        # the renderer puts each tile's output in the store, and all of those
+        # uploads will have finished by the time this function returns.
+        with tmpdir.tmpdir() as d, vrt.cache() as vrt_cache, \
+             pipeline.renderer(self.store, self.upload_queue_size) as r:
             mock_sources = []
             for s in sources:
+                if not any(s['vrts']):
+                    continue
+
+                def _load_vrts(input_vrts=s['vrts']):
+                    return _download_local_vrts(d, self.working_set,
+                                                input_vrts)
+
                 src = self._find_source_by_name(s['source'])
-                vrts = _download_local_vrts(d, self.source_store, s['vrts'])
-                if vrts:
-                    mock_sources.append(MockSource(src, vrts))
+                mock_sources.append(MockSource(src, _load_vrts, vrt_cache))
+
+            logger = logging.getLogger('process')
 
             for rehydrated in rehydrated_jobs:
                 rehydrated.set_sources(mock_sources)
 
-                _render(rehydrated, self.store)
+            # tiles which can be built from the pyramid are rendered on their
+            # own, as putting them in a metatile would composite them from
+            # the sources.
+            pyramid_tiles = []
+            if self.pyramid is not None:
+                for rehydrated in rehydrated_jobs:
+                    if isinstance(rehydrated, mercator.MercatorTile):
+                        rehydrated.pyramid = self.pyramid
+                pyramid_tiles = [t for t in rehydrated_jobs
+                                 if self.pyramid.covers(t)]
+                rehydrated_jobs = [t for t in rehydrated_jobs
+                                   if not self.pyramid.covers(t)]
+
+            # tiles in the batch which are close together can be rendered
+            # as a single, larger metatile and cut up afterwards.
+            metatiles, singles = mercator.metatiles(
+                rehydrated_jobs, self.metatile_size)
+            singles.extend(pyramid_tiles)
+
+            for metatile in metatiles:
+                with metatile.render(logger):
+                    for rehydrated in metatile.tiles:
+                        r.render(rehydrated)
+
+            for rehydrated in singles:
+                r.render(rehydrated)
+
+            logger.debug("Source working set: %(hits)d hits, %(misses)d "
+                         "misses, holding %(files)d files (%(size)d bytes)."
+                         % self.working_set.stats())
+
+    def _write_manifest(self, sources, data):
+        # the tiles have all been uploaded by now, so record that they're
+        # done, so that they aren't re-rendered unless their inputs change.
+        if self.manifest_prefix:
+            manifest.write(self.store, self.manifest_prefix, sources, data,
+                           self.render_version)
 
     def _run_job_download(self, job):
         data = job['data']
         typ = data['type']
         src = self._find_source_by_name(typ)
         rehydrated = src.rehydrate(data)
-        self._download(rehydrated)
+        self._download([rehydrated])
+
+    def _run_job_download_batch(self, job):
+        rehydrated_jobs = []
+        for datum in job['data']:
+            src = self._find_source_by_name(datum['type'])
+            rehydrated_jobs.append(src.rehydrate(datum))
+
+        # if the batch is being retried after some of its downloads failed,
+        # then the ones which succeeded don't need fetching again.
+        self._download(rehydrated_jobs, skip_existing=True)
 
     def _run_job_render(self, job):
         logger = logging.getLogger('process')
@@ -206,6 +287,7 @@ class Server:
 
         rehydrated = self.outputs[typ].rehydrate(data)
         self._render([rehydrated], sources)
+        self._write_manifest(sources, [data])
 
     def _run_job_render_batch(self, job):
         logger = logging.getLogger('process')
@@ -227,6 +309,7 @@ class Server:
             rehydrated_jobs.append(job)
 
         self._render(rehydrated_jobs, sources)
+        self._write_manifest(sources, data)
 
     def dispatch_job(self, job):
         logger = logging.getLogger('process')
@@ -236,12 +319,18 @@ class Server:
         if job_type == 'download':
             self._run_job_download(job)
 
+        elif job_type == 'downloadbatch':
+            self._run_job_download_batch(job)
+
         elif job_type == 'render':
             self._run_job_render(job)
 
         elif job_type == 'renderbatch':
             self._run_job_render_batch(job)
 
+        elif job_type == job_codec.PACKED_JOB_TYPE:
+            self._run_job_render_batch(job_codec.decode_render_batch(job))
+
         else:
             raise LookupError("Don't understand job type %r from job %r, " \
                             "ignoring." % (job_type, job))
@@ -63,6 +63,12 @@ class ETOPO1(object):
         """
         return [self.downloads_for(tile)]
 
+    def vrts_for_many(self, tiles):
+        """
+        Returns a list of the result of `vrts_for` for each of `tiles`.
+        """
+        return [self.vrts_for(t) for t in tiles]
+
     def output_file(self):
         return os.path.join(self.base_dir, self.target_name)
 
@@ -132,6 +132,12 @@ class GMTED(object):
         """
         return [self.downloads_for(tile)]
 
+    def vrts_for_many(self, tiles):
+        """
+        Returns a list of the result of `vrts_for` for each of `tiles`.
+        """
+        return [self.vrts_for(t) for t in tiles]
+
     def srs(self):
         return srs.wgs84()
 
@@ -5,6 +5,7 @@ import joerd.srs as srs
 import joerd.mask as mask
 import joerd.tmpdir as tmpdir
 from joerd.mkdir_p import mkdir_p
+from joerd.archive import tar_member
 from shutil import copyfileobj
 import os.path
 import os
@@ -91,18 +92,15 @@ class GreatLake(object):
         tif_file = self._tif_file()
         shift = GREAT_LAKES[self.lake]['datum']
 
-        with tmpdir.tmpdir() as tmp_dir:
-            with tarfile.open(tmp.name, mode='r:gz') as tar:
-                tar.extract(tif_file, tmp_dir)
+        # read the TIF straight out of the archive, rather than extracting
+        # it first.
+        tif_path = tar_member(tmp.name, tif_file)
 
-            tif_path = os.path.join(tmp_dir, tif_file)
-            assert os.path.exists(tif_path), "Didn't extract TIF"
+        with store.upload_dir() as target:
+            mkdir_p(os.path.join(target, self.base_dir))
+            output_file = os.path.join(target, self.output_file())
 
-            with store.upload_dir() as target:
-                mkdir_p(os.path.join(target, self.base_dir))
-                output_file = os.path.join(target, self.output_file())
-
-                mask.datum_shift(tif_path, 'GTiff', output_file, shift)
+            mask.datum_shift(tif_path, 'GTiff', output_file, shift)
 
     def freeze_dry(self):
         return dict(type='greatlakes', lake=self.lake)
@@ -162,6 +160,12 @@ class GreatLakes(object):
         """
         return [self.downloads_for(tile)]
 
+    def vrts_for_many(self, tiles):
+        """
+        Returns a list of the result of `vrts_for` for each of `tiles`.
+        """
+        return [self.vrts_for(t) for t in tiles]
+
     def srs(self):
         return srs.nad83()
 
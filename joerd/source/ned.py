@@ -29,6 +29,9 @@ class NED(object):
     def vrts_for(self, tile):
         return self.base.vrts_for(tile)
 
+    def vrts_for_many(self, tiles):
+        return self.base.vrts_for_many(tiles)
+
     def filter_type(self, src_res, dst_res):
         return self.base.filter_type(src_res, dst_res)
 
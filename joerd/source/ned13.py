@@ -6,9 +6,9 @@ import joerd.index as index
 import joerd.mask as mask
 import joerd.tmpdir as tmpdir
 from joerd.mkdir_p import mkdir_p
+from joerd.archive import zip_member
 from contextlib import closing
 from shutil import copyfile
-from ftplib import FTP
 import os.path
 import os
 import requests
@@ -78,12 +78,10 @@ class NED13Tile(object):
             target_dir = os.path.join(target, self.base_dir)
             mkdir_p(target_dir)
 
-            with tmpdir.tmpdir() as d:
-                with zipfile.ZipFile(tmp.name, 'r') as zfile:
-                    zfile.extract(img, d)
-
-                output_file = os.path.join(target, self.output_file())
-                mask.negative(os.path.join(d, img), "HFA", output_file)
+            # read the image straight out of the zip, rather than extracting
+            # it first.
+            output_file = os.path.join(target, self.output_file())
+            mask.negative(zip_member(tmp.name, img), "HFA", output_file)
 
     def img_name(self):
         base_name = self.fname.replace('.zip', '')
@@ -129,12 +127,12 @@ class NED13(object):
         self.base_path = options['base_path']
         self.download_options = options
         self.tile_index = None
+        self.tile_intersector = None
 
     def get_index(self):
         index_file = os.path.join(self.base_dir, 'index.yaml')
-        # if index doesn't exist, or is more than 24h old
-        if not os.path.isfile(index_file) or \
-           time.time() > os.path.getmtime(index_file) + 86400:
+        # if index doesn't exist, or hasn't been checked for 24h
+        if index.is_stale(index_file, 86400):
             self.download_index(index_file)
 
     def download_index(self, index_file):
@@ -142,14 +140,30 @@ class NED13(object):
             os.makedirs(self.base_dir)
 
         logger = logging.getLogger('ned')
-        logger.info('Fetching NED13 index...')
+        logger.info('Checking NED13 index...')
 
-        files = []
-        for zname in self._uniq_ned_files(self._list_ned_files()):
-            files.append(zname)
+        # if the server reports the modification time of the directory, and
+        # it hasn't changed, then there's no need to list it again.
+        validators = {}
+        if os.path.isfile(index_file):
+            validators = index.validators(index_file)
+        with download.ftp_session(self.ftp_server) as ftp:
+            mdtm = download.ftp_mdtm(ftp, self.base_path)
 
-        with open(index_file, 'w') as f:
-            f.write(yaml.dump(files))
+        if mdtm is not None and mdtm == validators.get('mdtm'):
+            logger.info('NED13 index is unchanged.')
+
+        else:
+            files = list(self._uniq_ned_files(self._list_ned_files()))
+            added, removed = index.update(index_file, files,
+                                          _parse_ned_tile, self)
+            if added or removed:
+                self.tile_index = None
+                self.tile_intersector = None
+            logger.info('NED13 index has %d new and %d removed files.'
+                        % (added, removed))
+
+        index.save_validators(index_file, dict(mdtm=mdtm))
 
     def _ensure_tile_index(self):
         if self.tile_index is None:
@@ -172,23 +186,36 @@ class NED13(object):
         return NED13Tile(self, data['fname'], data['lon'], data['lat'])
 
     def downloads_for(self, tile):
-        tiles = set()
+        return self.downloads_for_many([tile])[0]
+
+    def downloads_for_many(self, tiles):
+        """
+        Returns a list of the set of NED13 tiles needed for each of `tiles`,
+        resolving them against the index all at once.
+        """
+
+        result = [set() for t in tiles]
+
         # if the tile scale is greater than 20x the NED scale, then there's no
         # point in including NED, it'll be far too fine to make a difference.
         # NED13 is 1/3rd arc second.
-        if tile.max_resolution() > 20 * 1.0 / (3600 * 3):
-            return tiles
-
-        # buffer by 0.0075 degrees (81px) to grab neighbouring tiles and ensure
-        # some overlap to take care of boundary issues.
-        tile_bbox = tile.latlon_bbox().buffer(0.0075)
+        wanted = [i for i, t in enumerate(tiles)
+                  if t.max_resolution() <= 20 * 1.0 / (3600 * 3)]
+        if not wanted:
+            return result
 
-        tile_index = self._ensure_tile_index()
+        if self.tile_intersector is None:
+            # buffer by 0.0075 degrees (81px) to grab neighbouring tiles and
+            # ensure some overlap to take care of boundary issues.
+            self.tile_intersector = index.TileIntersector(
+                self._ensure_tile_index(), 0.0075)
 
-        for t in index.intersections(tile_index, tile_bbox):
-            tiles.add(t)
+        intersections = self.tile_intersector.intersections(
+            [tiles[i] for i in wanted])
+        for i, ts in zip(wanted, intersections):
+            result[i].update(ts)
 
-        return tiles
+        return result
 
     def vrts_for(self, tile):
         """
@@ -199,8 +226,13 @@ class NED13(object):
         """
         return [self.downloads_for(tile)]
 
+    def vrts_for_many(self, tiles):
+        """
+        Returns a list of the result of `vrts_for` for each of `tiles`.
+        """
+        return [[ts] for ts in self.downloads_for_many(tiles)]
+
     def _list_ned_files(self):
-        ftp = FTP(self.ftp_server)
         files = []
 
         def _callback(zname):
@@ -208,14 +240,14 @@ class NED13(object):
             if t is not None:
                 files.append(t.zip_name())
 
-        ftp.login()
-        ftp.cwd(self.base_path)
-        try:
-            ftp.set_pasv(True)
-            ftp.retrlines('NLST', _callback)
-            ftp.quit()
-        except EOFError:
-            pass
+        # the session is pooled, so later listings and downloads from the
+        # same server don't need to log in again.
+        with download.ftp_session(self.ftp_server) as ftp:
+            ftp.cwd(self.base_path)
+            try:
+                ftp.retrlines('NLST', _callback)
+            except EOFError:
+                pass
 
         return files
 
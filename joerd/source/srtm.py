@@ -7,6 +7,7 @@ import joerd.index as index
 import joerd.mask as mask
 import joerd.tmpdir as tmpdir
 from joerd.mkdir_p import mkdir_p
+from joerd.archive import zip_member
 from contextlib2 import closing, ExitStack
 from shutil import copyfile, move
 import os.path
@@ -73,21 +74,24 @@ class SRTMTile(object):
         names.append(self.fname.replace(".hgt", ".SRTMGL1.hgt"))
         return names
 
+    def _hgt_member(self, zfile, zip_name):
+        exists = set([i.filename for i in zfile.infolist()])
+        names = set(self._alternative_names())
+
+        for n in names & exists:
+            return n
+
+        raise LookupError("None of the alternative names %r were found "
+                          "in the SRTM zipfile %r. Contents are: %r" %
+                          (names, zip_name, exists))
+
     def _unpack_hgt(self, zip_name, target_dir):
         with zipfile.ZipFile(zip_name, 'r') as zfile:
-            exists = set([i.filename for i in zfile.infolist()])
-            names = set(self._alternative_names())
-
-            for n in names & exists:
-                zfile.extract(n, target_dir)
-                if n != self.fname:
-                    move(os.path.join(target_dir, n),
-                         os.path.join(target_dir, self.fname))
-                return
-
-            raise LookupError("None of the alternative names %r were found "
-                              "in the SRTM zipfile %r. Contents are: %r" %
-                              (names, zip_name, exists))
+            n = self._hgt_member(zfile, zip_name)
+            zfile.extract(n, target_dir)
+            if n != self.fname:
+                move(os.path.join(target_dir, n),
+                     os.path.join(target_dir, self.fname))
 
     def unpack(self, store, data_zip, mask_zip=None):
         with store.upload_dir() as target:
@@ -99,20 +103,19 @@ class SRTMTile(object):
                 self._unpack_hgt(data_zip.name, target_dir)
                 return
 
-            # otherwise, make a temporary directory to keep the SRTM and
-            # mask in while compositing them.
-            with tmpdir.tmpdir() as d:
-                self._unpack_hgt(data_zip.name, d)
+            # otherwise, read the SRTM straight out of its zip with GDAL, and
+            # the mask into memory, rather than extracting them both first.
+            with zipfile.ZipFile(data_zip.name, 'r') as zfile:
+                hgt = zip_member(data_zip.name,
+                                 self._hgt_member(zfile, data_zip.name))
 
-                mask_name = self.fname.replace(".hgt", ".raw")
-                with zipfile.ZipFile(mask_zip.name, 'r') as zfile:
-                    zfile.extract(mask_name, d)
+            mask_name = self.fname.replace(".hgt", ".raw")
+            with zipfile.ZipFile(mask_zip.name, 'r') as zfile:
+                mask_data = zfile.read(mask_name)
 
-                mask_file = os.path.join(d, mask_name)
-                # mask off the water using the mask raster raw file
-                output_file = os.path.join(target, self.output_file())
-                mask.raw(os.path.join(d, self.fname), mask_file, 255,
-                         "SRTMHGT", output_file)
+            # mask off the water using the mask raster raw data
+            output_file = os.path.join(target, self.output_file())
+            mask.raw_data(hgt, mask_data, 255, "SRTMHGT", output_file)
 
     def freeze_dry(self):
         return dict(type='srtm', link=self.link, is_masked=self.is_masked)
@@ -135,6 +138,7 @@ class SRTM(object):
         self.mask_url = options.get('mask-url')
         self.download_options = options
         self.tile_index = None
+        self.tile_intersector = None
         self.mask_index = None
 
     # Pickling the tile index is probably not a good idea, since it is
@@ -143,6 +147,7 @@ class SRTM(object):
     def __getstate__(self):
         odict = self.__dict__.copy()
         odict['tile_index'] = None
+        odict['tile_intersector'] = None
         odict['mask_index'] = None
         return odict
 
@@ -153,9 +158,8 @@ class SRTM(object):
     def get_one_index(self, name):
         fname = 'index_%s.yaml' % name
         index_file = os.path.join(self.base_dir, fname)
-        # if index doesn't exist, or is more than 24h old
-        if not os.path.isfile(index_file) or \
-           time.time() > os.path.getmtime(index_file) + 86400:
+        # if index doesn't exist, or hasn't been checked for 24h
+        if index.is_stale(index_file, 86400):
             self.download_index(index_file, name)
 
     def download_index(self, index_file, name):
@@ -163,7 +167,7 @@ class SRTM(object):
             os.makedirs(self.base_dir)
 
         logger = logging.getLogger('srtm')
-        logger.info('Fetching SRTM %r index...' % name)
+        logger.info('Checking SRTM %r index...' % name)
 
         url = None
         if name == 'tile':
@@ -171,19 +175,43 @@ class SRTM(object):
         if name == 'mask':
             url = self.mask_url
 
-        r = requests.get(url)
-        soup = BeautifulSoup(r.text, 'html.parser')
-
-        links = []
-        for a in soup.find_all('a'):
-            link = a.get('href')
-            if link is not None:
-                bbox = self._parse_bbox(link)
-                if bbox:
-                    links.append(link)
-
-        with open(index_file, 'w') as f:
-            f.write(yaml.dump(links))
+        # the listing is only fetched if it has changed since last time.
+        validators = {}
+        if os.path.isfile(index_file):
+            validators = index.validators(index_file)
+        text, validators = download.get_if_modified(url, validators)
+
+        if text is not None:
+            soup = BeautifulSoup(text, 'html.parser')
+
+            links = []
+            for a in soup.find_all('a'):
+                link = a.get('href')
+                if link is not None:
+                    bbox = self._parse_bbox(link)
+                    if bbox:
+                        links.append(link)
+
+            # only the bounding boxes of the tiles are needed for the index,
+            # so there's no need to look up whether each one is masked.
+            if name == 'tile':
+                added, removed = index.update(index_file, links,
+                                              _parse_srtm_tile, self, False)
+                if added or removed:
+                    self.tile_index = None
+                    self.tile_intersector = None
+            else:
+                added, removed = index.update(index_file, links)
+                if added or removed:
+                    self.mask_index = None
+
+            logger.info('SRTM %r index has %d new and %d removed files.'
+                        % (name, added, removed))
+
+        else:
+            logger.info('SRTM %r index is unchanged.' % name)
+
+        index.save_validators(index_file, validators)
 
     def _ensure_tile_index(self):
         if self.tile_index is None:
@@ -197,7 +225,7 @@ class SRTM(object):
     def _ensure_mask_index(self):
         if self.mask_index is None:
             index_file = os.path.join(self.base_dir, 'index_mask.yaml')
-            self.mask_index = set(yaml.load(open(index_file)))
+            self.mask_index = set(index.names(index_file))
 
         return self.mask_index
 
@@ -216,23 +244,36 @@ class SRTM(object):
         return _parse_srtm_tile(data['link'], self, data['is_masked'])
 
     def downloads_for(self, tile):
-        tiles = set()
+        return self.downloads_for_many([tile])[0]
+
+    def downloads_for_many(self, tiles):
+        """
+        Returns a list of the set of SRTM tiles needed for each of `tiles`,
+        resolving them against the index all at once.
+        """
+
+        result = [set() for t in tiles]
+
         # if the tile scale is greater than 20x the SRTM scale, then there's no
         # point in including SRTM, it'll be far too fine to make a difference.
         # SRTM is 1 arc second.
-        if tile.max_resolution() > 20 * 1.0 / 3600:
-            return tiles
+        wanted = [i for i, t in enumerate(tiles)
+                  if t.max_resolution() <= 20 * 1.0 / 3600]
+        if not wanted:
+            return result
 
-        # buffer by 0.01 degrees (36px) to grab neighbouring tiles and ensure
-        # that there aren't any boundary artefacts.
-        tile_bbox = tile.latlon_bbox().buffer(0.01)
+        if self.tile_intersector is None:
+            # buffer by 0.01 degrees (36px) to grab neighbouring tiles and
+            # ensure that there aren't any boundary artefacts.
+            self.tile_intersector = index.TileIntersector(
+                self._ensure_tile_index(), 0.01)
 
-        tile_index = self._ensure_tile_index()
+        intersections = self.tile_intersector.intersections(
+            [tiles[i] for i in wanted])
+        for i, ts in zip(wanted, intersections):
+            result[i].update(ts)
 
-        for t in index.intersections(tile_index, tile_bbox):
-            tiles.add(t)
-
-        return tiles
+        return result
 
     def vrts_for(self, tile):
         """
@@ -247,6 +288,12 @@ class SRTM(object):
         """
         return [self.downloads_for(tile)]
 
+    def vrts_for_many(self, tiles):
+        """
+        Returns a list of the result of `vrts_for` for each of `tiles`.
+        """
+        return [[ts] for ts in self.downloads_for_many(tiles)]
+
     def filter_type(self, src_res, dst_res):
         return gdal.GRA_Lanczos if src_res > dst_res else gdal.GRA_Cubic
 
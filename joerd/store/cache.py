@@ -1,20 +1,57 @@
 from joerd.mkdir_p import mkdir_p
 from joerd.plugin import plugin
+from joerd.tmpdir import tmpdir
 from os import link
 from contextlib2 import contextmanager
+from shutil import copyfile, move
+import os
 import os.path
+import errno
+import fcntl
+import logging
+
+
+# suffixes of the files used to lock and fill cache entries. these are kept
+# alongside the cached files, and are never counted or evicted as entries.
+_LOCK_SUFFIX = '.lock'
+_TMP_SUFFIX = '.tmp'
+
+
+@contextmanager
+def _locked(lock_file):
+    """
+    Holds an exclusive lock on `lock_file`, creating it if necessary. This is
+    an advisory lock, and so only protects against other processes also using
+    this function.
+    """
+
+    with open(lock_file, 'a') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
 
 
 class CacheStore(object):
     """
-    Every tile that gets generated requires ETOPO1. And most require a GMTED
-    tile, which are pretty large and cover much of the world. Rather than
-    re-download them every time (ETOPO1 alone is 446MB), we cache ETOPO1 and
-    GMTED.
-
-    This is a bit of a hack, and would be better replaced by a generic
-    fixed-size LRU/LFU cache. Even better if the cache could be shared
-    between multiple Joerd processes on the same host.
+    A store which caches files fetched from another store on the local disk.
+    Every tile that gets generated requires ETOPO1, most require a GMTED tile
+    and neighbouring render batches often share SRTM and NED tiles. Rather
+    than re-download them every time (ETOPO1 alone is 446MB), we keep them in
+    a local cache directory.
+
+    The cache is limited to `max_size` bytes (unlimited if not set), and the
+    least recently used files are evicted to make space for new ones. It can
+    be shared between several Joerd processes on the same host: files are
+    filled atomically while holding a per-file lock, so that only one process
+    downloads each file, and eviction holds a lock on the whole cache.
+
+    Cached files are handed out as hard links. This makes it non-portable, but
+    means that we don't have to worry about whether GDAL supports symbolic
+    links, and we don't have to worry about evicting files which are still in
+    use, as they are reference counted by the OS.
     """
 
     def __init__(self, cfg):
@@ -22,10 +59,19 @@ class CacheStore(object):
         create_fn = plugin('store', store_type, 'create')
         self.store = create_fn(cfg['store'])
         self.cache_dir = cfg['cache_dir']
+        self.max_size = cfg.get('max_size')
+
+        mkdir_p(self.cache_dir)
 
     def upload_all(self, d):
         self.store.upload_all(d)
 
+        # any files we have cached under the same names are now stale.
+        for dirpath, dirs, files in os.walk(d):
+            for f in files:
+                name = os.path.relpath(os.path.join(dirpath, f), d)
+                self._remove(os.path.join(self.cache_dir, name))
+
     @contextmanager
     def upload_dir(self):
         with tmpdir() as t:
@@ -35,21 +81,135 @@ class CacheStore(object):
     def exists(self, filename):
         return self.store.exists(filename)
 
+    def list_files(self, prefix):
+        return self.store.list_files(prefix)
+
     def get(self, source, dest):
-        if 'ETOPO1' in source or 'gmted' in source:
-            cache_path = os.path.join(self.cache_dir, source)
+        cache_path = os.path.join(self.cache_dir, source)
+
+        while True:
             if not os.path.exists(cache_path):
-                mkdir_p(os.path.dirname(cache_path))
-                self.store.get(source, cache_path)
+                # if the file was too large to fit in the cache, then it
+                # will have been put straight in dest instead.
+                if self._fill(source, cache_path, dest):
+                    return
+
+            try:
+                link(cache_path, dest)
+
+            except OSError as e:
+                # the file might have been evicted by another process since
+                # we checked for it, in which case we'll fetch it again.
+                if e.errno == errno.ENOENT and not os.path.exists(cache_path):
+                    continue
+                # hard links can't cross filesystems, so fall back to a copy
+                # if the cache is on a different one.
+                elif e.errno == errno.EXDEV:
+                    copyfile(cache_path, dest)
+                else:
+                    raise
+
+            # touch the file to mark it as recently used.
+            self._touch(cache_path)
+            return
+
+    def _fill(self, source, cache_path, dest):
+        """
+        Fetches `source` into the cache at `cache_path`. If it is too large
+        to be cached, then it is moved to `dest` instead and True is
+        returned.
+        """
+
+        logger = logging.getLogger('cache')
+        mkdir_p(os.path.dirname(cache_path))
+
+        with _locked(cache_path + _LOCK_SUFFIX):
+            # another process might have filled it while we were waiting for
+            # the lock.
+            if os.path.exists(cache_path):
+                return False
+
+            # download to a temporary name and rename it into place, so that
+            # other processes never see a partially-written file.
+            tmp_path = "%s%s.%d" % (cache_path, _TMP_SUFFIX, os.getpid())
+            try:
+                self.store.get(source, tmp_path)
+                size = os.path.getsize(tmp_path)
+
+                if self.max_size is not None and size > self.max_size:
+                    logger.info("Not caching %r, as it is larger than the "
+                                "whole cache (%d > %d bytes)."
+                                % (source, size, self.max_size))
+                    move(tmp_path, dest)
+                    return True
+
+                self._evict(size)
+                os.rename(tmp_path, cache_path)
+                logger.debug("Cached %r (%d bytes)." % (source, size))
+                return False
+
+            finally:
+                self._remove(tmp_path)
+
+    def _entries(self):
+        """
+        Returns a list of (mtime, size, path) tuples for each file in the
+        cache.
+        """
+
+        entries = []
+        for dirpath, dirs, files in os.walk(self.cache_dir):
+            for f in files:
+                if f.endswith(_LOCK_SUFFIX) or _TMP_SUFFIX in f:
+                    continue
+
+                path = os.path.join(dirpath, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # evicted by another process while we were walking.
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+
+        return entries
+
+    def _evict(self, new_size):
+        """
+        Removes the least recently used files from the cache until there is
+        space for a new file of `new_size` bytes.
+        """
+
+        if self.max_size is None:
+            return
+
+        logger = logging.getLogger('cache')
+        lock_file = os.path.join(self.cache_dir, _LOCK_SUFFIX)
+
+        with _locked(lock_file):
+            entries = self._entries()
+            total = sum(size for mtime, size, path in entries)
+
+            for mtime, size, path in sorted(entries):
+                if total + new_size <= self.max_size:
+                    break
+
+                logger.debug("Evicting %r (%d bytes) from cache."
+                             % (path, size))
+                self._remove(path)
+                total -= size
 
-            # hard link to dest. this makes it non-portable, but means that
-            # we don't have to worry about whether GDAL supports symbolic
-            # links, and we don't have to worry about deleting files, as they
-            # are reference counted by the OS.
-            link(cache_path, dest)
+    def _touch(self, path):
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
 
-        else:
-            self.store.get(source, dest)
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
 
 
 def create(cfg):
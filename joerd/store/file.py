@@ -24,6 +24,22 @@ class FileStore(object):
     def get(self, source, dest):
         copyfile(os.path.join(self.base_dir, source), dest)
 
+    def list_files(self, prefix):
+        """
+        Yields the names of all the files in the store which start with
+        `prefix`.
+        """
+
+        # only walk the directory the prefix is in, rather than the whole
+        # store.
+        top = os.path.join(self.base_dir, os.path.dirname(prefix))
+        for dirpath, dirs, files in os.walk(top):
+            for f in files:
+                name = os.path.relpath(os.path.join(dirpath, f),
+                                       self.base_dir)
+                if name.startswith(prefix):
+                    yield name
+
 
 def create(cfg):
     return FileStore(cfg)
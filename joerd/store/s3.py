@@ -1,6 +1,7 @@
 import boto3
 from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from os import walk
 import os.path
 from contextlib2 import contextmanager
@@ -26,7 +27,8 @@ _MIME_TYPES = {
 class S3Store(object):
     def __init__(self, cfg):
         self.bucket_name = cfg.get('bucket_name')
-        self.upload_config = cfg.get('upload_config')
+        self.upload_config = cfg.get('upload_config') or {}
+        self.upload_threads = cfg.get('upload_threads', 16)
 
         assert self.bucket_name is not None, \
             "Bucket name not configured for S3 store, but it must be."
@@ -36,6 +38,7 @@ class S3Store(object):
         # multiprocessing boundary.
         self.s3 = None
         self.bucket = None
+        self.client = None
 
     # This object is likely to get pickled to send it to other processes
     # for multiprocessing. However, the s3/boto objects are probably not
@@ -45,12 +48,14 @@ class S3Store(object):
         odict = self.__dict__.copy()
         del odict['s3']
         del odict['bucket']
+        del odict['client']
         return odict
 
     def __setstate__(self, d):
         self.__dict__.update(d)
         self.s3 = None
         self.bucket = None
+        self.client = None
 
     def _get_bucket(self):
         if self.s3 is None or self.bucket is None:
@@ -59,7 +64,17 @@ class S3Store(object):
 
         return self.bucket
 
+    def _get_client(self):
+        # unlike resources, boto clients are safe to share between threads,
+        # so a single one is used by all the upload threads.
+        if self.client is None:
+            self.client = boto3.session.Session().client('s3')
+
+        return self.client
+
     def upload_all(self, d):
+        logger = logging.getLogger('s3')
+
         # strip trailing slashes so that we're sure that the path we create by
         # removing this as a prefix does not start with a /.
         if not d.endswith('/'):
@@ -67,12 +82,48 @@ class S3Store(object):
 
         transfer_config = TransferConfig(**self.upload_config)
 
+        uploads = []
         for dirpath, dirs, files in walk(d):
             if dirpath.startswith(d):
                 suffix = dirpath[len(d):]
-                self._upload_files(dirpath, suffix, files, transfer_config)
+                uploads.extend(self._upload_files(dirpath, suffix, files))
+
+        if not uploads:
+            return
+
+        # make sure the client exists before starting the threads which
+        # share it.
+        self._get_client()
+
+        start = time.time()
+        num_bytes = 0
+
+        # upload the files concurrently, as most of the time for each upload
+        # is spent waiting on the round trip to S3. retry up to 6 times,
+        # waiting 32 (=2^5) seconds before the final attempt.
+        tries = 6
+        num_threads = max(1, min(self.upload_threads, len(uploads)))
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            futures = []
+            for src_name, s3_key, extra_args in uploads:
+                num_bytes += os.path.getsize(src_name)
+                futures.append(executor.submit(
+                    self.retry_upload_file, src_name, s3_key,
+                    transfer_config, extra_args, tries))
+
+            # re-raise the first error, if there was one.
+            for f in futures:
+                f.result()
+
+        elapsed = max(time.time() - start, 1.0e-6)
+        logger.info("Uploaded %d files (%d bytes) in %.2fs: %.1f files/s, "
+                    "%.1f KiB/s" % (len(uploads), num_bytes, elapsed,
+                                    len(uploads) / elapsed,
+                                    num_bytes / (1024.0 * elapsed)))
+
+    def _upload_files(self, dirpath, suffix, files):
+        uploads = []
 
-    def _upload_files(self, dirpath, suffix, files, transfer_config):
         for f in files:
             src_name = os.path.join(dirpath, f)
             s3_key = os.path.join(suffix, f)
@@ -84,21 +135,19 @@ class S3Store(object):
             if mime:
                 extra_args['ContentType'] = mime
 
-            # retry up to 6 times, waiting 32 (=2^5) seconds before the final
-            # attempt.
-            tries = 6
-            self.retry_upload_file(src_name, s3_key, transfer_config,
-                                   extra_args, tries)
+            uploads.append((src_name, s3_key, extra_args))
+
+        return uploads
 
     def retry_upload_file(self, src_name, s3_key, transfer_config,
                           extra_args, tries, backoff=1):
         logger = logging.getLogger('s3')
 
-        bucket = self._get_bucket()
+        client = self._get_client()
         try_num = 0
         while True:
             try:
-                bucket.upload_file(src_name, s3_key,
+                client.upload_file(src_name, self.bucket_name, s3_key,
                                    Config=transfer_config,
                                    ExtraArgs=extra_args)
                 break
@@ -150,6 +199,18 @@ class S3Store(object):
                                % (source, "".join(traceback.format_exception(
                                    *sys.exc_info()))))
 
+    def list_files(self, prefix):
+        """
+        Yields the names of all the objects in the bucket which start with
+        `prefix`.
+        """
+
+        paginator = self._get_client().get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name,
+                                       Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key']
+
 
 def create(cfg):
     return S3Store(cfg)
@@ -1,26 +1,72 @@
 from osgeo import gdal
-from contextlib2 import contextmanager, closing
-import subprocess
-import tempfile
+from contextlib2 import contextmanager
 import logging
 import os.path
 
 
+def _build(files, srs):
+    # ensure files are actually present before trying to make a VRT from
+    # them.
+    for f in files:
+        assert os.path.exists(f), "Trying to build a VRT including file " \
+            "%r, but it does not seem to exist." % f
+
+    # an empty destination name makes GDAL build the VRT in memory, which
+    # saves forking gdalbuildvrt and writing and re-reading a .vrt file for
+    # each mosaic.
+    ds = gdal.BuildVRT('', [str(f) for f in files], outputSRS=srs)
+
+    if ds is None:
+        raise RuntimeError("Unable to build VRT of %r" % (files,))
+
+    return ds
+
+
 @contextmanager
 def build(files, srs):
-    with closing(tempfile.NamedTemporaryFile(suffix='.vrt')) as vrt:
-        # ensure files are actually present before trying to make a VRT from
-        # them.
-        for f in files:
-            assert os.path.exists(f), "Trying to build a VRT including file " \
-                "%r, but it does not seem to exist." % f
+    ds = _build(files, srs)
+    yield ds
+    del ds
+
+
+class Cache(object):
+    """
+    Holds in-memory VRT mosaics, keyed on the list of files they include, so
+    that tiles in the same render batch which need the same sources don't
+    each build their own copy of the mosaic. The order of the files matters,
+    as it decides which file is used where they overlap.
+
+    The files must not be removed while the cache holds VRTs referencing them,
+    so the cache should be cleared before the directory they are in is
+    cleaned up.
+    """
 
-        args = ["gdalbuildvrt", "-q", "-a_srs", srs, vrt.name ] + files
-        status = subprocess.call(args)
+    def __init__(self):
+        self.mosaics = {}
 
-        if status != 0:
-            raise RuntimeError("Call to gdalbuildvrt failed: status=%r" % status)
+    @contextmanager
+    def build(self, files, srs):
+        key = (tuple(files), srs)
+        ds = self.mosaics.get(key)
+
+        if ds is None:
+            logger = logging.getLogger('vrt')
+            logger.debug("Building mosaic of %d files." % len(files))
+            ds = _build(files, srs)
+            self.mosaics[key] = ds
 
-        ds = gdal.Open(vrt.name)
         yield ds
-        del ds
+
+    def clear(self):
+        self.mosaics.clear()
+
+
+@contextmanager
+def cache():
+    c = Cache()
+
+    try:
+        yield c
+
+    finally:
+        c.clear()
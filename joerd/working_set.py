@@ -0,0 +1,159 @@
+from joerd.mkdir_p import mkdir_p
+from collections import OrderedDict
+from shutil import copyfile
+import threading
+import tempfile
+import shutil
+import atexit
+import logging
+import errno
+import glob
+import os
+import os.path
+
+
+def _dir_prefix(pid):
+    return 'joerd-sources-%d-' % pid
+
+
+class WorkingSet(object):
+    """
+    A local copy of the source files which a worker has recently used, kept
+    for the lifetime of the worker process. Consecutive render jobs very often
+    use the same source files (e.g: the same SRTM 1x1 degree tile), so this
+    saves fetching them from the source store for every job.
+
+    It has the same `get` method as a store, and the files are handed out as
+    hard links, so they can be removed from the working set without affecting
+    jobs which are still using them. The working set holds up to `max_size`
+    bytes, evicting the least recently used files beyond that. If `max_size`
+    is zero, then every `get` goes straight to the store.
+
+    It is safe to call `get` from several threads at once. If more than one
+    thread asks for the same file, then only one fetches it and the others
+    wait for it.
+
+    Processes forked by `multiprocessing` don't run `atexit` handlers, so
+    each worker should call `close` to remove its files before it exits. If
+    a worker dies without doing so, then its parent can call `sweep` to
+    remove them.
+    """
+
+    def __init__(self, store, max_size):
+        self.store = store
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # the directory is created lazily, and separately in each process,
+        # as the working set might be created in a parent process before
+        # workers are forked from it.
+        self.pid = None
+        self.dir = None
+        self.pending = {}
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def _ensure_dir(self):
+        if self.pid != os.getpid():
+            self._reset()
+            self.pid = os.getpid()
+            self.dir = tempfile.mkdtemp(prefix=_dir_prefix(self.pid))
+            atexit.register(shutil.rmtree, self.dir, True)
+
+        return self.dir
+
+    def close(self):
+        """
+        Removes the files held by this process.
+        """
+
+        with self.lock:
+            if self.pid == os.getpid():
+                shutil.rmtree(self.dir, True)
+            self._reset()
+
+    def sweep(self, pid):
+        """
+        Removes any files left behind by the process `pid`, which must have
+        exited.
+        """
+
+        pattern = os.path.join(tempfile.gettempdir(), _dir_prefix(pid) + '*')
+        for d in glob.glob(pattern):
+            shutil.rmtree(d, True)
+
+    def get(self, source, dest):
+        if self.max_size <= 0:
+            self.store.get(source, dest)
+            return
+
+        while True:
+            with self.lock:
+                d = self._ensure_dir()
+                path = os.path.join(d, source)
+
+                if source in self.entries:
+                    # move to the end, to mark it as most recently used.
+                    self.entries[source] = self.entries.pop(source)
+                    self.hits += 1
+                    self._link(path, dest)
+                    return
+
+                event = self.pending.get(source)
+                if event is None:
+                    event = threading.Event()
+                    self.pending[source] = event
+                    self.misses += 1
+                    break
+
+            # another thread is fetching this file, so wait for it and then
+            # try again. if that fetch failed, then this thread will try to
+            # fetch it.
+            event.wait()
+
+        try:
+            mkdir_p(os.path.dirname(path))
+            self.store.get(source, path)
+            size = os.path.getsize(path)
+
+            with self.lock:
+                self.entries[source] = size
+                self.size += size
+                self._link(path, dest)
+                self._evict()
+
+        finally:
+            with self.lock:
+                del self.pending[source]
+            event.set()
+
+    def _link(self, path, dest):
+        try:
+            os.link(path, dest)
+
+        except OSError as e:
+            # hard links can't cross filesystems, so fall back to a copy.
+            if e.errno == errno.EXDEV:
+                copyfile(path, dest)
+            else:
+                raise
+
+    def _evict(self):
+        while self.size > self.max_size and self.entries:
+            source, size = self.entries.popitem(last=False)
+            self.size -= size
+            os.remove(os.path.join(self.dir, source))
+
+    def stats(self):
+        """
+        Returns a dict of the number of hits and misses so far, and the
+        current number and total size of the files held.
+        """
+
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        files=len(self.entries), size=self.size)
@@ -0,0 +1,79 @@
+from joerd.dispatcher import GroupingDispatcher
+import joerd.queue.sqs as sqs
+import argparse
+import logging
+import time
+
+
+# measures the throughput of the enqueuer's batching and encoding of render
+# jobs, without sending anything to SQS. the jobs are synthetic terrarium
+# tiles, with runs of neighbouring tiles sharing the same sources, as they
+# would when enqueueing a real region.
+
+
+class CountingQueue(object):
+    def __init__(self, max_bytes, max_batch_len):
+        self.max_bytes = max_bytes
+        self.max_batch_len = max_batch_len
+        self.messages = 0
+        self.bytes = 0
+
+    def start_batch(self, max_batch_len):
+        return sqs.Batch(self, self.max_bytes,
+                         min(max_batch_len, self.max_batch_len))
+
+    def send_message(self, msg):
+        self.messages += 1
+        self.bytes += len(msg)
+
+    def flush(self):
+        pass
+
+
+def make_sources(num_source_sets):
+    sources = []
+    for i in range(num_source_sets):
+        srtm = ['srtm/N%02dW%03d.hgt' % (i % 60, 100 + j) for j in range(4)]
+        sources.append([
+            dict(source='srtm', vrts=[srtm]),
+            dict(source='etopo1', vrts=[['etopo1/ETOPO1_Bed_g_geotiff.tif']]),
+        ])
+    return sources
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark batching and encoding of render jobs.')
+    parser.add_argument('--jobs', type=int, default=1000000,
+                        help='Number of render jobs to enqueue.')
+    parser.add_argument('--source-sets', type=int, default=50,
+                        help='Number of distinct sets of sources.')
+    parser.add_argument('--run-length', type=int, default=37,
+                        help='Number of consecutive jobs sharing sources.')
+    parser.add_argument('--job-encoding', default='json',
+                        choices=('json', 'packed'),
+                        help='Encoding to use for batches of render jobs.')
+    args = parser.parse_args()
+
+    logger = logging.getLogger('enqueuer')
+    queue = CountingQueue(256 * 1024, 10)
+    dispatcher = GroupingDispatcher(queue, 1000, logger, 256 * 1024 - 100,
+                                    job_encoding=args.job_encoding)
+    sources = make_sources(args.source_sets)
+
+    start = time.time()
+    for i in xrange(args.jobs):
+        data = dict(type='terrarium', z=15, x=5000 + i % 1000,
+                    y=12000 + i // 1000)
+        s = sources[(i // args.run_length) % len(sources)]
+        dispatcher.append(dict(job='render', data=data, sources=s))
+    dispatcher.flush()
+    elapsed = time.time() - start
+
+    print "%d jobs in %.2fs: %.0f jobs/s, %d messages, %d bytes" \
+        % (args.jobs, elapsed, args.jobs / elapsed, queue.messages,
+           queue.bytes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import joerd.output.normal as normal
+import argparse
+import numpy
+import time
+
+
+# compares the lookup table used to map heights to the normal tiles' table
+# indices against the numpy.vectorize of the scalar function which was used
+# before. the heights are random, over the range of the table and a little
+# beyond.
+
+
+def vectorized(pixels):
+    func = numpy.vectorize(normal._height_mapping_func)
+    return func(pixels).astype(numpy.uint8)
+
+
+def best_of(fn, pixels, repeats):
+    best = None
+    for i in xrange(repeats):
+        start = time.time()
+        result = fn(pixels)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the normal tile height mapping.')
+    parser.add_argument('--size', type=int, default=276,
+                        help='Width and height of the image, in pixels. The '
+                        'default is a normal tile plus its margin.')
+    parser.add_argument('--repeats', type=int, default=10,
+                        help='Number of times to run each, taking the best.')
+    args = parser.parse_args()
+
+    lo = normal.HEIGHT_TABLE[0] - 100
+    hi = normal.HEIGHT_TABLE[-1] + 100
+    pixels = numpy.random.RandomState(1).uniform(
+        lo, hi, (args.size, args.size)).astype(numpy.float32)
+
+    old, old_time = best_of(vectorized, pixels, args.repeats)
+    new, new_time = best_of(normal._height_mapping, pixels, args.repeats)
+    assert (old == new).all(), "Lookup table and scalar function disagree."
+
+    print "%dx%d pixels: vectorize %.2fms, lookup table %.3fms (%.0fx)" \
+        % (args.size, args.size, old_time * 1000, new_time * 1000,
+           old_time / new_time)
+
+
+if __name__ == '__main__':
+    main()
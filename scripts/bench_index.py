@@ -0,0 +1,109 @@
+from joerd.util import BoundingBox
+from joerd.tmpdir import tmpdir
+import joerd.index as index
+import argparse
+import logging
+import pyqtree
+import random
+import yaml
+import time
+import os.path
+
+
+# compares loading and querying a source index through the compiled binary
+# arrays against the YAML list and quadtree which were used before. the index
+# is of synthetic SRTM-style 1x1 degree tiles, e.g: "N37W123.hgt".
+
+
+class Tile(object):
+    def __init__(self, name):
+        lat = int(name[1:3]) * (1 if name[0] == 'N' else -1)
+        lon = int(name[4:7]) * (1 if name[3] == 'E' else -1)
+        self.name = name
+        self.bbox = BoundingBox(lon, lat, lon + 1, lat + 1)
+
+
+def parse_tile(name):
+    return Tile(name)
+
+
+def make_names(num_tiles):
+    names = set()
+    while len(names) < num_tiles:
+        lat = random.randint(-56, 59)
+        lon = random.randint(-180, 179)
+        names.add('%s%02d%s%03d.hgt' % ('N' if lat >= 0 else 'S', abs(lat),
+                                        'E' if lon >= 0 else 'W', abs(lon)))
+    return sorted(names)
+
+
+def load_quadtree(index_file):
+    # the index as it was built before: parse the YAML, then insert every
+    # object into a quadtree.
+    idx = pyqtree.Index(bbox=(-180, -90, 180, 90))
+    with open(index_file, 'r') as f:
+        for name in yaml.load(f):
+            t = parse_tile(name)
+            idx.insert(bbox=t.bbox.bounds, item=t)
+    return idx
+
+
+def timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return result, time.time() - start
+
+
+def time_queries(fn, queries):
+    start = time.time()
+    total = 0
+    for q in queries:
+        total += len(fn(q))
+    return (time.time() - start) / len(queries), total
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark loading and querying source indexes.')
+    parser.add_argument('--tiles', type=int, default=14000,
+                        help='Number of tiles in the index.')
+    parser.add_argument('--queries', type=int, default=1000,
+                        help='Number of bounding box queries to time.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(1)
+    names = make_names(args.tiles)
+    queries = []
+    for i in xrange(args.queries):
+        lon = random.uniform(-180, 178)
+        lat = random.uniform(-60, 58)
+        queries.append(BoundingBox(lon, lat, lon + 1.5, lat + 1.5))
+
+    with tmpdir() as d:
+        index_file = os.path.join(d, 'index.yaml')
+        with open(index_file, 'w') as f:
+            yaml.dump(names, f)
+
+        tree, tree_load = timed(load_quadtree, index_file)
+        bbox = BoundingBox(-180, -90, 180, 90)
+        idx, compile_load = timed(index.create, index_file, bbox,
+                                  parse_tile)
+        idx, load = timed(index.create, index_file, bbox, parse_tile)
+
+        tree_query, tree_total = time_queries(
+            lambda q: tree.intersect(q.bounds), queries)
+        query, total = time_queries(
+            lambda q: index.intersections(idx, q), queries)
+        assert tree_total == total, "Indexes disagree: %d != %d" \
+            % (tree_total, total)
+
+    print "%d tiles, %d queries" % (args.tiles, args.queries)
+    print "YAML + quadtree: load %.3fs, query %.3fms" \
+        % (tree_load, tree_query * 1000)
+    print "compiled arrays: first load (compiling) %.3fs, load %.4fs, " \
+        "query %.3fms" % (compile_load, load, query * 1000)
+
+
+if __name__ == '__main__':
+    main()
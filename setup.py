@@ -38,10 +38,12 @@ setup(name='joerd',
           'geographiclib',
           'boto3',
           'contextlib2',
+          'futures',
       ],
       test_suite='tests',
       tests_require=[
           'httptestserver',
+          'moto',
       ],
       entry_points=dict(
           console_scripts=[
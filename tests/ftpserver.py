@@ -0,0 +1,176 @@
+import SocketServer
+import threading
+import socket
+import time
+
+
+# a minimal, read-only FTP server for tests, serving the files in a dict of
+# path to contents. it understands just enough of the protocol for ftplib and
+# urllib2 to fetch files and list directories in passive mode, and counts the
+# logins, so that tests can check whether sessions are being re-used.
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def _reply(self, line):
+        self.wfile.write(line + "\r\n")
+        self.wfile.flush()
+
+    def _data_conn(self):
+        conn, addr = self.pasv.accept()
+        self.pasv.close()
+        self.pasv = None
+        return conn
+
+    def _path(self, arg):
+        if arg.startswith('/'):
+            path = arg
+        else:
+            path = self.cwd.rstrip('/') + '/' + arg
+        return path
+
+    def handle(self):
+        server = self.server
+        self.cwd = '/'
+        self.pasv = None
+        self.rest = 0
+
+        self._reply("220 test server ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            cmd, _, arg = line.strip().partition(' ')
+            cmd = cmd.upper()
+            with server.lock:
+                server.commands.append(cmd)
+
+            if cmd == 'USER':
+                self._reply("331 password please")
+
+            elif cmd == 'PASS':
+                with server.lock:
+                    server.logins += 1
+                self._reply("230 logged in")
+
+            elif cmd in ('TYPE', 'NOOP'):
+                self._reply("200 ok")
+
+            elif cmd == 'CWD':
+                path = self._path(arg)
+                if any(f.startswith(path.rstrip('/') + '/')
+                       for f in server.files):
+                    self.cwd = path
+                    self._reply("250 ok")
+                else:
+                    self._reply("550 no such directory")
+
+            elif cmd == 'PWD':
+                self._reply('257 "%s"' % self.cwd)
+
+            elif cmd == 'PASV':
+                self.pasv = socket.socket()
+                self.pasv.bind(('127.0.0.1', 0))
+                self.pasv.listen(1)
+                port = self.pasv.getsockname()[1]
+                self._reply("227 passive (127,0,0,1,%d,%d)"
+                            % (port >> 8, port & 0xff))
+
+            elif cmd == 'SIZE':
+                data = server.files.get(self._path(arg))
+                if data is None:
+                    self._reply("550 no such file")
+                else:
+                    self._reply("213 %d" % len(data))
+
+            elif cmd == 'MDTM':
+                mtime = server.mtimes.get(self._path(arg))
+                if mtime is None:
+                    self._reply("550 no such file")
+                else:
+                    self._reply("213 " + time.strftime(
+                        "%Y%m%d%H%M%S", time.gmtime(mtime)))
+
+            elif cmd == 'REST':
+                self.rest = int(arg)
+                self._reply("350 restarting at %d" % self.rest)
+
+            elif cmd == 'RETR':
+                data = server.files.get(self._path(arg))
+                if data is None:
+                    self._reply("550 no such file")
+                    continue
+                rest, self.rest = self.rest, 0
+                limit = server.max_len
+                end = len(data) if limit is None else min(len(data),
+                                                          rest + limit)
+                self._reply("150 opening data connection (%d bytes)"
+                            % (len(data) - rest))
+                conn = self._data_conn()
+                conn.sendall(data[rest:end])
+                conn.close()
+                if end < len(data):
+                    self._reply("426 transfer aborted")
+                else:
+                    self._reply("226 transfer complete")
+
+            elif cmd in ('NLST', 'LIST'):
+                prefix = self._path(arg) if arg else self.cwd
+                prefix = prefix.rstrip('/') + '/'
+                names = sorted(f[len(prefix):] for f in server.files
+                               if f.startswith(prefix))
+                self._reply("150 here comes the listing")
+                conn = self._data_conn()
+                conn.sendall("".join(n + "\r\n" for n in names))
+                conn.close()
+                self._reply("226 listing sent")
+
+            elif cmd == 'QUIT':
+                self._reply("221 bye")
+                break
+
+            else:
+                self._reply("502 not implemented")
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FTPServer(object):
+    """
+    Serves `files`, a dict of absolute path to contents, on a local port
+    while used as a context manager. If `max_len` is set, then each transfer
+    is cut off after that many bytes, as though the connection dropped.
+    """
+
+    def __init__(self, files, mtimes=None, max_len=None):
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.files = files
+        self.server.mtimes = mtimes or {}
+        self.server.max_len = max_len
+        self.server.logins = 0
+        self.server.commands = []
+        self.server.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def logins(self):
+        return self.server.logins
+
+    @property
+    def commands(self):
+        return self.server.commands
+
+    def url(self, path):
+        return "ftp://127.0.0.1:%d%s" % (self.server.server_address[1], path)
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
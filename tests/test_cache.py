@@ -0,0 +1,74 @@
+import unittest
+import joerd.store.cache as cache
+from joerd.tmpdir import tmpdir
+import os
+import os.path
+import time
+
+
+class _CountingStore(object):
+    """
+    Fake store which makes files of a given size, and counts how many times
+    each has been fetched.
+    """
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.fetches = {}
+
+    def get(self, source, dest):
+        self.fetches[source] = self.fetches.get(source, 0) + 1
+        with open(dest, 'wb') as fh:
+            fh.write('x' * self.sizes[source])
+
+
+class TestCacheStore(unittest.TestCase):
+
+    def _store(self, cache_dir, sizes, max_size):
+        s = cache.CacheStore(dict(
+            store=dict(type='file'), cache_dir=cache_dir, max_size=max_size))
+        s.store = _CountingStore(sizes)
+        return s
+
+    def _get(self, store, d, source):
+        dest = os.path.join(d, 'out')
+        if os.path.exists(dest):
+            os.remove(dest)
+        store.get(source, dest)
+        self.assertEqual(store.store.sizes[source], os.path.getsize(dest))
+
+    def test_hits(self):
+        with tmpdir() as c, tmpdir() as d:
+            s = self._store(c, {'srtm/a.hgt': 10}, None)
+            for i in range(0, 3):
+                self._get(s, d, 'srtm/a.hgt')
+            self.assertEqual({'srtm/a.hgt': 1}, s.store.fetches)
+
+    def test_lru_eviction(self):
+        with tmpdir() as c, tmpdir() as d:
+            s = self._store(c, {'a': 40, 'b': 40, 'c': 40}, 100)
+            self._get(s, d, 'a')
+            self._get(s, d, 'b')
+
+            # make 'a' more recently used than 'b', then adding 'c' should
+            # push out 'b'.
+            past = time.time() - 10
+            os.utime(os.path.join(c, 'b'), (past, past))
+            self._get(s, d, 'a')
+            self._get(s, d, 'c')
+
+            self.assertTrue(os.path.exists(os.path.join(c, 'a')))
+            self.assertFalse(os.path.exists(os.path.join(c, 'b')))
+            self.assertTrue(os.path.exists(os.path.join(c, 'c')))
+
+            self._get(s, d, 'b')
+            self.assertEqual({'a': 1, 'b': 2, 'c': 1}, s.store.fetches)
+
+    def test_too_large(self):
+        # files larger than the whole cache are passed straight through.
+        with tmpdir() as c, tmpdir() as d:
+            s = self._store(c, {'big': 200}, 100)
+            for i in range(0, 2):
+                self._get(s, d, 'big')
+                self.assertEqual({'big': i + 1}, s.store.fetches)
+            self.assertFalse(os.path.exists(os.path.join(c, 'big')))
@@ -0,0 +1,173 @@
+import unittest
+import joerd.composite as composite
+from contextlib2 import contextmanager
+import logging
+import numpy
+
+
+NODATA = -32768.0
+
+
+class _Band(object):
+    def __init__(self, data):
+        self.data = data
+        self.DataType = composite.gdal.GDT_Float32
+        self.nodata = None
+
+    def GetNoDataValue(self):
+        return self.nodata
+
+    def SetNoDataValue(self, nodata):
+        self.nodata = nodata
+
+    def Fill(self, value):
+        self.data.fill(value)
+        return composite.gdal.CPLE_None
+
+    def ReadAsArray(self, x, y, w, h, buf_obj=None):
+        buf_obj[:] = self.data[y:y+h, x:x+w]
+        return buf_obj
+
+    def WriteArray(self, data):
+        self.data[:] = data
+        return composite.gdal.CPLE_None
+
+
+class _Dataset(object):
+    """
+    Just enough of a GDAL dataset to composite into.
+    """
+
+    def __init__(self, x_size, y_size):
+        self.RasterXSize = x_size
+        self.RasterYSize = y_size
+        self.band = _Band(numpy.zeros((y_size, x_size), numpy.float32))
+
+    def GetRasterBand(self, n):
+        return self.band
+
+    def GetGeoTransform(self):
+        return (0, 1, 0, 0, 0, -1)
+
+    def SetGeoTransform(self, gt):
+        pass
+
+    def GetProjection(self):
+        return ''
+
+    def SetProjection(self, proj):
+        pass
+
+
+class _Driver(object):
+    def Create(self, name, x_size, y_size, count, data_type):
+        return _Dataset(x_size, y_size)
+
+
+class _Gdal(object):
+    GDT_Float32 = composite.gdal.GDT_Float32
+    CPLE_None = composite.gdal.CPLE_None
+
+    def GetDriverByName(self, name):
+        return _Driver()
+
+
+class _Source(object):
+    """
+    A layer, made of several rasters which are "reprojected" by copying in
+    their data.
+    """
+
+    def __init__(self, rasters):
+        self.rasters = rasters
+
+    def vrts_for(self, tile):
+        return [[r] for r in self.rasters]
+
+    def filter_type(self, src_res, dst_res):
+        return None
+
+
+class _Tile(object):
+    def __init__(self, sources):
+        self.sources = sources
+
+
+def _paint_in_order(layers, shape):
+    """
+    The original way of compositing: paint each raster of each layer over
+    the last, in order, except where it is nodata.
+    """
+
+    dst = numpy.full(shape, NODATA, numpy.float32)
+    for rasters in layers:
+        for data in rasters:
+            dst = numpy.where(data != NODATA, data, dst)
+    return dst
+
+
+class TestComposite(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger('composite')
+        self.orig = (composite.gdal, composite._mosaic, composite._mk_image)
+        self.used = []
+
+        @contextmanager
+        def _mosaic(source, rasters):
+            self.used.append(rasters[0])
+            yield rasters[0]
+
+        def _mk_image(src_data, dst_ds, filter_type):
+            dst_ds.GetRasterBand(1).WriteArray(src_data)
+
+        composite.gdal = _Gdal()
+        composite._mosaic = _mosaic
+        composite._mk_image = _mk_image
+
+    def tearDown(self):
+        composite.gdal, composite._mosaic, composite._mk_image = self.orig
+
+    def _compose(self, layers, shape):
+        tile = _Tile([_Source(rasters) for rasters in layers])
+        dst = _Dataset(shape[1], shape[0])
+        dst.band.SetNoDataValue(NODATA)
+        composite.compose(tile, dst, self.logger, 1.0)
+        return dst.band.data
+
+    def test_same_as_painting_in_order(self):
+        # overlapping layers, each with rasters which have holes of nodata.
+        rng = numpy.random.RandomState(1)
+        shape = (16, 20)
+        layers = []
+        for i in range(0, 3):
+            rasters = []
+            for j in range(0, 2):
+                data = rng.uniform(-100, 100, shape).astype(numpy.float32)
+                data[rng.uniform(size=shape) < 0.6] = NODATA
+                rasters.append(data)
+            layers.append(rasters)
+
+        expected = _paint_in_order(layers, shape)
+        result = self._compose(layers, shape)
+        self.assertEqual(expected.tolist(), result.tolist())
+        # there are still holes, so every raster was used.
+        self.assertEqual(6, len(self.used))
+
+    def test_skips_covered(self):
+        # once the detailed layers cover the tile, the others aren't used.
+        shape = (8, 8)
+        full = numpy.full(shape, 3, numpy.float32)
+        left = numpy.full(shape, 2, numpy.float32)
+        left[:, 4:] = NODATA
+        right = numpy.full(shape, 1, numpy.float32)
+        right[:, :4] = NODATA
+        lower = numpy.full(shape, 0, numpy.float32)
+
+        result = self._compose([[lower], [full], [right, left]], shape)
+
+        expected = numpy.where(left != NODATA, left, right)
+        self.assertEqual(expected.tolist(), result.tolist())
+        self.assertEqual(2, len(self.used))
+        self.assertTrue(self.used[0] is left)
+        self.assertTrue(self.used[1] is right)
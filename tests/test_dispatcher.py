@@ -5,6 +5,7 @@ from joerd.util import BoundingBox
 import joerd.dispatcher as dispatcher
 import sys
 import logging
+import random
 
 
 class TestDispatcher(unittest.TestCase):
@@ -131,3 +132,136 @@ class TestDispatcher(unittest.TestCase):
 
         d.flush()
         self.assertEqual(queue.expected, set([]))
+
+    def test_group_dispatch_bounded(self):
+        class Batch(object):
+            def __init__(self, queue):
+                self.queue = queue
+
+            def append(self, job):
+                self.queue.jobs.append(job)
+
+            def flush(self):
+                pass
+
+        class Queue(object):
+            def __init__(self):
+                self.jobs = []
+
+            def start_batch(self, max_batch_len):
+                return Batch(self)
+
+            def flush(self):
+                pass
+
+        logger = logging.getLogger('process')
+        queue = Queue()
+        d = dispatcher.GroupingDispatcher(queue, 10, logger, 100000,
+                                          max_open_batches=2)
+
+        # three different source sets, used in turn, so that each one gets
+        # flushed before it's used again.
+        expected = {}
+        for i in range(30):
+            sources = [dict(source='s', vrts=[['file%d' % (i % 3)]])]
+            d.append(dict(job='render', sources=sources, data=dict(i=i)))
+            expected.setdefault(i % 3, []).append(i)
+            self.assertTrue(len(d.batches) <= 2)
+
+        d.flush()
+        self.assertEqual(0, len(d.batches))
+
+        received = {}
+        for job in queue.jobs:
+            self.assertEqual('renderbatch', job['job'])
+            k = int(job['sources'][0]['vrts'][0][0][len('file'):])
+            received.setdefault(k, []).extend(j['i'] for j in job['data'])
+        self.assertEqual(expected, received)
+
+    def test_encoded_batches(self):
+        import joerd.queue.sqs as sqs
+        import json
+
+        class Queue(object):
+            def __init__(self):
+                self.messages = []
+
+            def start_batch(self, max_batch_len):
+                return sqs.Batch(self, 2000, max_batch_len)
+
+            def send_message(self, msg):
+                self.messages.append(msg)
+
+            def flush(self):
+                pass
+
+        logger = logging.getLogger('process')
+        queue = Queue()
+        d = dispatcher.GroupingDispatcher(queue, 10, logger, 500)
+
+        expected = {}
+        for i in range(100):
+            sources = [dict(source='s', vrts=[['file%d' % (i % 2)]])]
+            data = dict(type='terrarium', z=10, x=i, y=i * 2)
+            d.append(dict(job='render', sources=sources, data=data))
+            expected.setdefault(i % 2, []).append(data)
+
+        d.flush()
+
+        received = {}
+        for msg in queue.messages:
+            self.assertTrue(len(msg) <= 2000)
+            for job in json.loads(msg):
+                self.assertEqual('renderbatch', job['job'])
+                self.assertTrue(len(json.dumps(job, separators=(',', ':')))
+                                <= 500)
+                k = int(job['sources'][0]['vrts'][0][0][len('file'):])
+                received.setdefault(k, []).extend(job['data'])
+        self.assertEqual(expected, received)
+
+    def test_packed_batches(self):
+        import joerd.job_codec as job_codec
+
+        class Batch(object):
+            def __init__(self, queue):
+                self.queue = queue
+
+            def append(self, job):
+                self.queue.jobs.append(job)
+
+            def flush(self):
+                pass
+
+        class Queue(object):
+            def __init__(self):
+                self.jobs = []
+
+            def start_batch(self, max_batch_len):
+                return Batch(self)
+
+            def flush(self):
+                pass
+
+        logger = logging.getLogger('process')
+        queue = Queue()
+        # small limit, so that the packed jobs have to be split.
+        d = dispatcher.GroupingDispatcher(queue, 10, logger, 400,
+                                          job_encoding='packed')
+
+        sources = [dict(source='s', vrts=[['file']])]
+        expected = set()
+        rnd = random.Random(1234)
+        for i in range(300):
+            x, y = rnd.randint(0, 1023), rnd.randint(0, 1023)
+            d.append(dict(job='render', sources=sources,
+                          data=dict(type='terrarium', z=10, x=x, y=y)))
+            expected.add((x, y))
+        d.flush()
+
+        received = set()
+        self.assertTrue(len(queue.jobs) > 1)
+        for job in queue.jobs:
+            self.assertTrue(len(job.json) <= 400)
+            decoded = job_codec.decode_render_batch(job)
+            received.update((t['x'], t['y']) for t in decoded['data'])
+        self.assertEqual(expected, received)
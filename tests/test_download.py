@@ -8,7 +8,12 @@ except ImportError:
     from http import server as http
 import contextlib
 from httptestserver import Server
+from tests.ftpserver import FTPServer
+import socket
+import gzip
 import re
+import time
+from StringIO import StringIO
 
 
 # simple handler which does what most HTTP servers (should) do; responds with
@@ -80,6 +85,115 @@ class _DroppingHandler(http.BaseHTTPRequestHandler):
             self.wfile.write(self.value[byte_range[0]:byte_range[1]+1])
 
 
+# handler for a server which supports HEAD and byte Range requests, like most
+# static file servers. it records the ranges requested, and can drop the
+# connection after sending `max_len` bytes of each response.
+class _RangeHandler(http.BaseHTTPRequestHandler):
+    def __init__(self, value, ranges, max_len, *args):
+        self.value = value
+        self.ranges = ranges
+        self.max_len = max_len
+        http.BaseHTTPRequestHandler.__init__(self, *args)
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', len(self.value))
+        self.end_headers()
+
+    def do_GET(self):
+        m = re.match('bytes=([0-9]+)-([0-9]+)', self.headers.get('Range', ''))
+        if not m:
+            self.do_HEAD()
+            self.wfile.write(self.value)
+            return
+
+        start, end = int(m.group(1)), int(m.group(2))
+        self.ranges.append((start, end))
+        self.send_response(206)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', end - start + 1)
+        self.send_header('Content-Range', 'bytes %d-%d/%d'
+                         % (start, end, len(self.value)))
+        self.end_headers()
+        self.wfile.write(self.value[start:min(end + 1, start + self.max_len)])
+
+
+# handler which serves Range requests slowly, a piece at a time, except for
+# the range starting at `bad_start`, which it replies to at once with the
+# whole file, as though it didn't support ranges after all. records how many
+# pieces of each range it sent.
+class _SlowRangeHandler(_RangeHandler):
+    def __init__(self, value, bad_start, pieces, *args):
+        self.bad_start = bad_start
+        self.pieces = pieces
+        _RangeHandler.__init__(self, value, [], len(value), *args)
+
+    def do_GET(self):
+        m = re.match('bytes=([0-9]+)-([0-9]+)', self.headers.get('Range', ''))
+        if not m or int(m.group(1)) == self.bad_start:
+            self.send_response(200)
+            self.send_header('Content-Length', len(self.value))
+            self.end_headers()
+            self.wfile.write(self.value)
+            return
+
+        start, end = int(m.group(1)), int(m.group(2))
+        self.send_response(206)
+        self.send_header('Content-Length', end - start + 1)
+        self.send_header('Content-Range', 'bytes %d-%d/%d'
+                         % (start, end, len(self.value)))
+        self.end_headers()
+
+        self.pieces[start] = 0
+        try:
+            for pos in xrange(start, end + 1, 10):
+                self.wfile.write(self.value[pos:min(pos + 10, end + 1)])
+                self.wfile.flush()
+                self.pieces[start] += 1
+                time.sleep(0.05)
+        except socket.error:
+            pass
+
+
+# handler which compresses the response whenever the client says that it
+# accepts gzip encoding, as many servers do.
+class _GzipHandler(http.BaseHTTPRequestHandler):
+    def __init__(self, value, *args):
+        self.value = value
+        http.BaseHTTPRequestHandler.__init__(self, *args)
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        if 'gzip' not in self.headers.get('Accept-Encoding', ''):
+            return None, self.value
+
+        buf = StringIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+            f.write(self.value)
+        return 'gzip', buf.getvalue()
+
+    def _headers(self):
+        encoding, body = self._body()
+        self.send_response(200)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        return body
+
+    def do_HEAD(self):
+        self._headers()
+
+    def do_GET(self):
+        self.wfile.write(self._headers())
+
+
 class _MaxLenFunc:
     def __init__(self, init_len, incr_len):
         self.length = init_len
@@ -181,3 +295,153 @@ class TestDownload(unittest.TestCase):
                 with download.get(server.url('/'), dict(verifier=_verifier,
                                                         tries=10)) as data:
                     data.read()
+
+    def test_download_segmented(self):
+        # Test that a file is downloaded as several concurrent byte ranges
+        # when the server supports them.
+        value = "".join(chr(i % 256) for i in range(10000))
+        ranges = []
+
+        def _handler(*args):
+            return _RangeHandler(value, ranges, len(value), *args)
+
+        def _verifier(filelike):
+            return filelike.read() == value
+
+        with _test_http_server(_handler) as server:
+            with download.get(server.url('/'), dict(
+                    verifier=_verifier, tries=1, segments=4,
+                    min_segment_size=1000)) as data:
+                self.assertEqual(value, data.read())
+
+        self.assertEqual([(0, 2499), (2500, 4999), (5000, 7499),
+                          (7500, 9999)], sorted(ranges))
+
+    def test_download_segmented_restart(self):
+        # Test that each segment resumes where it left off when the server
+        # drops the connection part-way through.
+        value = "".join(chr(i % 256) for i in range(10000))
+        ranges = []
+
+        def _handler(*args):
+            return _RangeHandler(value, ranges, 1000, *args)
+
+        def _verifier(filelike):
+            return filelike.read() == value
+
+        with _test_http_server(_handler) as server:
+            with download.get(server.url('/'), dict(
+                    verifier=_verifier, tries=3, segments=4,
+                    min_segment_size=1000)) as data:
+                self.assertEqual(value, data.read())
+
+        self.assertEqual(12, len(ranges))
+        self.assertTrue((1000, 2499) in ranges)
+
+    def test_download_segmented_falls_back(self):
+        # Test that servers without HEAD or Range support are downloaded as a
+        # single stream, as before.
+        value = "Some random string here." * 100
+
+        def _handler(*args):
+            return _SimpleHandler(value, *args)
+
+        with _test_http_server(_handler) as server:
+            with download.get(server.url('/'), dict(
+                    tries=1, segments=4, min_segment_size=10)) as data:
+                self.assertEqual(value, data.read())
+
+    def test_download_segmented_fails_fast(self):
+        # Test that when a later segment finds that the server doesn't honour
+        # Range requests, the earlier segments give up part-way through
+        # rather than fetching the whole of their ranges first.
+        value = "0123456789" * 60
+        pieces = {}
+
+        def _handler(*args):
+            return _SlowRangeHandler(value, 400, pieces, *args)
+
+        # read the segments a piece at a time, so that they can stop between
+        # pieces.
+        orig = download._CHUNK_SIZE
+        try:
+            download._CHUNK_SIZE = 10
+            with _test_http_server(_handler) as server:
+                start = time.time()
+                with download.get(server.url('/'), dict(
+                        tries=1, segments=3, min_segment_size=10)) as data:
+                    elapsed = time.time() - start
+                    self.assertEqual(value, data.read())
+
+        finally:
+            download._CHUNK_SIZE = orig
+
+        # each good range is 20 pieces, which would take a second to send.
+        self.assertEqual([0, 200], sorted(pieces.keys()))
+        self.assertTrue(elapsed < 0.5, "Took %f seconds" % elapsed)
+
+    def test_download_keeps_extension(self):
+        # Test that the downloaded file has the same extensions as the URL,
+        # which GDAL needs to read straight out of archives.
+        value = "Some random string here."
+
+        def _handler(*args):
+            return _SimpleHandler(value, *args)
+
+        with _test_http_server(_handler) as server:
+            with download.get(server.url('/data/lake.geotiff.tar.gz?x=1'),
+                              dict(tries=1)) as data:
+                self.assertTrue(data.name.endswith('.geotiff.tar.gz'))
+                self.assertEqual(value, data.read())
+
+            with download.get(server.url('/'), dict(tries=1)) as data:
+                self.assertEqual(value, data.read())
+
+    def test_download_pooled_not_encoded(self):
+        # Test that downloads over pooled connections get the file itself,
+        # and not a compressed encoding of it.
+        value = "Some random string here." * 100
+
+        def _handler(*args):
+            return _GzipHandler(value, *args)
+
+        with _test_http_server(_handler) as server:
+            connections = download.Connections()
+            try:
+                with download.get(server.url('/'), dict(
+                        tries=1, connections=connections)) as data:
+                    self.assertEqual(value, data.read())
+            finally:
+                connections.close()
+
+    def test_download_ftp_resume(self):
+        # Test that an interrupted FTP transfer is resumed from where it left
+        # off with REST, on the same session.
+        value = "Some random string here." * 100
+        files = {'/data/file.zip': value}
+
+        with FTPServer(files, max_len=1000) as ftp:
+            with download.get(ftp.url('/data/file.zip'), dict(
+                    tries=5)) as data:
+                self.assertEqual(value, data.read())
+
+            self.assertEqual(1, ftp.logins)
+            self.assertEqual(3, ftp.commands.count('RETR'))
+            self.assertEqual(2, ftp.commands.count('REST'))
+
+    def test_ftp_pool_replaces_stale_sessions(self):
+        # Test that a pooled session which the server has closed is replaced
+        # with a new one, rather than failing the transfer.
+        files = {'/a.zip': 'a' * 100}
+        pool = download.FTPPool()
+
+        with FTPServer(files) as ftp:
+            netloc = ftp.url('')[len('ftp://'):]
+            with pool.session(netloc) as session:
+                session.sock.shutdown(socket.SHUT_RDWR)
+
+            with pool.session(netloc) as session:
+                self.assertEqual(100, session.size('/a.zip'))
+
+            self.assertEqual(2, ftp.logins)
+            pool.close()
@@ -0,0 +1,273 @@
+import unittest
+import joerd.download as download
+from joerd.downloader import Downloader
+from tests.ftpserver import FTPServer
+import BaseHTTPServer as http
+from httptestserver import Server
+import contextlib
+import threading
+import time
+import re
+
+
+# HTTP/1.1 handler which keeps connections alive, and records which client
+# connection each request came from and how many requests are running at
+# once.
+class _KeepAliveHandler(http.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def __init__(self, stats, delay, *args):
+        self.stats = stats
+        self.delay = delay
+        http.BaseHTTPRequestHandler.__init__(self, *args)
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        with self.stats.lock:
+            self.stats.clients.add(self.client_address)
+            self.stats.requests += 1
+            self.stats.running += 1
+            self.stats.max_running = max(self.stats.running,
+                                         self.stats.max_running)
+
+        time.sleep(self.delay)
+
+        with self.stats.lock:
+            self.stats.running -= 1
+
+        if self.path.startswith('/missing'):
+            self.send_response(404)
+            self.send_header('Content-Length', 0)
+            self.end_headers()
+            return
+
+        value = 'contents of ' + self.path
+        self.send_response(200)
+        self.send_header('Content-Length', len(value))
+        self.end_headers()
+        self.wfile.write(value)
+
+
+# keep-alive handler which also accepts Range requests, and records the
+# largest number of connections which were open at once.
+class _RangeHandler(_KeepAliveHandler):
+
+    def handle(self):
+        with self.stats.lock:
+            self.stats.clients.add(self.client_address)
+            self.stats.connections += 1
+            self.stats.max_connections = max(self.stats.connections,
+                                             self.stats.max_connections)
+        try:
+            _KeepAliveHandler.handle(self)
+        finally:
+            with self.stats.lock:
+                self.stats.connections -= 1
+
+    def _value(self):
+        return ('contents of ' + self.path) * 10
+
+    def do_HEAD(self):
+        time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', len(self._value()))
+        self.end_headers()
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        value = self._value()
+        m = re.match('bytes=([0-9]+)-([0-9]+)', self.headers.get('Range', ''))
+        start, end = (int(m.group(1)), int(m.group(2))) if m \
+            else (0, len(value) - 1)
+
+        self.send_response(206 if m else 200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', end - start + 1)
+        if m:
+            self.send_header('Content-Range', 'bytes %d-%d/%d'
+                             % (start, end, len(value)))
+        self.end_headers()
+        self.wfile.write(value[start:end+1])
+
+
+class _Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.requests = 0
+        self.running = 0
+        self.max_running = 0
+        self.connections = 0
+        self.max_connections = 0
+
+
+# stands in for the download objects from a source, "unpacking" the file
+# into a dict.
+class _Download(object):
+    def __init__(self, url, opts=None):
+        self.url = url
+        self.opts = opts or {}
+
+    def urls(self):
+        return [self.url]
+
+    def options(self):
+        return self.opts
+
+    def verifier(self):
+        return None
+
+    def output_file(self):
+        return self.url
+
+    def unpack(self, store, tmp):
+        store.files[self.url] = tmp.read()
+
+
+class _Store(object):
+    def __init__(self):
+        self.files = {}
+
+    def exists(self, name):
+        return name in self.files
+
+
+def _run(downloader, downloads, store, **kwargs):
+    try:
+        downloader.run(downloads, store, **kwargs)
+    finally:
+        downloader.close()
+
+
+@contextlib.contextmanager
+def _server(stats, delay=0, handler_class=_KeepAliveHandler):
+    def _handler(*args):
+        return handler_class(stats, delay, *args)
+
+    server = Server('127.0.0.1', 0, 'http', _handler)
+    # kept-alive connections hold their handler threads open, which mustn't
+    # stop the tests from exiting.
+    server.daemon_threads = True
+    server.start()
+    yield server
+
+
+class TestDownloader(unittest.TestCase):
+
+    def test_http_keep_alive(self):
+        stats = _Stats()
+        with _server(stats) as server:
+            connections = download.Connections()
+            options = dict(connections=connections)
+            for name in ('/a', '/b', '/c'):
+                with download.get(server.url(name), options) as tmp:
+                    self.assertEqual('contents of ' + name, tmp.read())
+            connections.close()
+
+        # all the files came over the same connection.
+        self.assertEqual(1, len(stats.clients))
+
+    def test_ftp_session_reuse(self):
+        files = {'/data/a.zip': 'a' * 1000, '/data/b.zip': 'b' * 1000}
+        with FTPServer(files) as ftp:
+            connections = download.Connections()
+            options = dict(connections=connections)
+            for name in sorted(files.keys()):
+                with download.get(ftp.url(name), options) as tmp:
+                    self.assertEqual(files[name], tmp.read())
+            connections.close()
+
+            self.assertEqual(1, ftp.logins)
+
+    def test_host_limit(self):
+        stats = _Stats()
+        store = _Store()
+        with _server(stats, delay=0.1) as server:
+            urls = [server.url('/%d' % i) for i in range(6)]
+            _run(Downloader(4, 2), [_Download(u) for u in urls], store)
+
+        self.assertEqual(sorted(urls), sorted(store.files.keys()))
+        self.assertEqual(2, stats.max_running)
+
+    def test_source_host_limit(self):
+        stats = _Stats()
+        store = _Store()
+        opts = dict(num_download_threads=3)
+        with _server(stats, delay=0.1) as server:
+            urls = [server.url('/%d' % i) for i in range(6)]
+            _run(Downloader(6, 1), [_Download(u, opts) for u in urls],
+                 store)
+
+        self.assertEqual(3, stats.max_running)
+
+    def test_failure_finishes_others(self):
+        stats = _Stats()
+        store = _Store()
+        with _server(stats) as server:
+            good = [server.url('/%d' % i) for i in range(3)]
+            downloads = [_Download(u, dict(tries=1)) for u in good]
+            downloads.insert(1, _Download(server.url('/missing'),
+                                          dict(tries=1)))
+
+            with self.assertRaises(RuntimeError):
+                _run(Downloader(2, 2), downloads, store)
+
+        self.assertEqual(sorted(good), sorted(store.files.keys()))
+
+    def test_host_limit_counts_segments(self):
+        # each segment of a segmented download is a connection to the server,
+        # and counts against its limit.
+        stats = _Stats()
+        store = _Store()
+        opts = dict(segments=4, min_segment_size=10)
+        with _server(stats, delay=0.05, handler_class=_RangeHandler) \
+                as server:
+            urls = [server.url('/%d' % i) for i in range(4)]
+            _run(Downloader(4, 2), [_Download(u, opts) for u in urls], store)
+
+        for u in urls:
+            path = u[u.index('/', len('http://')):]
+            self.assertEqual(('contents of ' + path) * 10, store.files[u])
+        self.assertEqual(2, stats.max_connections)
+        # and the connections are re-used for each segment, rather than
+        # reconnecting.
+        self.assertEqual(2, len(stats.clients))
+
+    def test_skip_existing(self):
+        stats = _Stats()
+        store = _Store()
+        with _server(stats) as server:
+            urls = [server.url('/%d' % i) for i in range(3)]
+            store.files[urls[1]] = 'already downloaded'
+            _run(Downloader(2, 2), [_Download(u) for u in urls], store,
+                 skip_existing=True)
+
+            self.assertEqual('already downloaded', store.files[urls[1]])
+            self.assertEqual(sorted(urls), sorted(store.files.keys()))
+
+            # a batch which is entirely in the store does nothing.
+            _run(Downloader(2, 2), [_Download(u) for u in urls], store,
+                 skip_existing=True)
+
+        self.assertEqual(2, stats.requests)
+
+    def test_source_host_limits_independent(self):
+        # a source's limit isn't capped by another source's limit for the
+        # same host, which was used first.
+        stats = _Stats()
+        store = _Store()
+        downloader = Downloader(6, 1)
+        opts = dict(num_download_threads=3)
+        try:
+            with _server(stats, delay=0.1) as server:
+                downloader.run([_Download(server.url('/first'))], store)
+                urls = [server.url('/%d' % i) for i in range(6)]
+                downloader.run([_Download(u, opts) for u in urls], store)
+
+        finally:
+            downloader.close()
+
+        self.assertEqual(3, stats.max_running)
@@ -0,0 +1,182 @@
+import unittest
+import joerd.index as index
+import joerd.mercator as mercator
+from joerd.util import BoundingBox
+from joerd.tmpdir import tmpdir
+import numpy
+import yaml
+import os
+import os.path
+import re
+
+
+_NAME_PATTERN = re.compile('^tile_(-?[0-9]+)_(-?[0-9]+)$')
+
+
+class _Tile(object):
+    def __init__(self, name, x, y):
+        self.name = name
+        self.bbox = BoundingBox(x, y, x + 1, y + 1)
+
+    def latlon_bbox(self):
+        return self.bbox
+
+
+def _parse_tile(name, calls):
+    calls.append(name)
+    m = _NAME_PATTERN.match(name)
+    if not m:
+        return None
+    return _Tile(name, int(m.group(1)), int(m.group(2)))
+
+
+def _mercator_tile(z, x, y):
+    m = mercator.Mercator()
+    return mercator.MercatorTile(z, x, y, 256, m.latlon_bbox(z, x, y),
+                                 m.mercator_bbox(z, x, y))
+
+
+class TestIndex(unittest.TestCase):
+
+    def _write_index(self, d, names):
+        index_file = os.path.join(d, 'index.yaml')
+        with open(index_file, 'w') as f:
+            f.write(yaml.dump(names))
+        return index_file
+
+    def test_intersections(self):
+        names = ['tile_%d_%d' % (x, y)
+                 for x in range(-10, 10) for y in range(-5, 5)]
+        names.append('not_a_tile')
+
+        with tmpdir() as d:
+            index_file = self._write_index(d, names)
+            calls = []
+            idx = index.create(index_file, (-180, -90, 180, 90),
+                               _parse_tile, calls)
+            self.assertEqual(200, len(idx))
+
+            for query in [(0.5, 0.5, 0.6, 0.6), (0, 0, 1, 1),
+                          (-20, -20, -9.5, 20), (50, 50, 60, 60)]:
+                bbox = BoundingBox(*query)
+                expected = set(
+                    n for n in names if n.startswith('tile_') and
+                    _parse_tile(n, []).bbox.intersects(bbox))
+                actual = set(t.name for t in index.intersections(idx, bbox))
+                self.assertEqual(expected, actual)
+
+    def test_compiled_reused(self):
+        with tmpdir() as d:
+            index_file = self._write_index(d, ['tile_0_0', 'tile_1_1'])
+            index.create(index_file, None, _parse_tile, [])
+
+            # the second time, the compiled index should be used, and so
+            # nothing needs parsing until it's returned from a query.
+            calls = []
+            idx = index.create(index_file, None, _parse_tile, calls)
+            self.assertEqual([], calls)
+            tiles = index.intersections(idx, BoundingBox(0, 0, 0.5, 0.5))
+            self.assertEqual(['tile_0_0'], [t.name for t in tiles])
+            self.assertEqual(['tile_0_0'], calls)
+
+            # if the YAML changes, then the index is re-compiled.
+            os.utime(index_file, (0, 0))
+            for suffix in ('.bbox.npy', '.names.npy'):
+                os.utime(index_file + suffix, (0, 0))
+            self._write_index(d, ['tile_5_5'])
+            idx = index.create(index_file, None, _parse_tile, [])
+            self.assertEqual(1, len(idx))
+
+    def test_names(self):
+        with tmpdir() as d:
+            index_file = self._write_index(d, ['a', 'bb', 'ccc'])
+            self.assertEqual(['a', 'bb', 'ccc'], index.names(index_file))
+            os.remove(index_file)
+            self.assertEqual(['a', 'bb', 'ccc'], index.names(index_file))
+
+    def test_update_in_place(self):
+        with tmpdir() as d:
+            index_file = self._write_index(d, ['tile_0_0', 'tile_1_1', 'x'])
+            index.create(index_file, None, _parse_tile, [])
+
+            # only the new names are parsed, and the compiled index has the
+            # same contents as if it had been compiled from scratch.
+            calls = []
+            self.assertEqual((2, 1), index.update(
+                index_file, ['tile_1_1', 'x', 'tile_2_2', 'y'], _parse_tile,
+                calls))
+            self.assertEqual(['tile_2_2', 'y'], calls)
+
+            idx = index.create(index_file, None, _parse_tile, calls)
+            self.assertEqual(['tile_2_2', 'y'], calls)
+            self.assertEqual(['tile_1_1', 'tile_2_2'],
+                             sorted(str(n) for n in idx.names))
+            tiles = index.intersections(idx, BoundingBox(2.2, 2.2, 2.5, 2.5))
+            self.assertEqual(['tile_2_2'], [t.name for t in tiles])
+            self.assertEqual(['tile_1_1', 'x', 'tile_2_2', 'y'],
+                             index.names(index_file))
+
+            # an unchanged list doesn't touch the files.
+            os.utime(index_file, (0, 0))
+            self.assertEqual((0, 0), index.update(
+                index_file, ['tile_1_1', 'x', 'tile_2_2', 'y'], _parse_tile,
+                calls))
+            self.assertEqual(0, os.path.getmtime(index_file))
+
+    def test_update_new_index(self):
+        with tmpdir() as d:
+            index_file = os.path.join(d, 'index.yaml')
+            self.assertEqual((2, 0), index.update(index_file, ['a', 'b']))
+            self.assertEqual(['a', 'b'], index.names(index_file))
+
+    def test_is_stale(self):
+        with tmpdir() as d:
+            index_file = os.path.join(d, 'index.yaml')
+            self.assertTrue(index.is_stale(index_file, 100))
+
+            self._write_index(d, ['a'])
+            os.utime(index_file, (0, 0))
+            self.assertTrue(index.is_stale(index_file, 100))
+
+            # checking the index counts as refreshing it, even if it hasn't
+            # changed.
+            index.save_validators(index_file, dict(etag='"abc"'))
+            self.assertFalse(index.is_stale(index_file, 100))
+            self.assertEqual('"abc"',
+                             index.validators(index_file)['etag'])
+
+    def _brute_force(self, names, bbox):
+        return set(n for n in names if n.startswith('tile_') and
+                   _parse_tile(n, []).bbox.intersects(bbox))
+
+    def test_tile_intersector(self):
+        names = ['tile_%d_%d' % (x, y)
+                 for x in range(-125, -119) for y in range(35, 40)]
+
+        with tmpdir() as d:
+            index_file = self._write_index(d, names)
+            idx = index.create(index_file, None, _parse_tile, [])
+            intersector = index.TileIntersector(idx, 0.01, max_parents=4)
+
+            # a block of z14 tiles spanning several z12 parents, including
+            # some on the edges of the 1x1 degree source tiles, plus some low
+            # zoom tiles and a tile which isn't a Mercator tile at all.
+            tiles = [_mercator_tile(14, x, y)
+                     for x in range(2630, 2650) for y in range(6325, 6340)]
+            tiles.extend(_mercator_tile(z, 5 << (z - 4), 12 << (z - 5))
+                         for z in range(5, 13))
+            tiles.append(_Tile('other', -122, 37))
+
+            for t, objs in zip(tiles, intersector.intersections(tiles)):
+                expected = self._brute_force(names,
+                                             t.latlon_bbox().buffer(0.01))
+                self.assertEqual(expected, set(o.name for o in objs))
+
+            self.assertTrue(len(intersector.parents) <= 4)
+
+    def test_intersect_many_empty(self):
+        with tmpdir() as d:
+            index_file = self._write_index(d, ['not_a_tile'])
+            idx = index.create(index_file, None, _parse_tile, [])
+            bboxes = numpy.array([[0, 0, 1, 1], [2, 2, 3, 3]], dtype=float)
+            self.assertEqual([[], []], idx.intersect_many(bboxes))
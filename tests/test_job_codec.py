@@ -0,0 +1,59 @@
+import unittest
+import joerd.job_codec as job_codec
+import random
+
+
+SOURCES = [
+    dict(source='srtm', vrts=[['srtm/N37W123.hgt', 'srtm/N37W122.hgt']]),
+    dict(source='ned', vrts=[['ned/a.img'], ['ned/b.img', 'srtm/N37W122.hgt']]),
+]
+
+
+def _key(datum):
+    return tuple(sorted(datum.items()))
+
+
+class TestJobCodec(unittest.TestCase):
+
+    def _round_trip(self, data):
+        job = job_codec.encode_render_batch(SOURCES, data)
+        self.assertEqual(job_codec.PACKED_JOB_TYPE, job['job'])
+
+        decoded = job_codec.decode_render_batch(job)
+        self.assertEqual('renderbatch', decoded['job'])
+        self.assertEqual(SOURCES, decoded['sources'])
+        self.assertEqual(sorted(set(_key(d) for d in data)),
+                         sorted(_key(d) for d in decoded['data']))
+        return job
+
+    def test_rectangle(self):
+        data = [dict(type='terrarium', z=15, x=x, y=y)
+                for x in range(5000, 5100) for y in range(12000, 12050)]
+        job = self._round_trip(data)
+        # a single rectangle should pack down to almost nothing.
+        self.assertTrue(len(job['payload']) < 200)
+
+    def test_irregular(self):
+        rnd = random.Random(1234)
+        data = []
+        for z in (8, 12, 15):
+            for i in range(500):
+                x = rnd.randint(0, (1 << z) - 1)
+                y = rnd.randint(0, (1 << z) - 1)
+                data.append(dict(type='normal', z=z, x=x, y=y))
+        # some tiles of a different type, which has no zoom, and duplicates.
+        data.extend(dict(type='skadi', x=x, y=90) for x in range(10, 20))
+        data.extend(data[:20])
+        self._round_trip(data)
+
+    def test_rectangles_cover_exactly(self):
+        rnd = random.Random(5678)
+        coords = set((rnd.randint(0, 20), rnd.randint(0, 20))
+                     for i in range(200))
+        rects = job_codec._rectangles(coords)
+
+        covered = []
+        for x, y, w, h in rects:
+            covered.extend((x + i, y + j) for i in range(w) for j in range(h))
+        self.assertEqual(len(covered), len(set(covered)))
+        self.assertEqual(coords, set(covered))
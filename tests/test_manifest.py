@@ -0,0 +1,96 @@
+import unittest
+import joerd.manifest as manifest
+import joerd.store.file as file_store
+from joerd.tmpdir import tmpdir
+import json
+
+
+def _job(sources, x, y):
+    return dict(job='render', sources=sources,
+                data=dict(type='terrarium', z=12, x=x, y=y))
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.sources = [
+            dict(source='srtm', vrts=[['srtm/N37W123.hgt']]),
+            dict(source='etopo1', vrts=[['etopo1/ETOPO1_Bed_g_geotiff.tif']]),
+        ]
+
+    def test_round_trip(self):
+        with tmpdir() as d:
+            store = file_store.create(dict(base_dir=d))
+
+            # the server sees the sources after they've been through the
+            # queue, so make sure that gives the same hash.
+            queued = json.loads(json.dumps(self.sources))
+            data = [_job(queued, x, 1580)['data'] for x in range(654, 658)]
+            manifest.write(store, 'manifest', queued, data, 1)
+
+            rendered = manifest.load(store, 'manifest', 1)
+            self.assertTrue(rendered.is_current(
+                _job(self.sources, 655, 1580)))
+            self.assertFalse(rendered.is_current(
+                _job(self.sources, 655, 1581)))
+
+            # a tile rendered from different sources needs re-rendering.
+            changed = [dict(source='srtm', vrts=[['srtm/N37W123.hgt']])]
+            self.assertFalse(rendered.is_current(
+                _job(changed, 655, 1580)))
+
+            # and so does everything, if the version changes.
+            bumped = manifest.load(store, 'manifest', 2)
+            self.assertFalse(bumped.is_current(
+                _job(self.sources, 655, 1580)))
+
+    def test_latest_inputs(self):
+        # a tile's inputs change from A to B and back to A. the stored tile
+        # was rendered from B, so the old manifest for A mustn't count.
+        changed = [dict(source='srtm', vrts=[['srtm/N37W123.hgt']])]
+        data = [_job(self.sources, 655, 1580)['data']]
+
+        class _Clock(object):
+            now = 0
+
+            def time(self):
+                self.now += 1
+                return self.now
+
+        orig = manifest.time
+        try:
+            manifest.time = _Clock()
+            with tmpdir() as d:
+                store = file_store.create(dict(base_dir=d))
+
+                manifest.write(store, 'manifest', self.sources, data, 1)
+                manifest.write(store, 'manifest', changed, data, 1)
+                rendered = manifest.load(store, 'manifest', 1)
+                self.assertFalse(rendered.is_current(
+                    _job(self.sources, 655, 1580)))
+                self.assertTrue(rendered.is_current(
+                    _job(changed, 655, 1580)))
+
+                # once it's rendered from A again, B is out of date.
+                manifest.write(store, 'manifest', self.sources, data, 1)
+                rendered = manifest.load(store, 'manifest', 1)
+                self.assertTrue(rendered.is_current(
+                    _job(self.sources, 655, 1580)))
+                self.assertFalse(rendered.is_current(
+                    _job(changed, 655, 1580)))
+                self.assertEqual(1, len(rendered.tiles))
+
+        finally:
+            manifest.time = orig
+
+    def test_list_files(self):
+        with tmpdir() as d:
+            store = file_store.create(dict(base_dir=d))
+            data = [_job(self.sources, 1, 2)['data']]
+            manifest.write(store, 'manifest', self.sources, data, 1)
+            manifest.write(store, 'other', self.sources, data, 1)
+
+            names = list(store.list_files('manifest/'))
+            self.assertEqual(1, len(names))
+            self.assertTrue(names[0].startswith('manifest/'))
+            self.assertEqual([], list(store.list_files('missing/')))
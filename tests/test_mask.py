@@ -0,0 +1,252 @@
+import unittest
+import joerd.mask as mask
+import numpy
+
+
+class _Band(object):
+    """
+    Just enough of a GDAL band to read and write windows, recording the
+    windows which were read, and to hold the band's metadata.
+    """
+
+    DataType = 0
+
+    def __init__(self, data, block_size):
+        self.data = data
+        self.YSize, self.XSize = data.shape
+        self.block_size = block_size
+        self.reads = []
+        self.metadata = {}
+        self.nodata = None
+        self.scale = None
+        self.offset = None
+        self.unit_type = ''
+
+    def GetBlockSize(self):
+        return list(self.block_size)
+
+    def ReadAsArray(self, x, y, w, h):
+        self.reads.append((x, y, w, h))
+        return self.data[y:y+h, x:x+w].copy()
+
+    def GetNoDataValue(self):
+        return self.nodata
+
+    def SetNoDataValue(self, nodata):
+        self.nodata = nodata
+
+    def GetMetadata(self):
+        return dict(self.metadata)
+
+    def SetMetadata(self, md):
+        self.metadata = dict(md)
+
+    def GetScale(self):
+        return self.scale
+
+    def SetScale(self, scale):
+        self.scale = scale
+
+    def GetOffset(self):
+        return self.offset
+
+    def SetOffset(self, offset):
+        self.offset = offset
+
+    def GetUnitType(self):
+        return self.unit_type
+
+    def SetUnitType(self, unit_type):
+        self.unit_type = unit_type
+
+    def WriteArray(self, data, x, y):
+        h, w = data.shape
+        self.data[y:y+h, x:x+w] = data
+        return 0
+
+
+class _Dataset(object):
+    def __init__(self, bands):
+        self.bands = bands
+        self.RasterCount = len(bands)
+        self.RasterYSize, self.RasterXSize = bands[0].data.shape
+
+    def GetRasterBand(self, n):
+        return self.bands[n - 1]
+
+    def GetGeoTransform(self):
+        return (0, 1, 0, 0, 0, -1)
+
+    def GetProjection(self):
+        return ''
+
+    def GetMetadata(self):
+        return {}
+
+    def SetGeoTransform(self, gt):
+        pass
+
+    def SetProjection(self, proj):
+        pass
+
+    def SetMetadata(self, md):
+        pass
+
+
+class _Driver(object):
+    """
+    Just enough of a GDAL driver to create datasets of fake bands, recording
+    which datasets it was asked to create or copy.
+    """
+
+    def __init__(self, name, can_create, created):
+        self.name = name
+        self.can_create = can_create
+        self.created = created
+
+    def GetMetadataItem(self, key):
+        return 'YES' if self.can_create else None
+
+    def Create(self, filename, x_size, y_size, count, data_type):
+        self.created.append((self.name, 'Create'))
+        return _Dataset([_Band(numpy.zeros((y_size, x_size)), (x_size, 1))
+                         for i in range(count)])
+
+    def CreateCopy(self, filename, src_ds):
+        self.created.append((self.name, 'CreateCopy'))
+        return src_ds
+
+
+class _Gdal(object):
+    DCAP_CREATE = 'DCAP_CREATE'
+    CPLE_None = 0
+
+    def __init__(self):
+        self.created = []
+        self.drivers = dict(
+            GTiff=_Driver('GTiff', True, self.created),
+            MEM=_Driver('MEM', True, self.created),
+            SRTMHGT=_Driver('SRTMHGT', False, self.created))
+
+    def GetDriverByName(self, name):
+        return self.drivers[name]
+
+
+class TestMask(unittest.TestCase):
+
+    def _check_windows(self, x_size, y_size, block_size, max_pixels):
+        band = _Band(numpy.zeros((y_size, x_size)), block_size)
+        covered = numpy.zeros((y_size, x_size), dtype=numpy.int32)
+        windows = list(mask._windows(band, max_pixels))
+
+        for x, y, w, h in windows:
+            covered[y:y+h, x:x+w] += 1
+            # windows start on block boundaries, and aren't larger than
+            # allowed unless a single block is.
+            self.assertEqual(0, x % block_size[0])
+            self.assertEqual(0, y % block_size[1])
+            self.assertTrue(w * h <= max(max_pixels,
+                                         block_size[0] * block_size[1]))
+
+        # every pixel is in exactly one window.
+        self.assertTrue((covered == 1).all())
+        return windows
+
+    def test_windows_scanlines(self):
+        # scanline blocks are grouped into strips of whole rows.
+        windows = self._check_windows(100, 95, (100, 1), 1000)
+        self.assertEqual(10, len(windows))
+        self.assertEqual((0, 90, 100, 5), windows[-1])
+
+    def test_windows_tiled(self):
+        self._check_windows(100, 95, (16, 16), 1000)
+        self._check_windows(100, 95, (16, 16), 10)
+        self._check_windows(100, 95, (256, 256), 1000)
+
+    def test_copy_windows(self):
+        src = numpy.arange(-50, 50, dtype=numpy.int16).reshape((10, 10))
+        src_ds = _Dataset([_Band(src, (10, 1)), _Band(src.copy(), (10, 1))])
+        dst_ds = _Dataset([_Band(numpy.zeros_like(src), (10, 1)),
+                           _Band(numpy.zeros_like(src), (10, 1))])
+
+        # mask using the raw mask data, a window at a time.
+        msk = (src % 3 == 0).astype(numpy.uint8) * 255
+        nodata = -32768
+
+        def _msk_data(window):
+            x, y, w, h = window
+            return msk[y:y+h, x:x+w]
+
+        fn = mask._mask_with(_msk_data, 255, nodata)
+        orig = mask._WINDOW_PIXELS
+        try:
+            mask._WINDOW_PIXELS = 30
+            mask._copy_windows(src_ds, dst_ds, fn)
+        finally:
+            mask._WINDOW_PIXELS = orig
+
+        # strips of 3 rows.
+        self.assertEqual(4, len(src_ds.bands[0].reads))
+
+        expected = numpy.where(msk == 255, nodata, src)
+        self.assertEqual(expected.tolist(), dst_ds.bands[0].data.tolist())
+        # only the first band is processed.
+        self.assertEqual(src.tolist(), dst_ds.bands[1].data.tolist())
+
+    def test_create_like_copies_band_metadata(self):
+        src_band = _Band(numpy.zeros((10, 10)), (10, 1))
+        src_band.metadata = dict(AREA_OR_POINT='Point')
+        src_band.nodata = -32768
+        src_band.scale = 0.1
+        src_band.offset = -100
+        src_band.unit_type = 'm'
+        plain_band = _Band(numpy.zeros((10, 10)), (10, 1))
+        src_ds = _Dataset([src_band, plain_band])
+
+        drv = _Driver('GTiff', True, [])
+        dst_ds = mask._create_like(drv, 'out', src_ds)
+
+        dst_band = dst_ds.GetRasterBand(1)
+        self.assertEqual(dict(AREA_OR_POINT='Point'), dst_band.metadata)
+        self.assertEqual(-32768, dst_band.nodata)
+        self.assertEqual(0.1, dst_band.scale)
+        self.assertEqual(-100, dst_band.offset)
+        self.assertEqual('m', dst_band.unit_type)
+
+        # bands without any of these are left alone.
+        dst_band = dst_ds.GetRasterBand(2)
+        self.assertEqual({}, dst_band.metadata)
+        self.assertIsNone(dst_band.nodata)
+        self.assertIsNone(dst_band.scale)
+        self.assertIsNone(dst_band.offset)
+        self.assertEqual('', dst_band.unit_type)
+
+    def _staged_by(self, dst_driver, size):
+        src_ds = _Dataset([_Band(numpy.zeros((size, size)), (size, 1))])
+        fake = _Gdal()
+        orig = mask.gdal
+        try:
+            mask.gdal = fake
+            mask._process(src_ds, dst_driver, 'out', lambda d, w: d)
+        finally:
+            mask.gdal = orig
+        return fake.created
+
+    def test_process_staging(self):
+        orig = mask._MEM_STAGE_PIXELS
+        try:
+            mask._MEM_STAGE_PIXELS = 100
+
+            # drivers which can create are written directly.
+            self.assertEqual([('GTiff', 'Create')],
+                             self._staged_by('GTiff', 20))
+
+            # small rasters for copy-only drivers are staged in memory, and
+            # large ones on disk.
+            self.assertEqual([('MEM', 'Create'), ('SRTMHGT', 'CreateCopy')],
+                             self._staged_by('SRTMHGT', 10))
+            self.assertEqual([('GTiff', 'Create'),
+                              ('SRTMHGT', 'CreateCopy')],
+                             self._staged_by('SRTMHGT', 20))
+        finally:
+            mask._MEM_STAGE_PIXELS = orig
@@ -1,5 +1,47 @@
 import unittest
+import joerd.mercator as mercator
 from joerd.mercator import Mercator
+from osgeo import osr
+import numpy
+import math
+
+
+def _ogr_transforms():
+    merc_srs = osr.SpatialReference()
+    merc_srs.ImportFromEPSG(3857)
+    latlon_srs = osr.SpatialReference()
+    latlon_srs.ImportFromEPSG(4326)
+
+    # GDAL 3 defaults to the authority's (lat, lon) axis order for EPSG:4326.
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        merc_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        latlon_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    return (osr.CoordinateTransformation(merc_srs, latlon_srs),
+            osr.CoordinateTransformation(latlon_srs, merc_srs))
+
+
+def _ogr_latlon_bbox(tx, z, x, y):
+    # the way latlon_bbox used to be calculated, by transforming the corners
+    # of the Mercator bbox through OGR.
+    merc = Mercator().mercator_bbox(z, x, y).bounds
+    xs = []
+    ys = []
+    for mx in (merc[0], merc[2]):
+        for my in (merc[1], merc[3]):
+            lon, lat, _ = tx.TransformPoint(mx, my)
+            xs.append(lon)
+            ys.append(lat)
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def _ogr_lonlat_to_xy(tx_inv, zoom, lon, lat):
+    lat = min(max(lat, -85.051129), 85.051129)
+    x, y, _ = tx_inv.TransformPoint(float(lon), float(lat))
+    extent = 1 << zoom
+    tx = int(math.floor(extent * ((x / mercator.MERCATOR_WORLD_SIZE) + 0.5)))
+    ty = int(math.floor(extent * (0.5 - (y / mercator.MERCATOR_WORLD_SIZE))))
+    return (min(max(0, tx), extent - 1), min(max(0, ty), extent - 1))
 
 
 class TestMercator(unittest.TestCase):
@@ -11,3 +53,67 @@ class TestMercator(unittest.TestCase):
             cmax = (1 << zoom) - 1
             self.assertEqual(m.lonlat_to_xy(zoom, -180, 90), (0, 0))
             self.assertEqual(m.lonlat_to_xy(zoom, 180, -90), (cmax, cmax))
+
+    def test_world_bbox(self):
+        bbox = Mercator().latlon_bbox(0, 0, 0).bounds
+        for expected, actual in zip((-180, -85.0511287798, 180, 85.0511287798),
+                                    bbox):
+            self.assertAlmostEqual(expected, actual, places=6)
+
+    def test_vectorised_matches_scalar(self):
+        m = Mercator()
+        zs = numpy.array([0, 3, 10, 15, 19])
+        xs = numpy.array([0, 5, 163, 5243, 419485])
+        ys = numpy.array([0, 2, 395, 12663, 1013089])
+
+        ll = mercator.latlon_bboxes(zs, xs, ys)
+        merc = mercator.mercator_bboxes(zs, xs, ys)
+        for i in range(len(zs)):
+            z, x, y = int(zs[i]), int(xs[i]), int(ys[i])
+            for e, a in zip(ll[i], m.latlon_bbox(z, x, y).bounds):
+                self.assertAlmostEqual(e, a, places=9)
+            for e, a in zip(merc[i], m.mercator_bbox(z, x, y).bounds):
+                self.assertAlmostEqual(e, a, places=6)
+
+        tx, ty = mercator.lonlat_to_tiles(
+            15, numpy.array([-122.4, 0.0, 151.2]),
+            numpy.array([37.8, 0.0, -33.9]))
+        self.assertEqual(
+            [m.lonlat_to_xy(15, -122.4, 37.8), m.lonlat_to_xy(15, 0.0, 0.0),
+             m.lonlat_to_xy(15, 151.2, -33.9)],
+            zip(tx.tolist(), ty.tolist()))
+
+    def test_tile_range(self):
+        m = Mercator()
+        tiles = list(mercator.tile_range(12, 654, 1580, 657, 1584))
+        self.assertEqual(20, len(tiles))
+        for x, y, ll_bbox, merc_bbox in tiles:
+            for e, a in zip(m.latlon_bbox(12, x, y).bounds, ll_bbox.bounds):
+                self.assertAlmostEqual(e, a, places=9)
+            for e, a in zip(m.mercator_bbox(12, x, y).bounds,
+                            merc_bbox.bounds):
+                self.assertAlmostEqual(e, a, places=6)
+
+    def test_latlon_bbox_matches_ogr(self):
+        tx, tx_inv = _ogr_transforms()
+        m = Mercator()
+
+        for z in range(0, 20, 3):
+            extent = 1 << z
+            for x, y in ((0, 0), (extent - 1, extent - 1),
+                         (extent // 3, (2 * extent) // 3),
+                         ((5 * extent) // 7, extent // 5)):
+                expected = _ogr_latlon_bbox(tx, z, x, y)
+                actual = m.latlon_bbox(z, x, y).bounds
+                for e, a in zip(expected, actual):
+                    self.assertAlmostEqual(e, a, places=9)
+
+    def test_lonlat_to_xy_matches_ogr(self):
+        tx, tx_inv = _ogr_transforms()
+        m = Mercator()
+
+        for zoom in (0, 4, 9, 13, 17, 19):
+            for lon, lat in ((-122.39199, 37.79123), (0, 0), (179.9, -89),
+                             (-45.5, 84.9), (139.69, 35.69), (18.4, -33.9)):
+                self.assertEqual(_ogr_lonlat_to_xy(tx_inv, zoom, lon, lat),
+                                 m.lonlat_to_xy(zoom, lon, lat))
@@ -0,0 +1,171 @@
+import unittest
+import joerd.mercator as mercator
+import numpy
+
+
+class _Band(object):
+    def __init__(self, data):
+        self.data = data
+
+    def ReadAsArray(self, x=0, y=0, w=None, h=None):
+        h = self.data.shape[0] if h is None else h
+        w = self.data.shape[1] if w is None else w
+        return self.data[y:y+h, x:x+w].copy()
+
+    def WriteArray(self, data):
+        self.data[:] = data
+        return 0
+
+
+class _Dataset(object):
+    """
+    Just enough of a GDAL dataset to cover an area of "world pixels", where
+    the world is `world_px` pixels on a side.
+    """
+
+    def __init__(self, world_px, px_bbox, data=None):
+        res = mercator.MERCATOR_WORLD_SIZE / world_px
+        half = 0.5 * mercator.MERCATOR_WORLD_SIZE
+        self.gt = (res * px_bbox[0] - half, res, 0,
+                   half - res * px_bbox[1], 0, -res)
+        self.RasterXSize = px_bbox[2] - px_bbox[0]
+        self.RasterYSize = px_bbox[3] - px_bbox[1]
+        if data is None:
+            data = numpy.full((self.RasterYSize, self.RasterXSize),
+                              mercator.FLT_NODATA, numpy.float32)
+        self.band = _Band(data)
+
+    def GetGeoTransform(self):
+        return self.gt
+
+    def GetRasterBand(self, n):
+        return self.band
+
+
+def _render(world_px, px_bbox):
+    """
+    Stands in for compositing the sources over an area, giving each pixel a
+    value unique to its position in the world.
+    """
+
+    xs = numpy.arange(px_bbox[0], px_bbox[2], dtype=numpy.float32)
+    ys = numpy.arange(px_bbox[1], px_bbox[3], dtype=numpy.float32)
+    return (ys[:, numpy.newaxis] * world_px + xs).astype(numpy.float32)
+
+
+class _Tile(mercator.MercatorTile):
+    def __init__(self, z, x, y, size=256, margin=0):
+        super(_Tile, self).__init__(z, x, y, size, None, None)
+        self.margin = margin
+        self.sources = []
+
+    def px_bbox(self):
+        # the area the tile renders, including its margin, which is clipped
+        # at the edges of the world.
+        world_px = self.size << self.z
+        return (max(0, self.x * self.size - self.margin),
+                max(0, self.y * self.size - self.margin),
+                min(world_px, (self.x + 1) * self.size + self.margin),
+                min(world_px, (self.y + 1) * self.size + self.margin))
+
+
+class TestMetatile(unittest.TestCase):
+
+    def _groups(self, metatiles):
+        return sorted(sorted((t.z, t.x, t.y, t.size) for t in m.tiles)
+                      for m in metatiles)
+
+    def test_disabled(self):
+        tiles = [_Tile(4, x, 0) for x in range(0, 4)]
+        metatiles, singles = mercator.metatiles(tiles, 0)
+        self.assertEqual([], metatiles)
+        self.assertEqual(tiles, singles)
+
+    def test_grouping(self):
+        # tiles are grouped in blocks of 2x2 256px tiles, and tiles which
+        # aren't Mercator tiles are left over.
+        other = object()
+        tiles = [_Tile(4, x, y) for x in range(1, 4) for y in range(0, 2)]
+        metatiles, singles = mercator.metatiles(tiles + [other], 2)
+
+        self.assertEqual([other], singles)
+        self.assertEqual([
+            [(4, 1, 0, 256), (4, 1, 1, 256)],
+            [(4, 2, 0, 256), (4, 2, 1, 256), (4, 3, 0, 256),
+             (4, 3, 1, 256)],
+        ], self._groups(metatiles))
+
+        # each metatile covers just its own tiles.
+        bboxes = sorted(m.px_bbox for m in metatiles)
+        self.assertEqual([(256, 0, 512, 512), (512, 0, 1024, 512)], bboxes)
+
+    def test_mixed_sizes(self):
+        # a 512px tile is at the same resolution as the 256px tiles at the
+        # next zoom, so they can share a metatile, but not with 256px tiles
+        # at its own zoom.
+        tiles = [_Tile(3, 0, 0, 512), _Tile(4, 1, 1), _Tile(3, 0, 0)]
+        metatiles, singles = mercator.metatiles(tiles, 4)
+
+        self.assertEqual([], singles)
+        self.assertEqual([
+            [(3, 0, 0, 256)],
+            [(3, 0, 0, 512), (4, 1, 1, 256)],
+        ], self._groups(metatiles))
+
+    def test_margin_clipped_to_world(self):
+        # margins are included, except beyond the edges of the world.
+        tiles = [_Tile(2, 0, 0, margin=10), _Tile(2, 1, 0, margin=10)]
+        metatiles, singles = mercator.metatiles(tiles, 2)
+        self.assertEqual(1, len(metatiles))
+        self.assertEqual((0, 0, 522, 266), metatiles[0].px_bbox)
+
+        tiles = [_Tile(1, 0, 0, margin=10), _Tile(1, 1, 1, margin=10)]
+        metatiles, singles = mercator.metatiles(tiles, 2)
+        self.assertEqual((0, 0, 512, 512), metatiles[0].px_bbox)
+
+    def _check_extract(self, tiles, metatile_size):
+        metatiles, singles = mercator.metatiles(tiles, metatile_size)
+        self.assertEqual([], singles)
+
+        count = 0
+        for m in metatiles:
+            m.ds = _Dataset(m.world_px, m.px_bbox,
+                            _render(m.world_px, m.px_bbox))
+
+            for t in m.tiles:
+                world_px = t.size << t.z
+                dst = _Dataset(world_px, t.px_bbox())
+                self.assertTrue(m.extract(dst))
+
+                # the same as if the tile had been rendered by itself.
+                expected = _render(world_px, t.px_bbox())
+                self.assertEqual(expected.tolist(), dst.band.data.tolist())
+                count += 1
+
+        self.assertEqual(len(tiles), count)
+
+    def test_extract(self):
+        self._check_extract([_Tile(3, x, y, margin=10)
+                             for x in range(0, 8) for y in range(2, 5)], 2)
+        self._check_extract([_Tile(3, 2, 2, 512, margin=10),
+                             _Tile(4, 5, 4, margin=10),
+                             _Tile(4, 7, 7, margin=10)], 4)
+
+    def test_extract_refuses(self):
+        tile = _Tile(3, 2, 2)
+        metatiles, singles = mercator.metatiles([tile], 1)
+        m = metatiles[0]
+
+        # not rendered yet.
+        self.assertFalse(m.extract(_Dataset(2048, tile.px_bbox())))
+
+        m.ds = _Dataset(m.world_px, m.px_bbox,
+                        _render(m.world_px, m.px_bbox))
+
+        # a different resolution, or an area outside the metatile, are left
+        # alone.
+        dst = _Dataset(4096, (1024, 1024, 1280, 1280))
+        self.assertFalse(m.extract(dst))
+        dst = _Dataset(2048, (512, 512, 788, 788))
+        self.assertFalse(m.extract(dst))
+        self.assertTrue((dst.band.data == mercator.FLT_NODATA).all())
@@ -2,6 +2,10 @@ import unittest
 import joerd.source.ned as ned
 import joerd.source.ned_base as ned_base
 import joerd.source.ned_topobathy as ned_topo
+import joerd.index as index
+from joerd.tmpdir import tmpdir
+from tests.ftpserver import FTPServer
+import os.path
 
 
 FAKE_OPTIONS = dict(
@@ -84,3 +88,51 @@ class TestNEDSource(unittest.TestCase):
             self.assertTrue(t is not None, fname)
             f = t.zip_name()
             self.assertEqual(fname, f)
+
+    def test_list_files_reuses_session(self):
+        files = {
+            '/ned/ned19_n38x00_w122x50_ca_sanfrancisco_2010.zip': 'x',
+            '/ned/ned19_n38x00_w122x25_ca_sanfrancisocoast_2010.zip': 'x',
+            '/ned/readme.txt': 'x',
+        }
+        with FTPServer(files) as ftp:
+            options = dict(FAKE_OPTIONS, base_path='/ned',
+                           ftp_server=ftp.url('')[len('ftp://'):])
+            n = ned.create(options)
+            for i in range(2):
+                self.assertEqual(
+                    ['ned19_n38x00_w122x25_ca_sanfrancisocoast_2010.zip',
+                     'ned19_n38x00_w122x50_ca_sanfrancisco_2010.zip'],
+                    sorted(n.base._list_ned_files()))
+
+            self.assertEqual(1, ftp.logins)
+
+    def test_index_refresh_checks_mdtm(self):
+        files = {
+            '/ned/ned19_n38x00_w122x50_ca_sanfrancisco_2010.zip': 'x',
+        }
+        mtimes = {'/ned': 1000000000}
+
+        with tmpdir() as d, FTPServer(files, mtimes) as ftp:
+            options = dict(FAKE_OPTIONS, base_path='/ned', base_dir=d,
+                           ftp_server=ftp.url('')[len('ftp://'):])
+            n = ned.create(options)
+            index_file = os.path.join(d, 'index.yaml')
+
+            n.base.download_index(index_file)
+            self.assertEqual(
+                ['ned19_n38x00_w122x50_ca_sanfrancisco_2010.zip'],
+                index.names(index_file))
+            self.assertEqual(1, ftp.commands.count('NLST'))
+
+            # an unchanged directory isn't listed again.
+            n.base.download_index(index_file)
+            self.assertEqual(1, ftp.commands.count('NLST'))
+
+            # but a changed one is, and the index picks up the new file.
+            files['/ned/ned19_n38x00_w122x25_ca_sanfrancisocoast_2010.zip'] \
+                = 'x'
+            mtimes['/ned'] += 60
+            n.base.download_index(index_file)
+            self.assertEqual(2, ftp.commands.count('NLST'))
+            self.assertEqual(2, len(index.names(index_file)))
@@ -0,0 +1,29 @@
+import unittest
+import joerd.output.normal as normal
+import numpy
+
+
+class TestHeightMapping(unittest.TestCase):
+
+    def test_table_size(self):
+        # the flipped index must fit in a byte.
+        self.assertEqual(255, len(normal.HEIGHT_TABLE))
+
+    def test_vectorised_matches_scalar(self):
+        # check that the vectorised lookup gives exactly the same bytes as
+        # the scalar bisect version, including the values exactly on the
+        # table boundaries and those either side of them.
+        table = numpy.array(normal.HEIGHT_TABLE, dtype=numpy.float32)
+        heights = numpy.concatenate((
+            table, table - 0.5, table + 0.5,
+            numpy.array([-12000, 9000, -3.0e38], dtype=numpy.float32),
+            numpy.linspace(-11500, 9500, 10000).astype(numpy.float32)))
+        pixels = heights.reshape((-1, 8))
+
+        expected = numpy.vectorize(normal._height_mapping_func)(pixels) \
+            .astype(numpy.uint8)
+        actual = normal._height_mapping(pixels)
+
+        self.assertEqual(expected.dtype, actual.dtype)
+        self.assertEqual(expected.shape, actual.shape)
+        self.assertEqual(expected.tobytes(), actual.tobytes())
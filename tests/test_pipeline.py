@@ -0,0 +1,80 @@
+import unittest
+import joerd.pipeline as pipeline
+import threading
+import time
+import os
+import os.path
+
+
+class _Tile(object):
+    def __init__(self, name, fail=False):
+        self.name = name
+        self.fail = fail
+
+    def render(self, d):
+        if self.fail:
+            raise RuntimeError("Render failed.")
+        with open(os.path.join(d, self.name), 'w') as fh:
+            fh.write(self.name)
+
+
+class _Store(object):
+    def __init__(self, delay=0, fail_on=None):
+        self.delay = delay
+        self.fail_on = fail_on
+        self.uploaded = []
+        self.dirs = []
+        self.threads = set()
+
+    def upload_all(self, d):
+        self.threads.add(threading.current_thread().ident)
+        self.dirs.append(d)
+        time.sleep(self.delay)
+        for f in os.listdir(d):
+            if f == self.fail_on:
+                raise RuntimeError("Upload failed.")
+            self.uploaded.append(f)
+
+
+class TestPipeline(unittest.TestCase):
+
+    def _check(self, queue_size):
+        store = _Store(delay=0.01)
+        names = [str(i) for i in range(0, 20)]
+
+        with pipeline.renderer(store, queue_size) as r:
+            for name in names:
+                r.render(_Tile(name))
+
+        # all uploads should have finished by the time the context exits,
+        # and the temporary directories should have been cleaned up.
+        self.assertEqual(names, store.uploaded)
+        for d in store.dirs:
+            self.assertFalse(os.path.exists(d))
+
+        return store
+
+    def test_sync(self):
+        store = self._check(0)
+        self.assertEqual(set([threading.current_thread().ident]),
+                         store.threads)
+
+    def test_pipelined(self):
+        store = self._check(2)
+        self.assertFalse(threading.current_thread().ident in store.threads)
+
+    def test_upload_error(self):
+        store = _Store(fail_on='1')
+        with self.assertRaises(RuntimeError):
+            with pipeline.renderer(store, 2) as r:
+                for i in range(0, 5):
+                    r.render(_Tile(str(i)))
+        self.assertTrue('1' not in store.uploaded)
+
+    def test_render_error(self):
+        store = _Store()
+        with self.assertRaises(RuntimeError):
+            with pipeline.renderer(store, 2) as r:
+                r.render(_Tile('0'))
+                r.render(_Tile('1', fail=True))
+        self.assertEqual(['0'], store.uploaded)
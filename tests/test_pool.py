@@ -0,0 +1,105 @@
+import unittest
+import joerd.pool as pool
+import logging
+import time
+import os
+
+
+class _Server(object):
+    def __init__(self):
+        self.cleaned_up = []
+
+    def close(self):
+        pass
+
+    def cleanup_worker(self, pid):
+        self.cleaned_up.append(pid)
+
+    def dispatch_job(self, job):
+        if job == 'crash':
+            os._exit(1)
+        elif job == 'fail':
+            raise RuntimeError("Job failed.")
+
+
+class _Message(object):
+    def __init__(self, body, deleted, released):
+        self.body = body
+        self.deleted = deleted
+        self.released = released
+
+    def delete(self):
+        self.deleted.append(self.body)
+
+    def release(self):
+        self.released.append(self.body)
+
+
+class _Queue(object):
+    def __init__(self, bodies):
+        self.bodies = list(bodies)
+        self.deleted = []
+        self.released = []
+
+    def receive_messages(self):
+        if self.bodies:
+            yield _Message(self.bodies.pop(0), self.deleted, self.released)
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def test_run_jobs(self):
+        logger = logging.getLogger('process')
+        server = _Server()
+        self.assertTrue(pool.run_jobs(server, ['a', 'b'], logger))
+        self.assertFalse(pool.run_jobs(server, ['a', 'fail', 'b'], logger))
+
+    def test_pool_deletes_successful_messages(self):
+        # the message which crashes its worker and the one which fails
+        # shouldn't be deleted, but the pool should carry on and process the
+        # others with a restarted worker.
+        logger = logging.getLogger('process')
+        queue = _Queue([['a'], ['crash'], ['b'], ['fail'], ['c', 'd']])
+        server = _Server()
+        p = pool.WorkerPool(server, queue, 2)
+
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            p._check_workers(logger)
+            p._fill()
+            p._handle_results(logger, 0.1)
+            if not queue.bodies and not p.in_flight:
+                break
+
+        for w in p.workers:
+            w.terminate()
+
+        # messages handed to the crashed worker, but which it hadn't started,
+        # are released along with the one it crashed on, so every message is
+        # either deleted or will be retried.
+        self.assertIn(['crash'], queue.released)
+        self.assertIn(['fail'], queue.released)
+        self.assertEqual(
+            [['a'], ['b'], ['c', 'd'], ['crash'], ['fail']],
+            sorted(queue.deleted + queue.released))
+        # the crashed worker's leftovers are cleaned up when it's restarted.
+        self.assertEqual(1, len(server.cleaned_up))
+
+    def test_pool_releases_messages_not_started(self):
+        # a message handed to a worker which dies before taking it off its
+        # queue should be released, rather than held in flight forever.
+        logger = logging.getLogger('process')
+        queue = _Queue([['a']])
+        p = pool.WorkerPool(_Server(), queue, 1)
+
+        p._check_workers(logger)
+        p.workers[0].terminate()
+        p.workers[0].join()
+        p._fill()
+        self.assertEqual(1, len(p.in_flight))
+
+        p._check_workers(logger)
+        p.workers[0].terminate()
+
+        self.assertEqual({}, p.in_flight)
+        self.assertEqual([['a']], queue.released)
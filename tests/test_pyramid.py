@@ -0,0 +1,139 @@
+import unittest
+import joerd.pyramid as pyramid
+import joerd.mercator as mercator
+import joerd.store.file as file_store
+from joerd.tmpdir import tmpdir
+import logging
+import numpy
+
+
+class _Band(object):
+    def __init__(self, data):
+        self.data = data
+
+    def ReadAsArray(self):
+        return self.data.copy()
+
+    def WriteArray(self, data):
+        self.data[:] = data
+        return 0
+
+
+class _Dataset(object):
+    """
+    Just enough of a GDAL dataset to cover a Mercator tile.
+    """
+
+    def __init__(self, z, x, y, size=256, margin=0, data=None):
+        res = mercator.MERCATOR_WORLD_SIZE / (size << z)
+        half = 0.5 * mercator.MERCATOR_WORLD_SIZE
+        self.gt = (res * (x * size - margin) - half, res, 0,
+                   half - res * (y * size - margin), 0, -res)
+        self.RasterXSize = self.RasterYSize = size + 2 * margin
+        if data is None:
+            data = numpy.full((self.RasterYSize, self.RasterXSize),
+                              mercator.FLT_NODATA, numpy.float32)
+        self.band = _Band(data)
+
+    def GetGeoTransform(self):
+        return self.gt
+
+    def GetRasterBand(self, n):
+        return self.band
+
+
+class _Tile(mercator.MercatorTile):
+    def __init__(self, z, x, y, size=256):
+        super(_Tile, self).__init__(z, x, y, size, None, None)
+
+
+class TestPyramid(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger('pyramid')
+
+    def test_downsample(self):
+        nd = numpy.float32(mercator.FLT_NODATA)
+        data = numpy.array([[1, 3, nd, nd],
+                            [5, 7, nd, 4]], dtype=numpy.float32)
+        self.assertEqual([[4, 4]], pyramid._downsample(data).tolist())
+
+        data = numpy.full((2, 2), nd, numpy.float32)
+        self.assertEqual([[nd]], pyramid._downsample(data).tolist())
+
+    def test_build_from_level_above(self):
+        with tmpdir() as d:
+            p = pyramid.Pyramid(file_store.create(dict(base_dir=d)), 1)
+
+            # the level 1 tile needs all four level 2 children.
+            dst = _Dataset(1, 1, 0)
+            self.assertFalse(p.downsample(dst, self.logger))
+
+            for i, (x, y) in enumerate([(2, 0), (3, 0), (2, 1), (3, 1)]):
+                data = numpy.full((256, 256), float(i), numpy.float32)
+                p.save(_Dataset(2, x, y, data=data), self.logger)
+
+            self.assertTrue(p.downsample(dst, self.logger))
+            result = dst.band.data
+            self.assertEqual(0, result[0, 0])
+            self.assertEqual(1, result[0, 255])
+            self.assertEqual(2, result[255, 0])
+            self.assertEqual(3, result[255, 255])
+
+            # its heights are saved in turn, so that level 0 could be built
+            # if the rest of the level was there.
+            p.save(dst, self.logger)
+            self.assertTrue(file_store.create(dict(base_dir=d)).exists(
+                'heights/v1/1/1/0.npy'))
+
+            # a margin needs the neighbouring cells, which aren't there.
+            self.assertFalse(p.downsample(_Dataset(1, 1, 0, margin=10),
+                                          self.logger))
+
+    def test_version(self):
+        # heights saved for another render version aren't used.
+        with tmpdir() as d:
+            store = file_store.create(dict(base_dir=d))
+            old = pyramid.Pyramid(store, 1, version=1)
+            for x, y in [(2, 0), (3, 0), (2, 1), (3, 1)]:
+                old.save(_Dataset(2, x, y), self.logger)
+
+            self.assertTrue(old.downsample(_Dataset(1, 1, 0), self.logger))
+            new = pyramid.Pyramid(store, 1, version=2)
+            self.assertFalse(new.downsample(_Dataset(1, 1, 0), self.logger))
+
+    def test_save_with_margin(self):
+        with tmpdir() as d:
+            store = file_store.create(dict(base_dir=d))
+            p = pyramid.Pyramid(store, 3)
+
+            # only the whole cell inside the margin is saved, and not at all
+            # if the level is too high to be needed.
+            data = numpy.arange(276 * 276, dtype=numpy.float32)
+            p.save(_Dataset(4, 5, 6, margin=10,
+                            data=data.reshape((276, 276))), self.logger)
+            p.save(_Dataset(5, 5, 6), self.logger)
+
+            self.assertEqual(['heights/v1/4/5/6.npy'],
+                             list(store.list_files('heights/')))
+            cell = numpy.load(d + '/heights/v1/4/5/6.npy')
+            self.assertEqual(data[10 * 276 + 10], cell[0, 0])
+
+    def test_bottom_up(self):
+        tiles = [_Tile(z, 0, 0) for z in range(0, 5)] + [_Tile(1, 0, 0, 512)]
+        calls = []
+
+        def _generate(zooms=None):
+            calls.append(zooms)
+            for t in tiles:
+                if zooms is None or t.z in zooms:
+                    yield t
+
+        ordered = list(pyramid.bottom_up(_generate, 2))
+        self.assertEqual([(3, 256), (4, 256), (2, 256), (1, 512), (1, 256),
+                          (0, 256)],
+                         [(t.z, t.size) for t in ordered])
+
+        # the pyramid levels are generated again, one at a time, rather than
+        # being held back from the first pass.
+        self.assertEqual([None, set([2, 1]), set([1]), set([0])], calls)
@@ -0,0 +1,79 @@
+import unittest
+import joerd.store.s3 as s3
+from joerd.tmpdir import tmpdir
+from joerd.mkdir_p import mkdir_p
+from moto import mock_s3
+import boto3
+import os
+import os.path
+
+
+class TestS3Store(unittest.TestCase):
+
+    def setUp(self):
+        # moto doesn't need real credentials, but boto needs something to be
+        # configured.
+        for k, v in [('AWS_ACCESS_KEY_ID', 'testing'),
+                     ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                     ('AWS_DEFAULT_REGION', 'us-east-1')]:
+            os.environ.setdefault(k, v)
+
+    @mock_s3
+    def test_upload_all(self):
+        conn = boto3.resource('s3')
+        conn.create_bucket(Bucket='tiles')
+
+        store = s3.create(dict(bucket_name='tiles', upload_threads=4))
+
+        expected = {}
+        with tmpdir() as d:
+            for x in range(0, 10):
+                mkdir_p(os.path.join(d, 'terrarium', '15', str(x)))
+                for y in range(0, 10):
+                    name = 'terrarium/15/%d/%d.png' % (x, y)
+                    with open(os.path.join(d, name), 'wb') as fh:
+                        fh.write(name)
+                    expected[name] = 'image/png'
+
+            with open(os.path.join(d, 'index.xml'), 'wb') as fh:
+                fh.write('<xml/>')
+            expected['index.xml'] = 'application/xml'
+
+            store.upload_all(d)
+
+        bucket = conn.Bucket('tiles')
+        keys = set(o.key for o in bucket.objects.all())
+        self.assertEqual(set(expected.keys()), keys)
+
+        for name, mime in expected.items():
+            obj = bucket.Object(name).get()
+            self.assertEqual(mime, obj['ContentType'])
+            if name.endswith('.png'):
+                self.assertEqual(name, obj['Body'].read())
+
+        self.assertTrue(store.exists('terrarium/15/3/4.png'))
+        self.assertFalse(store.exists('terrarium/15/3/10.png'))
+
+        self.assertEqual(
+            sorted(n for n in expected if n.startswith('terrarium/15/3/')),
+            sorted(store.list_files('terrarium/15/3/')))
+
+    @mock_s3
+    def test_upload_failure(self):
+        # uploading to a bucket which doesn't exist should fail after
+        # retrying, rather than silently dropping the files.
+        store = s3.create(dict(bucket_name='missing', upload_threads=2))
+
+        def _no_backoff(src_name, s3_key, transfer_config, extra_args,
+                        tries, backoff=1):
+            return s3.S3Store.retry_upload_file(
+                store, src_name, s3_key, transfer_config, extra_args, 1,
+                backoff=0)
+        store.retry_upload_file = _no_backoff
+
+        with tmpdir() as d:
+            with open(os.path.join(d, 'a.png'), 'wb') as fh:
+                fh.write('a')
+
+            with self.assertRaises(Exception):
+                store.upload_all(d)
@@ -0,0 +1,91 @@
+import unittest
+import joerd.server as server
+import os.path
+
+
+class _Store(object):
+    """
+    Fake source store which makes empty files, and counts how many times
+    each has been fetched.
+    """
+
+    def __init__(self):
+        self.fetches = {}
+
+    def get(self, source, dest):
+        self.fetches[source] = self.fetches.get(source, 0) + 1
+        with open(dest, 'w'):
+            pass
+
+    def stats(self):
+        return dict(hits=0, misses=0, files=0, size=0)
+
+    def upload_all(self, d):
+        pass
+
+
+class _Source(object):
+    pass
+
+
+class _Tile(object):
+    """
+    Stands in for a tile which either needs its sources to render, or can be
+    built without them, e.g: from the pyramid.
+    """
+
+    def __init__(self, needs_sources):
+        self.needs_sources = needs_sources
+        self.vrts = None
+
+    def set_sources(self, sources):
+        self.sources = sources
+
+    def render(self, d):
+        if self.needs_sources:
+            self.vrts = [s.vrts_for(self) for s in self.sources]
+
+
+class _Server(server.Server):
+    """
+    A server with only what's needed to render, and fake stores.
+    """
+
+    def __init__(self):
+        self.sources = [('srtm', _Source()), ('etopo1', _Source())]
+        self.store = _Store()
+        self.working_set = _Store()
+        self.upload_queue_size = 0
+        self.metatile_size = 0
+        self.pyramid = None
+
+
+class TestServer(unittest.TestCase):
+
+    def _sources(self):
+        return [
+            dict(source='srtm', vrts=[['srtm/N37W123.hgt']]),
+            dict(source='etopo1', vrts=[['etopo1/ETOPO1_Bed_g_geotiff.tif']]),
+            dict(source='srtm', vrts=[[]]),
+        ]
+
+    def test_sources_fetched_lazily(self):
+        # tiles which don't need the sources don't fetch them.
+        s = _Server()
+        s._render([_Tile(False), _Tile(False)], self._sources())
+        self.assertEqual({}, s.working_set.fetches)
+
+    def test_sources_fetched_once(self):
+        s = _Server()
+        tiles = [_Tile(False), _Tile(True), _Tile(True)]
+        s._render(tiles, self._sources())
+
+        self.assertEqual({'srtm/N37W123.hgt': 1,
+                          'etopo1/ETOPO1_Bed_g_geotiff.tif': 1},
+                         s.working_set.fetches)
+
+        # sources with no files are left out.
+        self.assertEqual(2, len(tiles[1].vrts))
+        self.assertEqual(tiles[1].vrts, tiles[2].vrts)
+        self.assertEqual('N37W123.hgt',
+                         os.path.basename(tiles[1].vrts[0][0][0]))
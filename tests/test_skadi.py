@@ -1,5 +1,7 @@
 import unittest
 import joerd.output.skadi as skadi
+from joerd.region import Region
+from joerd.util import BoundingBox
 
 
 class TestTileName(unittest.TestCase):
@@ -9,3 +11,31 @@ class TestTileName(unittest.TestCase):
             for y in range(0, 180):
                 tile_name = skadi._tile_name(x, y)
                 self.assertEqual((x, y), skadi._parse_tile(tile_name))
+
+
+class TestGenerateTiles(unittest.TestCase):
+
+    def _brute_force(self, regions):
+        tiles = set()
+        for x in range(0, 360):
+            for y in range(0, 180):
+                bbox = skadi._bbox(x, y)
+                for r in regions:
+                    if r.intersects(bbox, skadi.SKADI_NOMINAL_ZOOM):
+                        tiles.add((x, y))
+        return tiles
+
+    def test_generate_tiles(self):
+        regions = [
+            Region(BoundingBox(-124.56, 32.4, -114.15, 42.03), [0, 16]),
+            Region(BoundingBox(-120, 40, -100, 45), [10, 13]),
+            Region(BoundingBox(10, -5, 11, -4), [0, 16]),
+            Region(BoundingBox(179.5, 89.5, 180, 90), [0, 16]),
+            # not at a zoom which includes Skadi
+            Region(BoundingBox(0, 0, 50, 50), [0, 5]),
+        ]
+        s = skadi.Skadi(regions, [])
+
+        tiles = [(t.x, t.y) for t in s.generate_tiles()]
+        self.assertEqual(len(set(tiles)), len(tiles))
+        self.assertEqual(self._brute_force(regions), set(tiles))
@@ -0,0 +1,139 @@
+import unittest
+import joerd.queue.sqlite as sqlite
+from joerd.tmpdir import tmpdir
+import multiprocessing
+import json
+import time
+import os.path
+
+
+def _produce(path, start, count):
+    queue = sqlite.create(None, dict(path=path))
+    for i in range(start, start + count):
+        queue.send_message(json.dumps([dict(job='test', i=i)]))
+    queue.flush()
+
+
+class TestSQLiteQueue(unittest.TestCase):
+
+    def _queue(self, d, **config):
+        config['path'] = os.path.join(d, 'queue.db')
+        config.setdefault('wait_time', 0)
+        return sqlite.create(None, config)
+
+    def _send(self, queue, bodies):
+        for body in bodies:
+            queue.send_message(json.dumps(body))
+        queue.flush()
+
+    def test_send_receive_delete(self):
+        with tmpdir() as d:
+            queue = self._queue(d, receive_batch_size=4)
+            batch = queue.start_batch(3)
+            for i in range(7):
+                batch.append(dict(job='test', i=i))
+            batch.flush()
+            queue.flush()
+
+            received = []
+            while True:
+                msgs = list(queue.receive_messages())
+                if not msgs:
+                    break
+                self.assertTrue(len(msgs) <= 4)
+                received.extend(msgs)
+
+            # 7 jobs in batches of up to 3.
+            self.assertEqual([3, 3, 1], [len(m.body) for m in received])
+            self.assertEqual(range(7), [j['i'] for m in received
+                                        for j in m.body])
+
+            for m in received:
+                m.delete()
+            self.assertEqual(0, len(queue.heartbeat.messages))
+            queue.heartbeat.stop()
+
+    def test_visibility_timeout(self):
+        with tmpdir() as d:
+            queue = self._queue(d, visibility_timeout=0.5,
+                                heartbeat_interval=1000)
+            self._send(queue, ['a'])
+
+            msg, = list(queue.receive_messages())
+            self.assertEqual([], list(queue.receive_messages()))
+
+            # a heartbeat keeps the message hidden past its first timeout.
+            time.sleep(0.3)
+            queue.heartbeat.beat()
+            time.sleep(0.35)
+            self.assertEqual([], list(queue.receive_messages()))
+
+            # when the process holding the message goes away, the message
+            # becomes visible again after the timeout.
+            time.sleep(0.5)
+            other = self._queue(d)
+            again, = list(other.receive_messages())
+            self.assertEqual('a', again.body)
+
+            # the original receipt is no longer valid, so deleting with it
+            # does nothing.
+            msg.delete()
+            again.delete()
+            self.assertEqual([], list(other.receive_messages()))
+
+            queue.heartbeat.stop()
+            other.heartbeat.stop()
+
+    def test_release_and_dead_letters(self):
+        with tmpdir() as d:
+            queue = self._queue(d, max_receives=2)
+            self._send(queue, ['a', 'b'])
+
+            a, b = list(queue.receive_messages())
+            self.assertEqual(['a', 'b'], [a.body, b.body])
+            a.release()
+            b.delete()
+
+            a, = list(queue.receive_messages())
+            self.assertEqual('a', a.body)
+            a.release()
+
+            # 'a' has failed too many times, so it goes to the dead letter
+            # table instead of being received again.
+            self.assertEqual([], list(queue.receive_messages()))
+            dead = queue.conn.execute(
+                "SELECT body, receive_count FROM dead_letters").fetchall()
+            self.assertEqual([(json.dumps('a'), 2)], dead)
+
+            self.assertEqual(1, queue.requeue_dead_letters())
+            msg, = list(queue.receive_messages())
+            self.assertEqual('a', msg.body)
+            msg.delete()
+
+            queue.heartbeat.stop()
+
+    def test_many_producers(self):
+        with tmpdir() as d:
+            queue = self._queue(d)
+            path = queue.path
+
+            procs = [multiprocessing.Process(target=_produce,
+                                             args=(path, i * 100, 100))
+                     for i in range(4)]
+            for p in procs:
+                p.start()
+            for p in procs:
+                p.join()
+                self.assertEqual(0, p.exitcode)
+
+            seen = []
+            while True:
+                msgs = list(queue.receive_messages())
+                if not msgs:
+                    break
+                for m in msgs:
+                    seen.append(m.body[0]['i'])
+                    m.delete()
+
+            self.assertEqual(range(400), sorted(seen))
+            queue.heartbeat.stop()
@@ -0,0 +1,104 @@
+import unittest
+import joerd.queue.sqs as sqs
+from moto import mock_sqs
+import boto3
+import json
+import os
+
+
+class TestSQSQueue(unittest.TestCase):
+
+    def setUp(self):
+        # moto doesn't need real credentials, but boto needs something to be
+        # configured.
+        for k, v in [('AWS_ACCESS_KEY_ID', 'testing'),
+                     ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                     ('AWS_DEFAULT_REGION', 'us-east-1')]:
+            os.environ.setdefault(k, v)
+
+    def _queue(self, **config):
+        boto3.resource('sqs').create_queue(
+            QueueName='jobs', Attributes=dict(VisibilityTimeout='30'))
+        config['queue_name'] = 'jobs'
+        config.setdefault('wait_time', 0)
+        return sqs.create(None, config)
+
+    @mock_sqs
+    def test_receive_batch(self):
+        queue = self._queue()
+        for i in range(15):
+            queue.send_message(json.dumps(dict(job='test', i=i)))
+        queue.flush()
+
+        received = []
+        while len(received) < 15:
+            msgs = list(queue.receive_messages())
+            self.assertTrue(msgs)
+            self.assertTrue(len(msgs) <= 10)
+            received.extend(msgs)
+
+        self.assertEqual(range(15), sorted(m.body['i'] for m in received))
+        self.assertEqual(15, len(queue.heartbeat.messages))
+
+        for m in received:
+            m.delete()
+        self.assertEqual(0, len(queue.heartbeat.messages))
+        self.assertEqual([], list(queue.receive_messages()))
+
+        queue.heartbeat.stop()
+
+    @mock_sqs
+    def test_heartbeat_extends_visibility(self):
+        queue = self._queue(visibility_timeout=1, heartbeat_interval=1000)
+        queue.send_message(json.dumps(dict(job='test')))
+        queue.flush()
+
+        msg, = list(queue.receive_messages())
+        # extend the visibility timeout, and check the message can't be
+        # received again straight away.
+        queue.heartbeat.beat()
+        self.assertEqual([], list(queue.receive_messages()))
+
+        # once released, it's left to time out and be retried.
+        msg.release()
+        self.assertEqual(0, len(queue.heartbeat.messages))
+        queue.heartbeat.beat()
+
+        queue.heartbeat.stop()
+
+    def test_failed_heartbeat_drops_message(self):
+        class _Msg(object):
+            def __init__(self, receipt_handle):
+                self.receipt_handle = receipt_handle
+
+        class _Queue(object):
+            def __init__(self):
+                self.calls = []
+
+            def change_message_visibility_batch(self, Entries):
+                self.calls.append(Entries)
+                # fail the entry for the message with handle 'gone'.
+                return dict(Failed=[dict(Id=e['Id'], Code='Invalid')
+                                    for e in Entries
+                                    if e['ReceiptHandle'] == 'gone'])
+
+        queue = _Queue()
+        heartbeat = sqs.Heartbeat(queue, 60, 1000)
+        for h in ['gone'] + ['h%d' % i for i in range(11)]:
+            heartbeat.add(_Msg(h))
+
+        heartbeat.beat()
+        # 12 messages need two requests, as each can have at most 10.
+        self.assertEqual([10, 2], [len(c) for c in queue.calls])
+        self.assertEqual(11, len(heartbeat.messages))
+        self.assertFalse('gone' in heartbeat.messages)
+
+        heartbeat.stop()
+
+    @mock_sqs
+    def test_flush_empty(self):
+        queue = self._queue()
+        # nothing to send, so this shouldn't make a (failing) empty request.
+        queue.flush()
+        self.assertEqual([], list(queue.receive_messages()))
+        queue.heartbeat.stop()
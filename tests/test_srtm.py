@@ -1,5 +1,11 @@
 import unittest
 import joerd.source.srtm as srtm
+import joerd.index as index
+from joerd.tmpdir import tmpdir
+import BaseHTTPServer as http
+from httptestserver import Server
+import contextlib
+import os.path
 
 
 FAKE_OPTIONS = dict(
@@ -7,6 +13,39 @@ FAKE_OPTIONS = dict(
 )
 
 
+# serves an HTML listing with an ETag, and records the If-None-Match header
+# of each request.
+class _ListingHandler(http.BaseHTTPRequestHandler):
+    def __init__(self, page, requests, *args):
+        self.page = page
+        self.requests = requests
+        http.BaseHTTPRequestHandler.__init__(self, *args)
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        etag = self.headers.get('If-None-Match')
+        self.requests.append(etag)
+        if etag == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', len(self.page))
+        self.end_headers()
+        self.wfile.write(self.page)
+
+
+@contextlib.contextmanager
+def _test_http_server(handler):
+    server = Server('127.0.0.1', 0, 'http', handler)
+    server.start()
+    yield server
+
+
 class TestSRTMSource(unittest.TestCase):
 
     def test_file_name_parsing_1(self):
@@ -29,3 +68,29 @@ class TestSRTMSource(unittest.TestCase):
         bbox = s._parse_bbox(fname)
         self.assertTrue(bbox is not None)
         self.assertEqual((-116, 37, -115, 38), bbox.bounds)
+
+    def test_index_refresh_is_conditional(self):
+        page = '<html><a href="N37W123.SRTMGL1.hgt.zip">x</a>' \
+               '<a href="N38W122.SRTMGL1.hgt.zip">x</a>' \
+               '<a href="readme.txt">x</a></html>'
+        requests = []
+
+        def _handler(*args):
+            return _ListingHandler(page, requests, *args)
+
+        with tmpdir() as d:
+            with _test_http_server(_handler) as server:
+                s = srtm.create(dict(url=server.url('/tiles/'), base_dir=d))
+                index_file = os.path.join(d, 'index_tile.yaml')
+
+                s.download_index(index_file, 'tile')
+                self.assertEqual(
+                    ['N37W123.SRTMGL1.hgt.zip', 'N38W122.SRTMGL1.hgt.zip'],
+                    index.names(index_file))
+
+                # the second time, the server says the listing hasn't
+                # changed.
+                s.download_index(index_file, 'tile')
+                self.assertFalse(index.is_stale(index_file, 100))
+
+        self.assertEqual([None, '"v1"'], requests)
@@ -34,3 +34,12 @@ class TestTerrariumTiles(unittest.TestCase):
             if coord in expected:
                 expected.remove(coord)
         self.assertEqual(expected, set([]))
+
+    def test_generate_tiles_at_zooms(self):
+        regions = [
+            Region(BoundingBox(-124.56, 32.4, -114.15, 42.03), [8, 10])
+        ]
+        t = terrarium.Terrarium(regions, [])
+        all_tiles = [(c.z, c.x, c.y) for c in t.generate_tiles()]
+        tiles = [(c.z, c.x, c.y) for c in t.generate_tiles(set([9]))]
+        self.assertEqual([c for c in all_tiles if c[0] == 9], tiles)
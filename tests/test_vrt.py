@@ -0,0 +1,61 @@
+import unittest
+import joerd.vrt as vrt
+
+
+class TestVrtCache(unittest.TestCase):
+
+    def setUp(self):
+        # stand in for building the VRT, recording the files in each one.
+        self.built = []
+
+        def _build(files, srs):
+            self.built.append(list(files))
+            return object()
+
+        self.orig_build = vrt._build
+        vrt._build = _build
+
+    def tearDown(self):
+        vrt._build = self.orig_build
+
+    def test_builds_once(self):
+        files = ['srtm/N37W123.hgt', 'srtm/N37W122.hgt']
+        datasets = []
+
+        with vrt.cache() as c:
+            for i in range(0, 4):
+                with c.build(files, 'EPSG:4326') as ds:
+                    datasets.append(ds)
+
+            with c.build(files[:1], 'EPSG:4326') as ds:
+                datasets.append(ds)
+
+        self.assertEqual([files, files[:1]], self.built)
+        self.assertEqual(1, len(set(id(ds) for ds in datasets[:4])))
+        self.assertTrue(datasets[4] is not datasets[0])
+
+    def test_order_matters(self):
+        # the first file wins where they overlap, so the same files in a
+        # different order are a different mosaic.
+        files = ['srtm/N37W123.hgt', 'srtm/N37W122.hgt']
+
+        with vrt.cache() as c:
+            with c.build(files, 'EPSG:4326') as a:
+                pass
+            with c.build(list(reversed(files)), 'EPSG:4326') as b:
+                pass
+
+        self.assertEqual([files, list(reversed(files))], self.built)
+        self.assertTrue(a is not b)
+
+    def test_clear(self):
+        files = ['srtm/N37W123.hgt']
+
+        with vrt.cache() as c:
+            with c.build(files, 'EPSG:4326'):
+                pass
+            c.clear()
+            with c.build(files, 'EPSG:4326'):
+                pass
+
+        self.assertEqual(2, len(self.built))
@@ -0,0 +1,117 @@
+import unittest
+from joerd.working_set import WorkingSet
+from joerd.tmpdir import tmpdir
+import threading
+import time
+import os.path
+
+
+class _SlowStore(object):
+    """
+    Fake store which makes files of a given size, slowly, and counts how many
+    times each has been fetched.
+    """
+
+    def __init__(self, sizes, delay=0):
+        self.sizes = sizes
+        self.delay = delay
+        self.fetches = {}
+        self.lock = threading.Lock()
+
+    def get(self, source, dest):
+        with self.lock:
+            self.fetches[source] = self.fetches.get(source, 0) + 1
+        time.sleep(self.delay)
+        with open(dest, 'wb') as fh:
+            fh.write('x' * self.sizes[source])
+
+
+class TestWorkingSet(unittest.TestCase):
+
+    def test_hits_and_misses(self):
+        store = _SlowStore({'a': 10, 'b': 10})
+        ws = WorkingSet(store, 100)
+
+        with tmpdir() as d:
+            for i, name in enumerate(['a', 'b', 'a', 'a']):
+                dest = os.path.join(d, str(i))
+                ws.get(name, dest)
+                self.assertEqual(10, os.path.getsize(dest))
+
+        self.assertEqual({'a': 1, 'b': 1}, store.fetches)
+        stats = ws.stats()
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(2, stats['misses'])
+        self.assertEqual(20, stats['size'])
+
+    def test_eviction(self):
+        store = _SlowStore({'a': 40, 'b': 40, 'c': 40})
+        ws = WorkingSet(store, 100)
+
+        with tmpdir() as d:
+            for i, name in enumerate(['a', 'b', 'a', 'c', 'b', 'a']):
+                ws.get(name, os.path.join(d, str(i)))
+
+        # 'b' is evicted when 'c' is added, as 'a' was used more recently.
+        # then 'a' is evicted when 'b' comes back.
+        self.assertEqual({'a': 2, 'b': 2, 'c': 1}, store.fetches)
+        self.assertTrue(ws.stats()['size'] <= 100)
+
+    def test_concurrent_fetch(self):
+        store = _SlowStore({'a': 10}, delay=0.2)
+        ws = WorkingSet(store, 100)
+
+        with tmpdir() as d:
+            threads = [
+                threading.Thread(target=ws.get,
+                                 args=('a', os.path.join(d, str(i))))
+                for i in range(0, 8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            for i in range(0, 8):
+                self.assertEqual(10, os.path.getsize(os.path.join(d, str(i))))
+
+        self.assertEqual({'a': 1}, store.fetches)
+
+    def test_disabled(self):
+        store = _SlowStore({'a': 10})
+        ws = WorkingSet(store, 0)
+
+        with tmpdir() as d:
+            ws.get('a', os.path.join(d, '0'))
+            ws.get('a', os.path.join(d, '1'))
+
+        self.assertEqual({'a': 2}, store.fetches)
+
+    def test_close(self):
+        store = _SlowStore({'a': 10})
+        ws = WorkingSet(store, 100)
+
+        with tmpdir() as d:
+            ws.get('a', os.path.join(d, '0'))
+            ws_dir = ws.dir
+            self.assertTrue(os.path.isdir(ws_dir))
+
+            ws.close()
+            self.assertFalse(os.path.exists(ws_dir))
+
+            # the working set can carry on being used afterwards.
+            ws.get('a', os.path.join(d, '1'))
+            self.assertEqual({'a': 2}, store.fetches)
+            ws.close()
+
+    def test_sweep(self):
+        # the files of a process which didn't close its working set can be
+        # removed by another, given its pid.
+        store = _SlowStore({'a': 10})
+        ws = WorkingSet(store, 100)
+
+        with tmpdir() as d:
+            ws.get('a', os.path.join(d, '0'))
+            ws_dir = ws.dir
+
+            WorkingSet(store, 100).sweep(os.getpid())
+            self.assertFalse(os.path.exists(ws_dir))